@@ -0,0 +1,225 @@
+import os
+import time
+import asyncio
+import hashlib
+import logging
+from functools import lru_cache
+from collections import OrderedDict
+from contextlib import suppress
+from fastapi import Request, Response
+from pydantic import TypeAdapter
+from psycopg import OperationalError, errors
+from psycopg_pool import PoolTimeout
+
+CACHE_ENABLED = os.getenv('API_CACHE_ENABLED', '1') != '0'
+CACHE_MAX_ENTRIES = int(os.getenv('API_CACHE_MAX_ENTRIES', '1024'))
+CACHE_MAX_BYTES = int(os.getenv('API_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+# Entries are invalidated by data versions; the TTL only bounds how long an
+# entry can outlive a version bump the API failed to see
+CACHE_TTL = float(os.getenv('API_CACHE_TTL', '3600'))
+CACHE_REDIS_URL = os.getenv('API_CACHE_REDIS_URL')
+DATA_VERSION_POLL_SECONDS = float(os.getenv('API_DATA_VERSION_POLL_SECONDS', '2'))
+
+@lru_cache(maxsize=None)
+def _adapter(model):
+    return TypeAdapter(model)
+
+def encode_json(data, model):
+    """`data` validated and serialized as `model`, as FastAPI does for an endpoint's response_model."""
+    adapter = _adapter(model)
+    return adapter.dump_json(adapter.validate_python(data, from_attributes=True))
+
+class LRUCache:
+    """In-process LRU of response bodies, bounded by entry count and total bytes, with a TTL."""
+
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, max_bytes=CACHE_MAX_BYTES, ttl=CACHE_TTL):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        body, expires_at = entry
+        if expires_at < time.monotonic():
+            self._remove(key)
+            self.expirations += 1
+            return None
+        self.entries.move_to_end(key)
+        return body
+
+    def set(self, key, body):
+        if len(body) > self.max_bytes:
+            return
+        if key in self.entries:
+            self._remove(key)
+        self.entries[key] = (body, time.monotonic() + self.ttl)
+        self.bytes += len(body)
+        while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+            self._remove(next(iter(self.entries)))
+            self.evictions += 1
+
+    def _remove(self, key):
+        body, _ = self.entries.pop(key)
+        self.bytes -= len(body)
+
+class RedisCache:
+    """Cache shared by every API process; entries expire through Redis' own TTL."""
+
+    def __init__(self, url=CACHE_REDIS_URL, ttl=CACHE_TTL, prefix='api-cache:'):
+        try:
+            import redis.asyncio as redis
+        except ImportError:
+            raise ImportError("API_CACHE_REDIS_URL needs the redis package: pip install redis") from None
+        self.client = redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+        self.errors = 0
+
+    async def get(self, key):
+        try:
+            return await self.client.get(self.prefix + key)
+        except Exception:
+            # A cache outage must not fail the request; compute it instead
+            self.errors += 1
+            return None
+
+    async def set(self, key, body):
+        try:
+            await self.client.set(self.prefix + key, body, ex=int(self.ttl))
+        except Exception:
+            self.errors += 1
+
+    async def close(self):
+        await self.client.aclose()
+
+class DataVersions:
+    """Latest data_versions counters (see src/data_version.py), polled in the background."""
+
+    def __init__(self, pool, interval=DATA_VERSION_POLL_SECONDS):
+        self.pool = pool
+        self.interval = interval
+        self.versions = {}
+        # False until the versions have been read once; nothing is cached before that
+        self.available = False
+        self.refreshed_at = None
+        self.errors = 0
+        self.task = None
+
+    async def refresh(self):
+        try:
+            async with self.pool.connection() as conn:
+                cur = await conn.execute('select component, version from data_versions')
+                self.versions = dict(await cur.fetchall())
+        except errors.UndefinedTable:
+            self.versions = {}  # nothing has been loaded or built yet
+        except (OperationalError, PoolTimeout) as e:
+            # Start (or keep serving) without the database; _poll retries
+            self.errors += 1
+            logging.warning(f'Could not read data versions, caching is paused until the database is back: {e}')
+            return
+        self.available = True
+        self.refreshed_at = time.time()
+
+    async def _poll(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.refresh()
+            except Exception:
+                # Keep serving with the last known versions; the TTL bounds staleness
+                self.errors += 1
+
+    async def start(self):
+        await self.refresh()
+        self.task = asyncio.create_task(self._poll())
+
+    async def stop(self):
+        # Wait for the poll to finish, so it isn't mid-query when the pool closes
+        if self.task:
+            self.task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self.task
+            self.task = None
+
+    def stamp(self, components):
+        return ','.join(f'{c}={self.versions.get(c, 0)}' for c in sorted(components))
+
+class ResponseCache:
+    """JSON responses keyed by request and the data versions they depend on.
+
+    The ETag is derived from the same key, so a client that already has the
+    current version gets a 304 without the response being built or looked up.
+    """
+
+    def __init__(self, versions, local=None, shared=None, enabled=CACHE_ENABLED):
+        self.versions = versions
+        self.local = local if local is not None else LRUCache()
+        self.shared = shared
+        self.enabled = enabled
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.not_modified = 0
+
+    async def respond(self, request: Request, depends, compute, model):
+        """A JSON response for `request`, built by `await compute()` unless cached.
+
+        `depends` names the data_versions components the response is computed from.
+        The raw Response bypasses the endpoint's response_model, so the result is
+        validated and serialized as `model` (the same type) before it is cached.
+        """
+        if not self.versions.available:
+            # Without the versions a cached entry could never be invalidated
+            self.misses += 1
+            return Response(content=encode_json(await compute(), model), media_type='application/json')
+        query = '&'.join(f'{k}={v}' for k, v in sorted(request.query_params.multi_items()))
+        key = f'{request.url.path}?{query}|{self.versions.stamp(depends)}'
+        etag = '"' + hashlib.md5(key.encode('utf-8')).hexdigest() + '"'
+        headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+        if_none_match = [tag.strip().removeprefix('W/') for tag in request.headers.get('if-none-match', '').split(',')]
+        if etag in if_none_match or '*' in if_none_match:
+            self.not_modified += 1
+            return Response(status_code=304, headers=headers)
+        body = self.local.get(key) if self.enabled else None
+        if body is not None:
+            self.hits += 1
+        elif self.enabled and self.shared is not None and (body := await self.shared.get(key)) is not None:
+            self.shared_hits += 1
+            self.local.set(key, body)
+        else:
+            self.misses += 1
+            body = encode_json(await compute(), model)
+            if self.enabled:
+                self.local.set(key, body)
+                if self.shared is not None:
+                    await self.shared.set(key, body)
+        return Response(content=body, media_type='application/json', headers=headers)
+
+    def stats(self):
+        lookups = self.hits + self.shared_hits + self.misses
+        return {
+            'enabled': self.enabled,
+            'hits': self.hits,
+            'shared_hits': self.shared_hits,
+            'misses': self.misses,
+            'hit_ratio': (self.hits + self.shared_hits) / lookups if lookups else 0.0,
+            'not_modified': self.not_modified,
+            'entries': len(self.local.entries),
+            'bytes': self.local.bytes,
+            'max_entries': self.local.max_entries,
+            'max_bytes': self.local.max_bytes,
+            'evictions': self.local.evictions,
+            'expirations': self.local.expirations,
+            'shared': self.shared is not None,
+            'shared_errors': self.shared.errors if self.shared is not None else 0,
+            'data_versions': dict(self.versions.versions),
+            'data_versions_available': self.versions.available,
+            'data_versions_refreshed_at': self.versions.refreshed_at,
+            'data_version_errors': self.versions.errors,
+        }
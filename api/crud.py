@@ -1,66 +1,279 @@
-from .database import get_db_conn
+import json
+import time
+import base64
+import binascii
+from datetime import date, datetime
+from typing import List, Optional, Tuple
+from src.instrumentation import histogram
 from .schemas import ProductReport, ChannelActivity, MessageSearchResult, ImageDetectionResult
-from typing import List
 
-def get_top_products(limit: int = 10) -> List[ProductReport]:
-    conn = get_db_conn()
-    cur = conn.cursor()
-    cur.execute('''
-        select word as product, count(*) as mentions
-        from (
-            select unnest(string_to_array(lower(text), ' ')) as word
-            from fct_messages
-            where text is not null
-        ) t
-        group by word
-        order by mentions desc
+POOL_WAIT_SECONDS = histogram('api_pool_wait_seconds', 'Time spent waiting for a pooled connection')
+DB_QUERY_SECONDS = histogram('api_db_query_seconds', 'Query time on a pooled connection', ['query'])
+
+async def fetch_all(pool, sql, params=(), name='query'):
+    """Run one query on a pooled connection and return all its rows; `name` labels its timings."""
+    started = time.perf_counter()
+    async with pool.connection() as conn:
+        acquired = time.perf_counter()
+        POOL_WAIT_SECONDS.observe(acquired - started)
+        cur = await conn.execute(sql, params)
+        rows = await cur.fetchall()
+        DB_QUERY_SECONDS.labels(name).observe(time.perf_counter() - acquired)
+        return rows
+
+async def get_top_products(pool, limit: int = 10, start_date: Optional[date] = None, end_date: Optional[date] = None,
+                           channels: Optional[List[str]] = None) -> List[ProductReport]:
+    """Most mentioned products from product_mentions_daily (see src/product_mentions.py)."""
+    conditions, params = [], []
+    if start_date:
+        conditions.append('mention_date >= %s')
+        params.append(start_date)
+    if end_date:
+        conditions.append('mention_date <= %s')
+        params.append(end_date)
+    if channels:
+        conditions.append('channel_name = any(%s)')
+        params.append(channels)
+    where = 'where ' + ' and '.join(conditions) if conditions else ''
+    rows = await fetch_all(pool, f'''
+        select product, sum(mentions) as mentions
+        from product_mentions_daily
+        {where}
+        group by product
+        order by mentions desc, product
         limit %s
-    ''', (limit,))
-    results = [ProductReport(product=row[0], mentions=row[1]) for row in cur.fetchall()]
-    cur.close()
-    conn.close()
-    return results
-
-def get_channel_activity(channel_name: str) -> List[ChannelActivity]:
-    conn = get_db_conn()
-    cur = conn.cursor()
-    cur.execute('''
+    ''', params + [limit], name='top_products')
+    return [ProductReport(product=row[0], mentions=row[1]) for row in rows]
+
+async def get_channel_activity(pool, channel_name: str) -> List[ChannelActivity]:
+    rows = await fetch_all(pool, '''
         select date_id::text as date, count(*) as message_count
         from fct_messages
         where channel_name = %s
         group by date_id
         order by date_id
-    ''', (channel_name,))
-    results = [ChannelActivity(date=row[0], message_count=row[1]) for row in cur.fetchall()]
-    cur.close()
-    conn.close()
-    return results
-
-def search_messages(query: str, limit: int = 20) -> List[MessageSearchResult]:
-    conn = get_db_conn()
-    cur = conn.cursor()
-    cur.execute('''
-        select message_id, channel_name, message_date::text, text
-        from fct_messages
-        where text ilike %s
-        order by message_date desc
+    ''', (channel_name,), name='channel_activity')
+    return [ChannelActivity(date=row[0], message_count=row[1]) for row in rows]
+
+# Must match the text search configuration of fct_messages.search_vector
+SEARCH_CONFIG = 'simple'
+# A result this many days older needs twice the text rank to sort level with a newer one
+RECENCY_HALF_LIFE_DAYS = 30
+SNIPPET_OPTIONS = 'StartSel=<b>, StopSel=</b>, MaxWords=25, MinWords=8, MaxFragments=2'
+
+SEARCH_ORDERS = {
+    # ln(rank) + recency as a now-independent score, so cursors stay valid between requests
+    'relevance': (
+        f"ln(ts_rank_cd(m.search_vector, q.tsq) + 0.01) + ln(2) * coalesce(extract(epoch from m.message_date), 0) / {RECENCY_HALF_LIFE_DAYS * 86400}",
+        float,
+    ),
+    # The bare column, ordered like fct_messages_recent_order_idx so pages walk the index
+    'recent': ('m.message_date', datetime.fromisoformat),
+}
+ORDER_BY = {
+    'relevance': 'k.sort_key desc, m.message_id desc, m.channel_name desc',
+    'recent': 'm.message_date desc nulls last, m.message_id desc, m.channel_name desc',
+}
+
+def encode_cursor(order, key, message_id, channel_name):
+    # A NULL key (an undated message under sort=recent) is encoded as null, not a stand-in value
+    value = key.isoformat() if isinstance(key, datetime) else key
+    return base64.urlsafe_b64encode(json.dumps([order, value, message_id, channel_name]).encode()).decode()
+
+def decode_cursor(cursor, order):
+    """(sort key or None, message_id, channel_name) after which the next page starts; ValueError if it is malformed."""
+    try:
+        cursor_order, value, message_id, channel_name = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if cursor_order != order:
+            raise ValueError(f'cursor is for sort={cursor_order}')
+        if value is None and order != 'recent':
+            raise ValueError('invalid cursor')
+        key = None if value is None else SEARCH_ORDERS[order][1](value)
+        return key, int(message_id), str(channel_name)
+    except (TypeError, KeyError, binascii.Error, json.JSONDecodeError) as exc:
+        raise ValueError('invalid cursor') from exc
+
+def like_pattern(query):
+    return '%' + query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+async def search_messages(pool, query: str, limit: int = 20, channels: Optional[List[str]] = None,
+                          start_date: Optional[date] = None, end_date: Optional[date] = None,
+                          order: str = 'relevance', cursor: Optional[str] = None,
+                          snippets: bool = True) -> Tuple[List[MessageSearchResult], Optional[str]]:
+    """One page of messages matching `query`, and the cursor of the next page (None on the last).
+
+    Messages match on full-text words (GIN index on search_vector) or as a
+    substring (trigram index on text). Pages are keyset-paginated on
+    (sort key, message_id, channel_name), so page N costs the same as page 1.
+    """
+    sort_key, _ = SEARCH_ORDERS[order]
+    conditions = ['(m.search_vector @@ q.tsq or m.text ilike %(pattern)s)']
+    params = {'query': query, 'pattern': like_pattern(query), 'limit': limit + 1, 'options': SNIPPET_OPTIONS}
+    if channels:
+        conditions.append('m.channel_name = any(%(channels)s)')
+        params['channels'] = channels
+    if start_date:
+        conditions.append('m.date_id >= %(start_date)s')
+        params['start_date'] = start_date
+    if end_date:
+        conditions.append('m.date_id <= %(end_date)s')
+        params['end_date'] = end_date
+    if cursor:
+        params['after_key'], params['after_id'], params['after_channel'] = decode_cursor(cursor, order)
+        if params['after_key'] is None:
+            # Past the last dated message: only undated ones remain (NULLS LAST)
+            conditions.append('m.message_date is null and (m.message_id, m.channel_name) < (%(after_id)s, %(after_channel)s)')
+        elif order == 'recent':
+            # A row comparison is NULL for undated messages, and they all come after any date
+            conditions.append('((m.message_date, m.message_id, m.channel_name) < (%(after_key)s, %(after_id)s, %(after_channel)s) or m.message_date is null)')
+        else:
+            conditions.append('(sort_key, m.message_id, m.channel_name) < (%(after_key)s, %(after_id)s, %(after_channel)s)')
+    # sort_key is a lateral column so the keyset condition can refer to it
+    snippet = f"ts_headline('{SEARCH_CONFIG}', page.text, page.tsq, %(options)s)" if snippets else 'null'
+    rows = await fetch_all(pool, f'''
+        select page.message_id, page.channel_name, page.message_date::text, page.text, page.sort_key, page.rank, {snippet}
+        from (
+            select m.message_id, m.channel_name, m.message_date, m.text, k.sort_key,
+                   ts_rank_cd(m.search_vector, q.tsq) as rank, q.tsq
+            from fct_messages m
+            cross join (select websearch_to_tsquery('{SEARCH_CONFIG}', %(query)s) as tsq) q
+            cross join lateral (select {sort_key} as sort_key) k
+            where {' and '.join(conditions)}
+            order by {ORDER_BY[order]}
+            limit %(limit)s
+        ) page
+        order by page.sort_key desc nulls last, page.message_id desc, page.channel_name desc
+    ''', params, name='search_messages')
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor(order, last[4], last[0], last[1])
+    results = [
+        MessageSearchResult(message_id=row[0], channel_name=row[1], message_date=row[2], text=row[3], rank=row[5], snippet=row[6])
+        for row in rows
+    ]
+    return results, next_cursor
+
+DETECTION_COLUMNS = 'message_id, channel_name, image_path, detected_object_class, confidence_score, message_date::text'
+
+def detection_result(row):
+    return ImageDetectionResult(
+        message_id=row[0], channel_name=row[1], image_path=row[2],
+        detected_object_class=row[3], confidence_score=row[4], message_date=row[5]
+    )
+
+async def get_detections_for_messages(pool, message_ids: List[int], channels: Optional[List[str]] = None) -> List[ImageDetectionResult]:
+    """Detections of all `message_ids` in one query on the covering message_id index."""
+    params = [list(message_ids)]
+    channel_filter = ''
+    if channels:
+        channel_filter = 'and channel_name = any(%s)'
+        params.append(channels)
+    rows = await fetch_all(pool, f'''
+        select {DETECTION_COLUMNS}
+        from fct_image_detections
+        where message_id = any(%s) {channel_filter}
+        order by message_id, detected_object_class, image_path
+    ''', params, name='detections_for_messages')
+    return [detection_result(row) for row in rows]
+
+async def get_image_detections(pool, message_id: int) -> List[ImageDetectionResult]:
+    return await get_detections_for_messages(pool, [message_id])
+
+async def find_detections(pool, classes: Optional[List[str]] = None, channels: Optional[List[str]] = None,
+                          start_date: Optional[date] = None, end_date: Optional[date] = None,
+                          min_confidence: Optional[float] = None, limit: int = 100) -> List[ImageDetectionResult]:
+    """Newest detections matching the filters."""
+    conditions, params = [], []
+    if classes:
+        conditions.append('detected_object_class = any(%s)')
+        params.append(classes)
+    if channels:
+        conditions.append('channel_name = any(%s)')
+        params.append(channels)
+    if start_date:
+        conditions.append('message_date >= %s')
+        params.append(start_date)
+    if end_date:
+        conditions.append('message_date < %s::date + 1')
+        params.append(end_date)
+    if min_confidence is not None:
+        conditions.append('confidence_score >= %s')
+        params.append(min_confidence)
+    where = 'where ' + ' and '.join(conditions) if conditions else ''
+    rows = await fetch_all(pool, f'''
+        select {DETECTION_COLUMNS}
+        from fct_image_detections
+        {where}
+        order by message_date desc nulls last, message_id desc, detected_object_class
         limit %s
-    ''', (f'%{query}%', limit))
-    results = [MessageSearchResult(message_id=row[0], channel_name=row[1], message_date=row[2], text=row[3]) for row in cur.fetchall()]
-    cur.close()
-    conn.close()
-    return results
-
-def get_image_detections(message_id: int) -> List[ImageDetectionResult]:
-    conn = get_db_conn()
-    cur = conn.cursor()
-    cur.execute('''
-        select d.message_id, m.channel as channel_name, d.image_path, d.detected_object_class, d.confidence_score
-        from fct_image_detections d
-        left join fct_messages m on d.message_id = m.message_id
-        where d.message_id = %s
-    ''', (message_id,))
-    results = [ImageDetectionResult(message_id=row[0], channel_name=row[1], image_path=row[2], detected_object_class=row[3], confidence_score=row[4]) for row in cur.fetchall()]
-    cur.close()
-    conn.close()
-    return results 
\ No newline at end of file
+    ''', params + [limit], name='find_detections')
+    return [detection_result(row) for row in rows]
+
+EXPORT_FETCH_ROWS = 2000
+
+MESSAGE_EXPORT_COLUMNS = [
+    'message_id', 'channel_name', 'message_date', 'date_id', 'sender_id', 'text', 'has_image',
+    'has_document', 'has_video', 'has_audio', 'media_type', 'local_media_path'
+]
+DETECTION_EXPORT_COLUMNS = ['message_id', 'channel_name', 'message_date', 'image_path', 'detected_object_class', 'confidence_score']
+
+async def stream_rows(pool, sql, params=(), fetch_rows=EXPORT_FETCH_ROWS, name='export'):
+    """Yield the rows of `sql` through a named server-side cursor, `fetch_rows` at a time.
+
+    Only one fetch is held in memory however many rows the query returns,
+    and the first rows arrive as soon as the server produces them.
+    """
+    started = time.perf_counter()
+    async with pool.connection() as conn:
+        acquired = time.perf_counter()
+        POOL_WAIT_SECONDS.observe(acquired - started)
+        # Server-side cursors live inside a transaction; the pool's connections are autocommit
+        async with conn.transaction():
+            async with conn.cursor(name='export') as cur:
+                cur.itersize = fetch_rows
+                await cur.execute(sql, params)
+                async for row in cur:
+                    yield row
+        # The whole stream, which includes the time the client took to read it
+        DB_QUERY_SECONDS.labels(name).observe(time.perf_counter() - acquired)
+
+def export_filters(date_column, start_date=None, end_date=None, channels=None):
+    conditions, params = [], []
+    if start_date:
+        conditions.append(f'{date_column} >= %s')
+        params.append(start_date)
+    if end_date:
+        conditions.append(f'{date_column} < %s::date + 1')
+        params.append(end_date)
+    if channels:
+        conditions.append('channel_name = any(%s)')
+        params.append(channels)
+    return ('where ' + ' and '.join(conditions) if conditions else ''), params
+
+def export_messages(pool, start_date: Optional[date] = None, end_date: Optional[date] = None, channels: Optional[List[str]] = None):
+    # Filtered and ordered on message_date so the cursor walks fct_messages_recent_order_idx
+    # backwards and returns rows without sorting the whole result first (undated messages lead)
+    where, params = export_filters('message_date', start_date, end_date, channels)
+    sql = f'''
+        select {', '.join(MESSAGE_EXPORT_COLUMNS)}
+        from fct_messages
+        {where}
+        order by message_date asc nulls first, message_id asc, channel_name asc
+    '''
+    return stream_rows(pool, sql, params, name='export_messages')
+
+def export_detections(pool, start_date: Optional[date] = None, end_date: Optional[date] = None,
+                      channels: Optional[List[str]] = None, min_confidence: Optional[float] = None):
+    where, params = export_filters('message_date', start_date, end_date, channels)
+    if min_confidence is not None:
+        where = (where + ' and ' if where else 'where ') + 'confidence_score >= %s'
+        params.append(min_confidence)
+    sql = f'''
+        select {', '.join(DETECTION_EXPORT_COLUMNS)}
+        from fct_image_detections
+        {where}
+        order by message_id, image_path, detected_object_class  -- fct_image_detections_key
+    '''
+    return stream_rows(pool, sql, params, name='export_detections')
@@ -1,6 +1,9 @@
-import psycopg2
 import os
+import sys
+import asyncio
 from dotenv import load_dotenv
+from psycopg.conninfo import make_conninfo
+from psycopg_pool import AsyncConnectionPool
 
 load_dotenv()
 
@@ -10,11 +13,44 @@ DB_NAME = os.getenv('PGDATABASE', 'telegram_data')
 DB_USER = os.getenv('PGUSER', 'postgres')
 DB_PASS = os.getenv('PGPASSWORD', 'postgres')
 
-def get_db_conn():
-    return psycopg2.connect(
-        host=DB_HOST,
-        port=DB_PORT,
-        dbname=DB_NAME,
-        user=DB_USER,
-        password=DB_PASS
-    ) 
\ No newline at end of file
+# Connections held by each API process; requests beyond POOL_MAX_SIZE queue
+# for up to POOL_TIMEOUT seconds instead of opening more connections
+POOL_MIN_SIZE = int(os.getenv('API_POOL_MIN_SIZE', '2'))
+POOL_MAX_SIZE = int(os.getenv('API_POOL_MAX_SIZE', '10'))
+POOL_TIMEOUT = float(os.getenv('API_POOL_TIMEOUT', '10'))
+POOL_MAX_IDLE = float(os.getenv('API_POOL_MAX_IDLE', '300'))
+
+if sys.platform == 'win32':
+    # psycopg's async connections need the selector event loop
+    asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+
+def conninfo():
+    return make_conninfo(host=DB_HOST, port=DB_PORT, dbname=DB_NAME, user=DB_USER, password=DB_PASS)
+
+def create_pool(min_size=POOL_MIN_SIZE, max_size=POOL_MAX_SIZE, timeout=POOL_TIMEOUT):
+    """A closed pool; open it with `await pool.open()` (the app does this in its lifespan).
+
+    Connections are in autocommit mode: the API only reads, so a request never
+    leaves a connection idle in a transaction.
+    """
+    return AsyncConnectionPool(
+        conninfo(),
+        min_size=min_size,
+        max_size=max_size,
+        timeout=timeout,
+        max_idle=POOL_MAX_IDLE,
+        kwargs={'autocommit': True},
+        open=False,
+        name='api',
+    )
+
+def pool_stats(pool):
+    """Pool counters (see psycopg_pool's get_stats) plus how many connections are in use."""
+    stats = pool.get_stats()
+    in_use = stats.get('pool_size', 0) - stats.get('pool_available', 0)
+    stats.update(
+        in_use=in_use,
+        saturation=in_use / pool.max_size,
+        requests_waiting=stats.get('requests_waiting', 0),
+    )
+    return stats
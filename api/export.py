@@ -0,0 +1,107 @@
+import io
+import os
+import csv
+import json
+import zlib
+import asyncio
+from contextlib import suppress
+from datetime import date, datetime
+from fastapi.responses import StreamingResponse
+from .database import POOL_MAX_SIZE
+
+# Most bytes gathered into one chunk (and gzip-flush) while rows keep arriving
+EXPORT_CHUNK_BYTES = 64 * 1024
+# Encoded lines read ahead of the client; bounds memory when the client is slow
+EXPORT_READ_AHEAD_LINES = 4096
+# Exports hold a pooled connection for as long as they stream, so only a few
+# may run at once; the rest of the pool stays free for the other endpoints
+EXPORT_MAX_CONCURRENT = int(os.getenv('API_EXPORT_MAX_CONCURRENT', str(max(1, POOL_MAX_SIZE // 4))))
+EXPORT_FORMATS = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+
+_export_slots = asyncio.Semaphore(EXPORT_MAX_CONCURRENT)
+
+def json_default(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+async def iter_ndjson(rows, columns):
+    async for row in rows:
+        yield json.dumps(dict(zip(columns, row)), default=json_default, ensure_ascii=False) + '\n'
+
+async def iter_csv(rows, columns):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    async for row in rows:
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+_END = object()
+
+async def _read_ahead(lines, queue):
+    """Put `lines` into `queue` encoded, then _END, or the exception that stopped them."""
+    try:
+        async for line in lines:
+            await queue.put(line.encode('utf-8'))
+        await queue.put(_END)
+    except Exception as exc:
+        await queue.put(exc)
+    finally:
+        await lines.aclose()
+
+async def iter_chunks(lines, compress=False, chunk_bytes=EXPORT_CHUNK_BYTES):
+    """Join encoded lines into chunks, gzipping them as a stream if asked.
+
+    Lines are read ahead in a task, and a chunk is sent once it reaches
+    `chunk_bytes` or as soon as no further line is ready yet. So the first
+    row goes out the moment the cursor returns it, and nothing waits in the
+    buffer while the next fetch (or a narrow filter) keeps the server busy.
+    """
+    gzip = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+
+    def encode(chunk):
+        # Sync-flush so every chunk reaches the client instead of waiting in zlib's window
+        return gzip.compress(chunk) + gzip.flush(zlib.Z_SYNC_FLUSH) if gzip else chunk
+
+    async with _export_slots:
+        queue = asyncio.Queue(EXPORT_READ_AHEAD_LINES)
+        reader = asyncio.create_task(_read_ahead(lines, queue))
+        try:
+            parts, size = [], 0
+            while True:
+                if parts and queue.empty():
+                    yield encode(b''.join(parts))
+                    parts, size = [], 0
+                item = await queue.get()
+                if item is _END:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                parts.append(item)
+                size += len(item)
+                if size >= chunk_bytes:
+                    yield encode(b''.join(parts))
+                    parts, size = [], 0
+            chunk = b''.join(parts)
+            yield gzip.compress(chunk) + gzip.flush() if gzip else chunk
+        finally:
+            # The client went away or the query failed: stop reading and release the connection
+            reader.cancel()
+            with suppress(asyncio.CancelledError):
+                await reader
+
+def export_response(rows, columns, name, fmt='ndjson', compress=False):
+    """StreamingResponse of `rows` as NDJSON or CSV, optionally a .gz download."""
+    lines = iter_ndjson(rows, columns) if fmt == 'ndjson' else iter_csv(rows, columns)
+    filename = f'{name}.{fmt}' + ('.gz' if compress else '')
+    media_type = 'application/gzip' if compress else EXPORT_FORMATS[fmt]
+    return StreamingResponse(
+        iter_chunks(lines, compress),
+        media_type=media_type,
+        headers={'Content-Disposition': f'attachment; filename="{filename}"'},
+    )
@@ -1,78 +1,192 @@
-from fastapi import FastAPI, Query, Path
-from typing import List, Optional
-import psycopg2
-import os
-from dotenv import load_dotenv
-from .schemas import ProductReport, ChannelActivity, MessageSearchResult
-
-load_dotenv()
-
-DB_HOST = os.getenv('PGHOST', 'localhost')
-DB_PORT = os.getenv('PGPORT', '5432')
-DB_NAME = os.getenv('PGDATABASE', 'telegram_data')
-DB_USER = os.getenv('PGUSER', 'postgres')
-DB_PASS = os.getenv('PGPASSWORD', 'kaleb1234')
-
-app = FastAPI()
-
-def get_db_conn():
-    return psycopg2.connect(
-        host=DB_HOST,
-        port=DB_PORT,
-        dbname=DB_NAME,
-        user=DB_USER,
-        password=DB_PASS
-    )
+import time
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Query, Request, Response
+from fastapi.responses import JSONResponse
+from psycopg_pool import PoolTimeout
+from datetime import date
+from typing import List, Literal, Optional
+from . import crud
+from .cache import CACHE_REDIS_URL, DataVersions, RedisCache, ResponseCache
+from .database import create_pool, pool_stats
+from .export import export_response
+from .schemas import ProductReport, ChannelActivity, MessageSearchResult, ImageDetectionResult, PoolHealth
+from src.instrumentation import REGISTRY, counter, gauge, histogram
+
+# Most message ids one batch detection lookup accepts
+MAX_BATCH_MESSAGE_IDS = 500
+
+REQUEST_SECONDS = histogram('api_request_seconds', 'Time until the response starts', ['method', 'route', 'status'])
+REQUESTS_IN_FLIGHT = gauge('api_requests_in_flight', 'Requests being handled')
+POOL_TIMEOUTS = counter('api_pool_timeouts_total', 'Requests answered 503 because no connection freed up')
+POOL_STATS = gauge('api_pool', 'Connection pool counters (see /api/health)', ['stat'])
+CACHE_STATS = gauge('api_cache', 'Response cache counters (see /api/cache/stats)', ['stat'])
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One pool per process, shared by every request
+    app.state.pool = create_pool()
+    await app.state.pool.open()
+    versions = DataVersions(app.state.pool)
+    await versions.start()
+    shared = RedisCache() if CACHE_REDIS_URL else None
+    app.state.cache = ResponseCache(versions, shared=shared)
+    try:
+        yield
+    finally:
+        await versions.stop()
+        if shared is not None:
+            await shared.close()
+        await app.state.pool.close()
+
+app = FastAPI(lifespan=lifespan)
+
+@app.middleware('http')
+async def record_request(request: Request, call_next):
+    started = time.perf_counter()
+    REQUESTS_IN_FLIGHT.inc()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        REQUESTS_IN_FLIGHT.dec()
+        # Label by route template, not path, so /api/channels/{channel_name}/activity is one series
+        route = request.scope.get('route')
+        REQUEST_SECONDS.labels(request.method, route.path if route else 'unmatched', str(status)).observe(time.perf_counter() - started)
+
+@app.exception_handler(PoolTimeout)
+async def pool_timeout_handler(request: Request, exc: PoolTimeout):
+    # Every connection stayed busy for the whole pool timeout
+    POOL_TIMEOUTS.inc()
+    return JSONResponse(status_code=503, content={'detail': 'Database busy, try again'}, headers={'Retry-After': '1'})
 
 @app.get("/api/reports/top-products", response_model=List[ProductReport])
-def top_products(limit: int = Query(10, gt=0, le=100)):
-    # Example: count most mentioned products (by word frequency in messages)
-    conn = get_db_conn()
-    cur = conn.cursor()
-    cur.execute('''
-        select word as product, count(*) as mentions
-        from (
-            select unnest(string_to_array(lower(text), ' ')) as word
-            from fct_messages
-            where text is not null
-        ) t
-        group by word
-        order by mentions desc
-        limit %s
-    ''', (limit,))
-    results = [ProductReport(product=row[0], mentions=row[1]) for row in cur.fetchall()]
-    cur.close()
-    conn.close()
-    return results
+async def top_products(
+    request: Request,
+    limit: int = Query(10, gt=0, le=100),
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    channel: Optional[List[str]] = Query(None, description='Only these channels; repeat for several'),
+):
+    """Messages mentioning each product, read from the precomputed product_mentions_daily."""
+    return await request.app.state.cache.respond(
+        request, ['product_mentions'],
+        lambda: crud.get_top_products(request.app.state.pool, limit, start_date, end_date, channel),
+        model=List[ProductReport],
+    )
 
 @app.get("/api/channels/{channel_name}/activity", response_model=List[ChannelActivity])
-def channel_activity(channel_name: str):
-    conn = get_db_conn()
-    cur = conn.cursor()
-    cur.execute('''
-        select date_id::text as date, count(*) as message_count
-        from fct_messages
-        where channel_name = %s
-        group by date_id
-        order by date_id
-    ''', (channel_name,))
-    results = [ChannelActivity(date=row[0], message_count=row[1]) for row in cur.fetchall()]
-    cur.close()
-    conn.close()
-    return results
+async def channel_activity(request: Request, channel_name: str):
+    return await request.app.state.cache.respond(
+        request, ['marts'], lambda: crud.get_channel_activity(request.app.state.pool, channel_name),
+        model=List[ChannelActivity],
+    )
 
 @app.get("/api/search/messages", response_model=List[MessageSearchResult])
-def search_messages(query: str = Query(..., min_length=1, max_length=100), limit: int = Query(20, gt=0, le=100)):
-    conn = get_db_conn()
-    cur = conn.cursor()
-    cur.execute('''
-        select message_id, channel_name, date_id::text, text
-        from fct_messages
-        where text ilike %s
-        order by date_id desc
-        limit %s
-    ''', (f'%{query}%', limit))
-    results = [MessageSearchResult(message_id=row[0], channel_name=row[1], message_date=row[2], text=row[3]) for row in cur.fetchall()]
-    cur.close()
-    conn.close()
-    return results 
\ No newline at end of file
+async def search_messages(
+    request: Request,
+    response: Response,
+    query: str = Query(..., min_length=1, max_length=100),
+    limit: int = Query(20, gt=0, le=100),
+    channel: Optional[List[str]] = Query(None, description='Only these channels; repeat for several'),
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    sort: Literal['relevance', 'recent'] = 'relevance',
+    cursor: Optional[str] = Query(None, description='X-Next-Cursor of the previous page'),
+    snippets: bool = True,
+):
+    """Full-text/substring search ranked by relevance and recency (or newest first).
+
+    When there are more results, the X-Next-Cursor response header holds the
+    cursor for the next page.
+    """
+    try:
+        results, next_cursor = await crud.search_messages(
+            request.app.state.pool, query, limit, channel, start_date, end_date, sort, cursor, snippets
+        )
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return results
+
+@app.get("/api/detections/by-message", response_model=List[ImageDetectionResult])
+async def detections_by_message(
+    request: Request,
+    message_id: List[int] = Query(..., description=f'Repeat for each message, up to {MAX_BATCH_MESSAGE_IDS}'),
+    channel: Optional[List[str]] = Query(None, description='Only these channels (message ids are unique per channel)'),
+):
+    """Detections for a whole page of messages in one query."""
+    if len(message_id) > MAX_BATCH_MESSAGE_IDS:
+        raise HTTPException(status_code=422, detail=f'At most {MAX_BATCH_MESSAGE_IDS} message ids per request')
+    return await request.app.state.cache.respond(
+        request, ['marts'], lambda: crud.get_detections_for_messages(request.app.state.pool, message_id, channel),
+        model=List[ImageDetectionResult],
+    )
+
+@app.get("/api/detections", response_model=List[ImageDetectionResult])
+async def find_detections(
+    request: Request,
+    detected_object_class: Optional[List[str]] = Query(None, description='Only these classes; repeat for several'),
+    channel: Optional[List[str]] = Query(None, description='Only these channels; repeat for several'),
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    min_confidence: Optional[float] = Query(None, ge=0, le=1),
+    limit: int = Query(100, gt=0, le=1000),
+):
+    """Newest detections by class, channel, date and confidence."""
+    return await request.app.state.cache.respond(
+        request, ['marts'],
+        lambda: crud.find_detections(request.app.state.pool, detected_object_class, channel, start_date, end_date, min_confidence, limit),
+        model=List[ImageDetectionResult],
+    )
+
+@app.get("/api/export/messages")
+async def export_messages(
+    request: Request,
+    format: Literal['ndjson', 'csv'] = 'ndjson',
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    channel: Optional[List[str]] = Query(None, description='Only these channels; repeat for several'),
+    gzip: bool = False,
+):
+    """Every matching row of fct_messages, streamed as it is read."""
+    rows = crud.export_messages(request.app.state.pool, start_date, end_date, channel)
+    return export_response(rows, crud.MESSAGE_EXPORT_COLUMNS, 'messages', format, gzip)
+
+@app.get("/api/export/detections")
+async def export_detections(
+    request: Request,
+    format: Literal['ndjson', 'csv'] = 'ndjson',
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    channel: Optional[List[str]] = Query(None, description='Only these channels; repeat for several'),
+    min_confidence: Optional[float] = Query(None, ge=0, le=1),
+    gzip: bool = False,
+):
+    """Every matching row of fct_image_detections, streamed as it is read."""
+    rows = crud.export_detections(request.app.state.pool, start_date, end_date, channel, min_confidence)
+    return export_response(rows, crud.DETECTION_EXPORT_COLUMNS, 'detections', format, gzip)
+
+@app.get("/api/health", response_model=PoolHealth)
+async def health(request: Request):
+    """Round-trips one query through the pool and reports its size, usage and wait counters."""
+    pool = request.app.state.pool
+    await crud.fetch_all(pool, 'select 1', name='health')
+    return PoolHealth(status='ok', pool=pool_stats(pool))
+
+@app.get("/api/cache/stats")
+async def cache_stats(request: Request):
+    """Response cache hit/miss/eviction counters and the data versions it is keyed on."""
+    return request.app.state.cache.stats()
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics(request: Request):
+    """Every metric in the Prometheus text format, with pool and cache counters as of now."""
+    for stat, value in pool_stats(request.app.state.pool).items():
+        POOL_STATS.labels(stat).set(value)
+    for stat, value in request.app.state.cache.stats().items():
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            CACHE_STATS.labels(stat).set(value)
+    return Response(REGISTRY.render(), media_type='text/plain; version=0.0.4')
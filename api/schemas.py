@@ -1,5 +1,5 @@
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import Dict, List, Optional
 
 class ProductReport(BaseModel):
     product: str
@@ -12,12 +12,19 @@ class ChannelActivity(BaseModel):
 class MessageSearchResult(BaseModel):
     message_id: int
     channel_name: str
-    message_date: str
+    message_date: Optional[str]
     text: Optional[str]
+    rank: Optional[float] = None
+    snippet: Optional[str] = None
 
 class ImageDetectionResult(BaseModel):
     message_id: int
-    channel_name: str
+    channel_name: Optional[str]
     image_path: str
     detected_object_class: str
-    confidence_score: float 
\ No newline at end of file
+    confidence_score: float
+    message_date: Optional[str] = None
+
+class PoolHealth(BaseModel):
+    status: str
+    pool: Dict[str, float]
@@ -0,0 +1,124 @@
+"""Latency of the analytics API under concurrent load.
+
+Starts `uvicorn api.main:app` in a subprocess (or targets --url) and keeps
+`concurrency` requests in flight against each endpoint for --requests
+requests, reporting p50/p95/p99 latency and throughput per level. p99
+should stay flat as concurrency grows past the pool size: extra requests
+queue for a pooled connection instead of opening new ones.
+
+    python benchmarks/bench_api.py --concurrency 1 50 200 400
+    python benchmarks/bench_api.py --url http://localhost:8000 --paths /api/search/messages?query=cream
+"""
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import subprocess
+from _common import percentile
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_PATHS = [
+    '/api/reports/top-products?limit=10',
+    '/api/channels/lobelia4cosmetics/activity',
+    '/api/search/messages?query=cream&limit=20',
+]
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def start_server(opts):
+    port = free_port()
+    cmd = [sys.executable, '-m', 'uvicorn', 'api.main:app', '--port', str(port), '--log-level', 'warning', '--workers', str(opts.server_workers)]
+    proc = subprocess.Popen(cmd, cwd=REPO_ROOT)
+    url = f'http://127.0.0.1:{port}'
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return proc, url
+        except OSError:
+            if proc.poll() is not None:
+                sys.exit('uvicorn exited before accepting connections')
+            time.sleep(0.2)
+    proc.kill()
+    sys.exit('uvicorn did not start within 30s')
+
+async def run_level(client, url, path, concurrency, total):
+    latencies = []
+    statuses = {}
+    queue = iter(range(total))
+
+    async def worker():
+        for _ in queue:
+            started = time.perf_counter()
+            response = await client.get(url + path)
+            latencies.append((time.perf_counter() - started) * 1000)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    return {
+        'path': path,
+        'concurrency': concurrency,
+        'requests': len(latencies),
+        'p50_ms': percentile(latencies, 0.5),
+        'p95_ms': percentile(latencies, 0.95),
+        'p99_ms': percentile(latencies, 0.99),
+        'requests_per_sec': len(latencies) / elapsed,
+        'statuses': statuses,
+    }
+
+async def run(opts, url):
+    import httpx
+    limits = httpx.Limits(max_connections=max(opts.concurrency), max_keepalive_connections=max(opts.concurrency))
+    results = []
+    async with httpx.AsyncClient(limits=limits, timeout=60) as client:
+        for path in opts.paths:
+            await client.get(url + path)  # warm-up
+            for concurrency in opts.concurrency:
+                results.append(await run_level(client, url, path, concurrency, max(opts.requests, concurrency)))
+        health = (await client.get(url + '/api/health')).json()
+    return results, health
+
+def main():
+    parser = argparse.ArgumentParser(description='API latency benchmark under concurrent load')
+    parser.add_argument('--url', type=str, default=None, help='Running API to target (default: start uvicorn api.main:app)')
+    parser.add_argument('--paths', nargs='+', default=DEFAULT_PATHS)
+    parser.add_argument('--concurrency', nargs='+', type=int, default=[1, 50, 200])
+    parser.add_argument('--requests', type=int, default=1000, help='Requests per path and concurrency level')
+    parser.add_argument('--server-workers', type=int, default=1, help='uvicorn worker processes when starting the server')
+    parser.add_argument('--json', action='store_true', help='Print raw JSON results')
+    opts = parser.parse_args()
+
+    proc = None
+    url = opts.url
+    if url is None:
+        proc, url = start_server(opts)
+    try:
+        results, health = asyncio.run(run(opts, url))
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+
+    if opts.json:
+        print(json.dumps({'results': results, 'pool': health.get('pool')}, indent=2))
+        return
+    print(f"{'path':<44}{'conc':>6}{'reqs':>7}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'req/s':>9}  statuses")
+    for r in results:
+        print(f"{r['path'][:43]:<44}{r['concurrency']:>6}{r['requests']:>7}{r['p50_ms']:>9.1f}{r['p95_ms']:>9.1f}{r['p99_ms']:>9.1f}"
+              f"{r['requests_per_sec']:>9.1f}  {r['statuses']}")
+    pool = health.get('pool', {})
+    print(f"Pool after run: size {pool.get('pool_size', 0):.0f}/{pool.get('pool_max', 0):.0f}, "
+          f"requests {pool.get('requests_num', 0):.0f}, queued {pool.get('requests_queued', 0):.0f}, "
+          f"wait {pool.get('requests_wait_ms', 0):.0f} ms total, timeouts {pool.get('requests_errors', 0):.0f}")
+
+if __name__ == '__main__':
+    main()
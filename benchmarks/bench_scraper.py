@@ -0,0 +1,116 @@
+"""Scraper throughput benchmark against a local Telegram stand-in.
+
+Each scraper mode runs in its own subprocess (so peak RSS is per mode) and
+in a scratch directory, driving scrape_telegram.run_scraper with a
+FakeTelegramClient instead of a real one.
+
+The scraper's token bucket would otherwise cap both modes at the same
+requests per second, so each run gets --requests-per-second and --burst
+high enough never to throttle and the modes differ only in concurrency.
+--rate-limited keeps the scraper's defaults instead (anything in
+--scraper-args still wins).
+
+    python benchmarks/bench_scraper.py --corpus replay
+    python benchmarks/bench_scraper.py --corpus synthetic --channels 5 --messages 5000 --latency 0.05
+"""
+import os
+import sys
+import json
+import shlex
+import asyncio
+import argparse
+import tempfile
+import subprocess
+import time
+from _common import peak_rss_mb
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_ROOT, 'src'))
+
+MODES = {
+    'sequential': [],
+    'parallel': ['--parallel'],
+}
+# Requests per second and burst that the fake client never reaches
+UNLIMITED_RATE = ['--requests-per-second', '1000000', '--burst', '1000000']
+
+def build_corpus(opts):
+    from fake_telegram import load_corpus, synthetic_corpus
+    if opts.corpus == 'replay':
+        return load_corpus(
+            os.path.join(REPO_ROOT, 'data/raw/telegram_messages'),
+            os.path.join(REPO_ROOT, 'data/raw/telegram_images'),
+        )
+    return synthetic_corpus(opts.channels, opts.messages, opts.media_ratio, opts.media_bytes)
+
+def run_child(opts):
+    corpus = build_corpus(opts)
+    workdir = tempfile.mkdtemp(prefix='bench_scraper_')
+    os.chdir(workdir)
+    # Imported here so its relative data/ and logs/ paths land in the scratch dir
+    import scrape_telegram
+    from fake_telegram import FakeTelegramClient
+    with open('channels.txt', 'w') as f:
+        f.write('\n'.join(corpus))
+    rate = [] if opts.rate_limited else UNLIMITED_RATE
+    argv = ['--channels', 'channels.txt'] + MODES[opts.child] + rate + shlex.split(opts.scraper_args)
+    args = scrape_telegram.parse_args(argv)
+    client = FakeTelegramClient(corpus, opts.latency, opts.bandwidth, opts.flood_every, opts.flood_seconds)
+    started = time.perf_counter()
+    results = asyncio.run(scrape_telegram.run_scraper(args, lambda session: client))
+    elapsed = time.perf_counter() - started
+    messages = sum(r['messages'] for r in results)
+    media_bytes = sum(r['media_bytes'] for r in results)
+    print(json.dumps({
+        'mode': opts.child,
+        'channels': len(results),
+        'messages': messages,
+        'images': sum(r['images'] for r in results),
+        'seconds': elapsed,
+        'messages_per_sec': messages / elapsed,
+        'media_mb_per_sec': media_bytes / 1e6 / elapsed,
+        'peak_rss_mb': peak_rss_mb(),
+        'requests': client.requests,
+        'workdir': workdir,
+    }))
+
+def main():
+    parser = argparse.ArgumentParser(description='Scraper throughput benchmark')
+    parser.add_argument('--corpus', choices=['replay', 'synthetic'], default='replay')
+    parser.add_argument('--modes', nargs='*', choices=list(MODES), default=list(MODES))
+    parser.add_argument('--channels', type=int, default=3, help='Synthetic channels')
+    parser.add_argument('--messages', type=int, default=1000, help='Synthetic messages per channel')
+    parser.add_argument('--media-ratio', type=float, default=0.5, help='Synthetic share of messages with a photo')
+    parser.add_argument('--media-bytes', type=int, default=150_000, help='Synthetic photo size')
+    parser.add_argument('--latency', type=float, default=0.02, help='Seconds per fake API call')
+    parser.add_argument('--bandwidth', type=float, default=None, help='Fake download bandwidth in bytes/sec')
+    parser.add_argument('--flood-every', type=int, default=0, help='Inject a FloodWaitError every N requests')
+    parser.add_argument('--flood-seconds', type=int, default=1)
+    parser.add_argument('--rate-limited', action='store_true', help="Keep the scraper's default request rate limit")
+    parser.add_argument('--scraper-args', type=str, default='', help='Extra scrape_telegram.py arguments')
+    parser.add_argument('--json', action='store_true', help='Print raw JSON results')
+    parser.add_argument('--child', choices=list(MODES), help=argparse.SUPPRESS)
+    opts = parser.parse_args()
+
+    if opts.child:
+        return run_child(opts)
+
+    results = []
+    for mode in opts.modes:
+        child_argv = [a for a in sys.argv[1:] if a != '--json'] + ['--child', mode]
+        proc = subprocess.run([sys.executable, os.path.abspath(__file__)] + child_argv, capture_output=True, text=True)
+        if proc.returncode != 0:
+            sys.stderr.write(proc.stderr)
+            sys.exit(f'{mode} run failed')
+        results.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+
+    if opts.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'mode':<12}{'msgs':>8}{'images':>8}{'secs':>9}{'msgs/s':>10}{'media MB/s':>12}{'peak RSS MB':>13}")
+    for r in results:
+        rss = f"{r['peak_rss_mb']:.1f}" if r['peak_rss_mb'] is not None else 'n/a'
+        print(f"{r['mode']:<12}{r['messages']:>8}{r['images']:>8}{r['seconds']:>9.2f}{r['messages_per_sec']:>10.1f}{r['media_mb_per_sec']:>12.2f}{rss:>13}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+"""Compare YOLO inference backends on the bundled telegram_images corpus.
+
+Each model runs in its own subprocess (so peak RSS and thread pools are per
+model). Images are decoded up front; single-image latency and batched
+throughput cover preprocess, inference and NMS. Detections of every model
+are compared with the first one listed; every backend shares the letterbox
+and NMS, so the .pt and fp32 .onnx weights should agree on every image, and
+--min-agreement turns that into a check that fails the run.
+
+    python src/export_yolo.py --model yolov8n.pt --int8
+    python benchmarks/bench_yolo_backends.py --models yolov8n.pt yolov8n.onnx yolov8n.int8.onnx
+    python benchmarks/bench_yolo_backends.py --models yolov8n.pt yolov8n.onnx --min-agreement 1.0
+"""
+import os
+import sys
+import json
+import argparse
+import subprocess
+import time
+from _common import peak_rss_mb, percentile
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_ROOT, 'src'))
+
+def run_child(opts):
+    import cv2
+    from yolo_backends import backend_for, load_backend
+    from yolo_enrichment import get_all_images
+
+    img_paths = sorted(get_all_images(opts.images))[:opts.limit or None]
+    images = []
+    for img_path in img_paths:
+        img = cv2.imread(img_path)
+        if img is not None:
+            images.append((os.path.relpath(img_path, opts.images).replace('\\', '/'), img))
+    backend = load_backend(opts.child, opts.backend, opts.imgsz, opts.conf, threads=opts.threads)
+    backend.predict([img for _, img in images[:opts.batch_size]])  # warm-up
+
+    latencies = []
+    for _, img in images[:opts.latency_images]:
+        started = time.perf_counter()
+        backend.predict([img])
+        latencies.append((time.perf_counter() - started) * 1000)
+
+    detections = {}
+    started = time.perf_counter()
+    for start in range(0, len(images), opts.batch_size):
+        batch = images[start:start + opts.batch_size]
+        for (name, _), boxes in zip(batch, backend.predict([img for _, img in batch])):
+            detections[name] = boxes
+    elapsed = time.perf_counter() - started
+    print(json.dumps({
+        'model': opts.child,
+        'backend': backend_for(opts.child, opts.backend),
+        'images': len(images),
+        'p50_ms': percentile(latencies, 0.5),
+        'p95_ms': percentile(latencies, 0.95),
+        'images_per_sec': len(images) / elapsed,
+        'detections': detections,
+        'peak_rss_mb': peak_rss_mb(),
+    }))
+
+def agreement(reference, other):
+    """Share of images with the same detected classes, and the mean |confidence difference| on those."""
+    same, deltas = 0, []
+    for name, ref_boxes in reference.items():
+        ref = sorted(ref_boxes)
+        got = sorted(other.get(name, []))
+        if [cls for cls, _ in ref] != [cls for cls, _ in got]:
+            continue
+        same += 1
+        deltas.extend(abs(a[1] - b[1]) for a, b in zip(ref, got))
+    return same / max(len(reference), 1), (sum(deltas) / len(deltas) if deltas else 0.0)
+
+def print_table(results):
+    print(f"{'model':<24}{'backend':>8}{'images':>8}{'p50 ms':>9}{'p95 ms':>9}{'img/s':>9}{'dets':>7}{'agree':>8}{'|dconf|':>9}{'peak RSS MB':>13}")
+    for r in results:
+        rss = f"{r['peak_rss_mb']:.1f}" if r['peak_rss_mb'] is not None else 'n/a'
+        print(f"{r['model'][-23:]:<24}{r['backend']:>8}{r['images']:>8}{r['p50_ms']:>9.1f}{r['p95_ms']:>9.1f}{r['images_per_sec']:>9.1f}"
+              f"{r['total_detections']:>7}{r['class_agreement']:>8.1%}{r['mean_conf_delta']:>9.4f}{rss:>13}")
+
+def main():
+    parser = argparse.ArgumentParser(description='YOLO backend latency, throughput and agreement benchmark')
+    parser.add_argument('--models', nargs='+', default=['yolov8n.pt', 'yolov8n.onnx'], help='Weights to compare; the first is the reference')
+    parser.add_argument('--backend', choices=['auto', 'torch', 'onnx'], default='auto')
+    parser.add_argument('--images', type=str, default=os.path.join(REPO_ROOT, 'data/raw/telegram_images'))
+    parser.add_argument('--limit', type=int, default=0, help='Use only the first N images (0: all)')
+    parser.add_argument('--imgsz', type=int, default=640)
+    parser.add_argument('--conf', type=float, default=0.25)
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--threads', type=int, default=None, help='Intra-op threads per runtime')
+    parser.add_argument('--latency-images', type=int, default=50, help='Images timed one at a time for latency')
+    parser.add_argument('--min-agreement', type=float, default=None, help='Exit non-zero if any model agrees with the reference on fewer than this share of images')
+    parser.add_argument('--json', action='store_true', help='Print raw JSON results')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    opts = parser.parse_args()
+
+    if opts.child:
+        return run_child(opts)
+
+    results = []
+    for model in opts.models:
+        child_argv = [a for a in sys.argv[1:] if a != '--json'] + ['--child', model]
+        proc = subprocess.run([sys.executable, os.path.abspath(__file__)] + child_argv, capture_output=True, text=True)
+        if proc.returncode != 0:
+            sys.stderr.write(proc.stderr)
+            sys.exit(f'{model} run failed')
+        results.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+
+    reference = results[0]['detections']
+    for r in results:
+        r['class_agreement'], r['mean_conf_delta'] = agreement(reference, r['detections'])
+        r['total_detections'] = sum(len(boxes) for boxes in r['detections'].values())
+
+    if opts.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_table(results)
+    if opts.min_agreement is not None:
+        below = [r['model'] for r in results if r['class_agreement'] < opts.min_agreement]
+        if below:
+            sys.exit(f"Below {opts.min_agreement:.1%} agreement with {results[0]['model']}: {', '.join(below)}")
+
+if __name__ == '__main__':
+    main()
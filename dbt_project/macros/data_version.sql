@@ -0,0 +1,18 @@
+-- Bumps a data_versions component (see src/data_version.py) so the API's
+-- response cache drops entries built from the previous data. Only after
+-- `dbt run`/`dbt build`, and only when every node succeeded.
+{% macro bump_data_version(component) %}
+    {% if execute and flags.WHICH in ('run', 'build') and results | rejectattr('status', 'in', ['success', 'pass', 'warn', 'skipped']) | list | length == 0 %}
+        create table if not exists data_versions (
+            component text primary key,
+            version bigint not null,
+            updated_at timestamp default now()
+        );
+        insert into data_versions (component, version, updated_at) values ('{{ component }}', 1, now())
+        on conflict (component) do update set
+            version = data_versions.version + 1,
+            updated_at = excluded.updated_at;
+    {% else %}
+        select 1;
+    {% endif %}
+{% endmacro %}
@@ -0,0 +1,26 @@
+-- Watermark of an incremental mart: the newest raw load time among its rows,
+-- from `column` (one per source table). A column the existing table doesn't
+-- have yet (added by on_schema_change) has no watermark, so everything
+-- qualifies once.
+{% macro last_loaded_at(column='loaded_at') %}
+    {%- set built = adapter.get_columns_in_relation(this) | map(attribute='name') | list if execute else [column] -%}
+    {%- if column in built -%}
+    (select coalesce(max({{ column }}), '-infinity') from {{ this }})
+    {%- else -%}
+    '-infinity'::timestamp
+    {%- endif -%}
+{% endmacro %}
+
+-- Which staging messages (aliased `alias`) an incremental run rebuilds from:
+-- everything loaded since the watermark in `this_loaded_at_column`, plus
+-- `lookback_days` of message_date before the newest `this_date_column`
+-- already built. The lookback catches rows whose load committed while the
+-- previous run was reading. On a full build every message qualifies.
+{% macro incremental_messages(alias, this_date_column='message_date', this_loaded_at_column='loaded_at') %}
+    {%- if is_incremental() -%}
+    ({{ alias }}.loaded_at > {{ last_loaded_at(this_loaded_at_column) }}
+     or {{ alias }}.message_date >= (select coalesce(max({{ this_date_column }}), '-infinity') from {{ this }}) - interval '{{ var("lookback_days") }} days')
+    {%- else -%}
+    true
+    {%- endif -%}
+{% endmacro %}
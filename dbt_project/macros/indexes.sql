@@ -0,0 +1,18 @@
+-- Post-hook creating the index `<model>_<suffix>` unless it exists. Named
+-- indexes keep incremental runs from piling up a copy on every run. On a full
+-- refresh the previous table still exists (dbt drops it after the hooks) and
+-- owns an index of that name, so that one is dropped first.
+{% macro create_index(suffix, definition, unique=false) %}
+    {%- set name = this.identifier ~ '_' ~ suffix -%}
+    do $$
+    begin
+        if exists (
+            select 1 from pg_index
+            where indexrelid = to_regclass('"{{ this.schema }}"."{{ name }}"')
+              and indrelid <> '"{{ this.schema }}"."{{ this.identifier }}"'::regclass
+        ) then
+            drop index "{{ this.schema }}"."{{ name }}";
+        end if;
+    end $$;
+    create {% if unique %}unique {% endif %}index if not exists "{{ name }}" on {{ this }} {{ definition }}
+{% endmacro %}
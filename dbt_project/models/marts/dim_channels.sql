@@ -1,8 +1,45 @@
 -- models/marts/dim_channels.sql
+-- Incremental: only channels with new messages are rebuilt, and their first
+-- and last dates are merged with the existing row. total_messages is recounted
+-- rather than added to: the lookback re-reads messages that were already
+-- counted, and fct_messages has already merged this run's rows by the time
+-- this model runs, so new and re-loaded messages can't be told apart here.
+-- The recount only runs for channels with new rows and is an index scan on
+-- fct_messages_key (channel_name, message_id), so it grows with the channel's
+-- message count, not with the table.
+{{ config(
+    materialized='incremental',
+    unique_key='channel_name',
+    incremental_strategy='delete+insert',
+    post_hook=["{{ create_index('key', '(channel_name)', unique=true) }}"]
+) }}
+with new_messages as (
+    select
+        channel as channel_name,
+        min(message_date) as first_message_date,
+        max(message_date) as last_message_date,
+        max(loaded_at) as loaded_at
+    from {{ ref('stg_telegram_messages') }} m
+    where {{ incremental_messages('m', 'last_message_date') }}
+    group by channel
+)
+
 select
-    channel as channel_name,
-    min(message_date) as first_message_date,
-    max(message_date) as last_message_date,
-    count(*) as total_messages
-from {{ ref('stg_telegram_messages') }}
-group by channel
+    n.channel_name,
+    {% if is_incremental() %}
+    least(n.first_message_date, c.first_message_date) as first_message_date,
+    greatest(n.last_message_date, c.last_message_date) as last_message_date,
+    {% else %}
+    n.first_message_date,
+    n.last_message_date,
+    {% endif %}
+    (select count(*) from {{ ref('fct_messages') }} f where f.channel_name = n.channel_name) as total_messages,
+    {% if is_incremental() %}
+    greatest(n.loaded_at, c.loaded_at) as loaded_at
+    {% else %}
+    n.loaded_at
+    {% endif %}
+from new_messages n
+{% if is_incremental() %}
+left join {{ this }} c on c.channel_name = n.channel_name
+{% endif %}
@@ -1,13 +1,31 @@
 -- models/marts/dim_dates.sql
+-- Incremental: adds or refreshes the days of new messages. The lookback can cut
+-- a day in two, so loaded_at keeps the existing row's value if that is newer.
+{{ config(
+    materialized='incremental',
+    unique_key='date_id',
+    incremental_strategy='delete+insert',
+    post_hook=["{{ create_index('key', '(date_id)', unique=true) }}"]
+) }}
 with dates as (
-    select distinct date_trunc('day', message_date) as date
-    from {{ ref('stg_telegram_messages') }}
+    select date_trunc('day', message_date) as date, max(loaded_at) as loaded_at
+    from {{ ref('stg_telegram_messages') }} m
+    where {{ incremental_messages('m', 'date_id') }}
+    group by 1
 )
 select
-    date::date as date_id,
-    extract(year from date) as year,
-    extract(month from date) as month,
-    extract(day from date) as day,
-    extract(dow from date) as day_of_week,
-    extract(week from date) as week
-from dates
+    d.date::date as date_id,
+    extract(year from d.date) as year,
+    extract(month from d.date) as month,
+    extract(day from d.date) as day,
+    extract(dow from d.date) as day_of_week,
+    extract(week from d.date) as week,
+    {% if is_incremental() %}
+    greatest(d.loaded_at, t.loaded_at) as loaded_at
+    {% else %}
+    d.loaded_at
+    {% endif %}
+from dates d
+{% if is_incremental() %}
+left join {{ this }} t on t.date_id = d.date::date
+{% endif %}
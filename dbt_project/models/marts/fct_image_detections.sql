@@ -1,12 +1,60 @@
 -- models/marts/fct_image_detections.sql
+-- Incremental on the raw natural key (see macros/incremental.sql), with one
+-- watermark per source table: loaded_at for raw_image_detections and
+-- message_loaded_at for the messages. A single max over both would let a
+-- message loaded late move the detections' watermark past detections that
+-- were not loaded yet. Besides the key and watermark indexes, indexes for the /api/detections endpoints: a
+-- covering index for batch lookups by message id, and indexes for
+-- class/channel/date filters.
+{{ config(
+    materialized='incremental',
+    unique_key=['message_id', 'image_path', 'detected_object_class'],
+    incremental_strategy='delete+insert',
+    on_schema_change='append_new_columns',
+    post_hook=[
+        "{{ create_index('key', '(message_id, image_path, detected_object_class)', unique=true) }}",
+        "{{ create_index('message_idx', '(message_id, detected_object_class) include (channel_name, image_path, confidence_score, message_date)') }}",
+        "{{ create_index('class_idx', '(detected_object_class, channel_name, message_date) include (confidence_score, message_id, image_path)') }}",
+        "{{ create_index('channel_date_idx', '(channel_name, message_date)') }}",
+        "{{ create_index('loaded_at_idx', '(loaded_at)') }}",
+        "{{ create_index('message_loaded_at_idx', '(message_loaded_at)') }}",
+        "analyze {{ this }}"
+    ]
+) }}
+with source as (
+    select d.*
+    from {{ source('public', 'raw_image_detections') }} d
+    {% if is_incremental() %}
+    where d.loaded_at > {{ last_loaded_at() }}
+    union
+    -- A detection can be loaded before its message; rebuild it once the
+    -- message arrives so it picks up message_date
+    select d.*
+    from {{ source('public', 'raw_image_detections') }} d
+    join {{ ref('stg_telegram_messages') }} m on m.message_id = d.message_id
+    where {{ incremental_messages('m', 'message_date', 'message_loaded_at') }}
+    {% endif %}
+),
+
+detections as (
+    select
+        d.*,
+        -- Images are saved as .../<date>/<channel>/<message_id>.<ext>, and message
+        -- ids are only unique within a channel
+        substring(d.image_path from '([^/]+)/[^/]+$') as channel_name
+    from source d
+)
 
 select
     d.message_id,
-    m.channel as channel_name,
+    d.channel_name,
     m.message_date,
     d.image_path,
     d.detected_object_class,
-    d.confidence_score
-from {{ source('public', 'raw_image_detections') }} d
+    d.confidence_score,
+    d.loaded_at,
+    m.loaded_at as message_loaded_at
+from detections d
 left join {{ ref('stg_telegram_messages') }} m
     on d.message_id = m.message_id
+   and d.channel_name = m.channel
@@ -1,8 +1,28 @@
 -- models/marts/fct_messages.sql
+-- Incremental: a run only rebuilds the messages picked by incremental_messages()
+-- (see macros/incremental.sql), replacing them by (channel_name, message_id).
+-- The unique index serves that replace and loaded_at_idx the run's watermark;
+-- the others serve /api/search/messages; recent_order_idx has exactly the
+-- sort=recent order (it replaces recent_idx, which sorted NULL dates first).
+{{ config(
+    materialized='incremental',
+    unique_key=['channel_name', 'message_id'],
+    incremental_strategy='delete+insert',
+    post_hook=[
+        "{{ create_index('key', '(channel_name, message_id)', unique=true) }}",
+        "{{ create_index('search_vector_idx', 'using gin (search_vector)') }}",
+        "{{ create_index('text_trgm_idx', 'using gin (text gin_trgm_ops)') }}",
+        "drop index if exists \"{{ this.schema }}\".\"{{ this.identifier }}_recent_idx\"",
+        "{{ create_index('recent_order_idx', '(message_date desc nulls last, message_id desc, channel_name desc)') }}",
+        "{{ create_index('channel_date_idx', '(channel_name, date_id)') }}",
+        "{{ create_index('loaded_at_idx', '(loaded_at)') }}"
+    ]
+) }}
 select
     m.message_id,
     m.channel as channel_name,
     date_trunc('day', m.message_date)::date as date_id,
+    m.message_date,
     m.sender_id,
     m.text,
     m.has_image,
@@ -10,5 +30,9 @@ select
     m.has_video,
     m.has_audio,
     m.media_type,
-    m.local_media_path
+    m.local_media_path,
+    -- 'simple' (no stemming) because posts mix English and Amharic; must match api/crud.py
+    to_tsvector('simple', coalesce(m.text, '')) as search_vector,
+    m.loaded_at
 from {{ ref('stg_telegram_messages') }} m
+where {{ incremental_messages('m') }}
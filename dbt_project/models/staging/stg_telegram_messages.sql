@@ -11,7 +11,8 @@ with source as (
         has_audio,
         media_type,
         local_media_path,
-        raw_json
+        raw_json,
+        loaded_at
     from {{ source('public', 'raw_telegram_messages') }}
 )
 
@@ -26,5 +27,6 @@ select
     has_video,
     has_audio,
     media_type,
-    local_media_path
+    local_media_path,
+    loaded_at
 from source
@@ -1,9 +1,8 @@
 from dagster import job
-from pipeline.ops import scrape_telegram_data, load_raw_to_postgres, run_dbt_transformations, run_yolo_enrichment
+from pipeline.ops import scrape_telegram_data, load_raw_to_postgres, update_product_mentions, run_dbt_transformations, run_yolo_enrichment
 
 @job
 def full_pipeline():
-    scrape_telegram_data()
-    load_raw_to_postgres()
-    run_dbt_transformations()
-    run_yolo_enrichment() 
\ No newline at end of file
+    loaded = load_raw_to_postgres(start=scrape_telegram_data())
+    update_product_mentions(start=loaded)
+    run_yolo_enrichment(start=run_dbt_transformations(start=loaded)) 
\ No newline at end of file
@@ -1,4 +1,4 @@
-from dagster import op
+from dagster import In, Nothing, op
 import subprocess
 
 @op
@@ -6,19 +6,24 @@ def scrape_telegram_data():
     print("Running Telegram scraping...")
     subprocess.run(["python", "scrape_telegram.py"], check=True)
 
-@op
+# `start` only orders the op after its upstream step
+@op(ins={'start': In(Nothing)})
 def load_raw_to_postgres():
     print("Loading raw data into Postgres...")
     subprocess.run(["python", "load_to_postgres.py"], check=True)
 
-@op
+@op(ins={'start': In(Nothing)})
+def update_product_mentions():
+    print("Updating product mention counts...")
+    subprocess.run(["python", "product_mentions.py"], check=True)
+
+@op(ins={'start': In(Nothing)})
 def run_dbt_transformations():
     print("Running dbt transformations...")
     subprocess.run(["dbt", "run"], check=True, cwd="telegram_dbt")
     subprocess.run(["dbt", "test"], check=True, cwd="telegram_dbt")
 
-@op
+@op(ins={'start': In(Nothing)})
 def run_yolo_enrichment():
     print("Running YOLO enrichment...")
-    subprocess.run(["python", "yolo_enrichment.py"], check=True)
-    subprocess.run(["python", "load_yolo_detections.py"], check=True) 
\ No newline at end of file
+    subprocess.run(["python", "yolo_enrichment.py", "--sink", "postgres"], check=True) 
\ No newline at end of file
@@ -0,0 +1,112 @@
+import os
+import json
+import time
+from datetime import datetime, timezone
+
+CHECKPOINT_DIR = 'data/raw/checkpoints'
+DEFAULT_FLUSH_EVERY = 200        # messages
+DEFAULT_FLUSH_INTERVAL = 30.0    # seconds
+
+def checkpoint_path(channel_name, checkpoint_dir=CHECKPOINT_DIR):
+    return os.path.join(checkpoint_dir, f'{channel_name}.json')
+
+def read_checkpoint(channel_name, checkpoint_dir=CHECKPOINT_DIR):
+    path = checkpoint_path(channel_name, checkpoint_dir)
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            return json.load(f)
+    return {}
+
+def load_checkpoint(channel_name, checkpoint_dir=CHECKPOINT_DIR):
+    return read_checkpoint(channel_name, checkpoint_dir).get('last_message_id')
+
+def write_json_atomic(path, data, **dump_kwargs):
+    """Write `data` to a temp file, fsync it, rename it over `path` and fsync the directory.
+
+    Readers see either the old file or the new one, never a partial write,
+    and the rename itself survives a crash once this returns.
+    """
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, **dump_kwargs)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    fsync_dir(directory)
+
+def fsync_dir(directory):
+    """Persist a directory entry change (a rename or new file); a no-op where directories can't be opened (Windows)."""
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class CheckpointJournal:
+    """Batched checkpoint for one channel.
+
+    `record` notes that a message has been seen; nothing is written until
+    `commit`, which the caller must only invoke once the output for every
+    recorded message is durable. `due` says when a commit is worth doing,
+    either every `flush_every` messages or every `flush_interval` seconds.
+    """
+
+    def __init__(self, channel_name, flush_every=DEFAULT_FLUSH_EVERY, flush_interval=DEFAULT_FLUSH_INTERVAL, checkpoint_dir=CHECKPOINT_DIR):
+        self.channel_name = channel_name
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.path = checkpoint_path(channel_name, checkpoint_dir)
+        self.state = read_checkpoint(channel_name, checkpoint_dir)
+        self.pending_id = None
+        self.pending_date = None
+        self.pending_count = 0
+        self.last_commit = time.monotonic()
+
+    @property
+    def last_message_id(self):
+        return self.state.get('last_message_id')
+
+    def record(self, message_id, message_date=None):
+        if self.pending_id is None or message_id > self.pending_id:
+            self.pending_id = message_id
+            self.pending_date = str(message_date) if message_date is not None else None
+        self.pending_count += 1
+
+    def due(self):
+        if not self.pending_count:
+            return False
+        return self.pending_count >= self.flush_every or time.monotonic() - self.last_commit >= self.flush_interval
+
+    def commit(self):
+        if self.pending_id is None:
+            return
+        self.state.update({
+            'last_message_id': self.pending_id,
+            'last_message_date': self.pending_date,
+            'messages_committed': self.state.get('messages_committed', 0) + self.pending_count,
+            'updated_at': datetime.now(timezone.utc).isoformat(),
+        })
+        write_json_atomic(self.path, self.state)
+        self.pending_id = None
+        self.pending_date = None
+        self.pending_count = 0
+        self.last_commit = time.monotonic()
+
+    def stats(self):
+        return dict(self.state, channel=self.channel_name, pending=self.pending_count)
+
+def resume_stats(checkpoint_dir=CHECKPOINT_DIR):
+    """Checkpoint state for every channel, for reporting how far each one is."""
+    if not os.path.isdir(checkpoint_dir):
+        return []
+    stats = []
+    for file in sorted(os.listdir(checkpoint_dir)):
+        if file.endswith('.json'):
+            channel_name = file[:-len('.json')]
+            stats.append(dict(read_checkpoint(channel_name, checkpoint_dir), channel=channel_name))
+    return stats
@@ -0,0 +1,33 @@
+"""Per-component version counters that the API keys its response cache on.
+
+Every job that changes data the API serves bumps its component once it has
+committed successfully:
+
+    raw_telegram_messages   load_to_postgres.py
+    raw_image_detections    load_yolo_detections.py, yolo_enrichment.py --sink postgres
+    product_mentions        product_mentions.py
+    marts                   dbt run (on-run-end, see dbt_project/macros/data_version.sql)
+
+Cached responses are only reused while the versions of the components they
+read from are unchanged.
+"""
+
+CREATE_TABLE_SQL = '''
+CREATE TABLE IF NOT EXISTS data_versions (
+    component TEXT PRIMARY KEY,
+    version BIGINT NOT NULL,
+    updated_at TIMESTAMP DEFAULT now()
+);
+'''
+
+BUMP_SQL = '''
+INSERT INTO data_versions (component, version, updated_at) VALUES (%s, 1, now())
+ON CONFLICT (component) DO UPDATE SET
+    version = data_versions.version + 1,
+    updated_at = EXCLUDED.updated_at;
+'''
+
+def bump_data_version(cur, component):
+    """Bump `component` in the caller's transaction, so the bump commits with the data."""
+    cur.execute(CREATE_TABLE_SQL)
+    cur.execute(BUMP_SQL, (component,))
@@ -0,0 +1,175 @@
+import os
+import json
+import hashlib
+import sqlite3
+from datetime import datetime, timezone
+
+DETECTION_CACHE_PATH = 'data/raw/detection_cache.sqlite'
+HASH_CHUNK_SIZE = 1024 * 1024
+
+CREATE_TABLES_SQL = '''
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime REAL,
+    content_hash TEXT
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS detections (
+    content_hash TEXT,
+    model_key TEXT,
+    conf REAL,
+    boxes TEXT,
+    created_at TEXT,
+    representative TEXT,
+    PRIMARY KEY (content_hash, model_key, conf)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS image_hashes (
+    content_hash TEXT,
+    algorithm TEXT,
+    hash TEXT,
+    PRIMARY KEY (content_hash, algorithm)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    started_at TEXT,
+    finished_at TEXT,
+    model_key TEXT,
+    conf REAL,
+    images INTEGER,
+    hits INTEGER,
+    misses INTEGER,
+    errors INTEGER,
+    near_duplicates INTEGER
+);
+'''
+
+# Columns added after the first release, for caches created before them
+ADDED_COLUMNS = [
+    ('detections', 'representative', 'TEXT'),
+    ('runs', 'near_duplicates', 'INTEGER'),
+]
+
+def create_tables(conn):
+    conn.executescript(CREATE_TABLES_SQL)
+    for table, column, decl in ADDED_COLUMNS:
+        if column not in {row[1] for row in conn.execute(f'PRAGMA table_info({table})')}:
+            conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {decl}')
+    conn.commit()
+
+def file_hash(path, chunk_size=HASH_CHUNK_SIZE):
+    hasher = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+def model_key(model_name):
+    """`<weights name>:<md5 of the weights>`, or just the name if the file isn't local.
+
+    Retrained weights saved under the same file name get a new key, so their
+    detections are never served from an older model's entries.
+    """
+    if os.path.isfile(model_name):
+        return f"{os.path.basename(model_name)}:{file_hash(model_name)}"
+    return model_name
+
+class DetectionCache:
+    """Persistent YOLO results keyed by (image content hash, model key, conf).
+
+    Content hashes are remembered per path with the file's size and mtime, so
+    an unchanged image is not re-read on later runs. Cached boxes are stored
+    as `[[class, confidence], ...]` and hold no path, so the same image saved
+    under two paths is only inferred once. A near-duplicate that reused
+    another image's detections names that image in `representative`.
+    """
+
+    def __init__(self, model_key, conf, path=DETECTION_CACHE_PATH):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.model_key = model_key
+        self.conf = conf
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        create_tables(self.conn)
+        self.started_at = datetime.now(timezone.utc).isoformat()
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self.near_duplicates = 0
+
+    def content_hash(self, path):
+        stat = os.stat(path)
+        row = self.conn.execute('SELECT size, mtime, content_hash FROM files WHERE path = ?', (path,)).fetchone()
+        if row and row[0] == stat.st_size and row[1] == stat.st_mtime:
+            return row[2]
+        content_hash = file_hash(path)
+        self.conn.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)', (path, stat.st_size, stat.st_mtime, content_hash))
+        return content_hash
+
+    def get(self, content_hash):
+        """Cached boxes for this image under the current model and conf, or None."""
+        row = self.conn.execute(
+            'SELECT boxes FROM detections WHERE content_hash = ? AND model_key = ? AND conf = ?',
+            (content_hash, self.model_key, self.conf)
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(row[0])
+
+    def peek(self, content_hash):
+        """Like `get`, without counting a hit or miss."""
+        row = self.conn.execute(
+            'SELECT boxes FROM detections WHERE content_hash = ? AND model_key = ? AND conf = ?',
+            (content_hash, self.model_key, self.conf)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, content_hash, boxes, representative=None):
+        self.conn.execute(
+            'INSERT OR REPLACE INTO detections (content_hash, model_key, conf, boxes, created_at, representative) VALUES (?, ?, ?, ?, ?, ?)',
+            (content_hash, self.model_key, self.conf, json.dumps(boxes), datetime.now(timezone.utc).isoformat(), representative)
+        )
+
+    def put_image_hash(self, content_hash, algorithm, hash_value):
+        self.conn.execute('INSERT OR REPLACE INTO image_hashes VALUES (?, ?, ?)', (content_hash, algorithm, format(hash_value, '016x')))
+
+    def iter_representatives(self, algorithm, since=''):
+        """(perceptual hash, content hash) of every image this model actually ran on, optionally only newer ones."""
+        cur = self.conn.execute(
+            '''SELECT h.hash, d.content_hash FROM detections d
+               JOIN image_hashes h ON h.content_hash = d.content_hash AND h.algorithm = ?
+               WHERE d.model_key = ? AND d.conf = ? AND d.representative IS NULL AND d.created_at > ?''',
+            (algorithm, self.model_key, self.conf, since)
+        )
+        for hash_hex, content_hash in cur:
+            yield int(hash_hex, 16), content_hash
+
+    def commit(self):
+        self.conn.commit()
+
+    def record_run(self):
+        self.conn.execute(
+            'INSERT INTO runs (started_at, finished_at, model_key, conf, images, hits, misses, errors, near_duplicates) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (self.started_at, datetime.now(timezone.utc).isoformat(), self.model_key, self.conf,
+             self.hits + self.misses, self.hits, self.misses, self.errors, self.near_duplicates)
+        )
+        self.conn.commit()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+def run_stats(path=DETECTION_CACHE_PATH, limit=20):
+    """Most recent runs as dicts, newest first."""
+    if not os.path.exists(path):
+        return []
+    conn = sqlite3.connect(path)
+    try:
+        create_tables(conn)
+        cur = conn.execute('SELECT * FROM runs ORDER BY run_id DESC LIMIT ?', (limit,))
+        columns = [c[0] for c in cur.description]
+        return [dict(zip(columns, row)) for row in cur.fetchall()]
+    finally:
+        conn.close()
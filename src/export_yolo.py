@@ -0,0 +1,79 @@
+import os
+import argparse
+import cv2
+from yolo_backends import get_model, preprocess
+from yolo_enrichment import MODEL_NAME, DEFAULT_IMGSZ, get_all_images
+
+DEFAULT_CALIBRATION_IMAGES = 200
+
+def sample_images(count):
+    """Spread `count` calibration images evenly over the corpus."""
+    img_paths = sorted(get_all_images())
+    step = max(1, len(img_paths) // max(count, 1))
+    return img_paths[::step][:count]
+
+def export_onnx(model_name, imgsz, opset=None):
+    """Export with a dynamic batch axis so one file serves every --batch-size."""
+    kwargs = {'format': 'onnx', 'imgsz': imgsz, 'dynamic': True, 'simplify': True}
+    if opset:
+        kwargs['opset'] = opset
+    return get_model(model_name).export(**kwargs)
+
+def quantize_int8(fp32_path, int8_path, imgsz, calibration_images):
+    """Static int8 (QDQ) quantization calibrated on our own scraped images."""
+    import onnx
+    import onnxruntime as ort
+    from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, quantize_static
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+
+    input_name = ort.InferenceSession(fp32_path, providers=['CPUExecutionProvider']).get_inputs()[0].name
+
+    class ImageReader(CalibrationDataReader):
+        def __init__(self, img_paths):
+            self.img_paths = iter(img_paths)
+
+        def get_next(self):
+            for img_path in self.img_paths:
+                img = cv2.imread(img_path)
+                if img is not None:
+                    return {input_name: preprocess([img], imgsz)}
+            return None
+
+    # Shape inference and graph optimization first, as onnxruntime recommends for static quantization
+    prep_path = os.path.splitext(fp32_path)[0] + '.prep.onnx'
+    quant_pre_process(fp32_path, prep_path)
+    img_paths = sample_images(calibration_images)
+    print(f"Calibrating on {len(img_paths)} images...")
+    quantize_static(
+        prep_path, int8_path, ImageReader(img_paths),
+        quant_format=QuantFormat.QDQ,
+        per_channel=True,
+        activation_type=QuantType.QUInt8,
+        weight_type=QuantType.QInt8,
+    )
+    # Keep the class names and image size the ONNX backend reads from the metadata
+    fp32, int8 = onnx.load(fp32_path), onnx.load(int8_path)
+    del int8.metadata_props[:]
+    int8.metadata_props.extend(fp32.metadata_props)
+    onnx.save(int8, int8_path)
+    os.remove(prep_path)
+    return int8_path
+
+def main():
+    parser = argparse.ArgumentParser(description='Export YOLO weights to ONNX for the onnx backend, optionally int8-quantized')
+    parser.add_argument('--model', type=str, default=MODEL_NAME, help='PyTorch weights to export')
+    parser.add_argument('--imgsz', type=int, default=DEFAULT_IMGSZ, help='Input size baked into the export')
+    parser.add_argument('--opset', type=int, default=None, help='ONNX opset (default: ultralytics picks)')
+    parser.add_argument('--onnx', type=str, default=None, help='Quantize this existing ONNX file instead of exporting')
+    parser.add_argument('--int8', action='store_true', help='Also write an int8-quantized <name>.int8.onnx')
+    parser.add_argument('--calibration-images', type=int, default=DEFAULT_CALIBRATION_IMAGES, help='Images from data/raw/telegram_images used to calibrate int8')
+    args = parser.parse_args()
+
+    fp32_path = args.onnx or export_onnx(args.model, args.imgsz, args.opset)
+    print(f"ONNX model: {fp32_path} ({os.path.getsize(fp32_path) / 1e6:.1f} MB)")
+    if args.int8:
+        int8_path = quantize_int8(fp32_path, os.path.splitext(fp32_path)[0] + '.int8.onnx', args.imgsz, args.calibration_images)
+        print(f"int8 model: {int8_path} ({os.path.getsize(int8_path) / 1e6:.1f} MB)")
+
+if __name__ == '__main__':
+    main()
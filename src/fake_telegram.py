@@ -0,0 +1,186 @@
+import os
+import asyncio
+import hashlib
+import random
+from datetime import datetime, timedelta, timezone
+from telethon.errors import FloodWaitError
+from message_segments import RAW_DATA_DIR, iter_message_files, iter_messages
+
+IMAGE_DATA_DIR = 'data/raw/telegram_images'
+FAKE_MIME_TYPES = {'.jpg': 'image/jpeg', '.jpeg': 'image/jpeg', '.png': 'image/png', '.mp4': 'video/mp4', '.mp3': 'audio/mpeg'}
+
+class FakePhoto:
+    def __init__(self, photo_id):
+        self.id = photo_id
+
+class FakeDocument:
+    def __init__(self, document_id, mime_type):
+        self.id = document_id
+        self.mime_type = mime_type
+
+class FakeFile:
+    def __init__(self, mime_type, ext, size):
+        self.mime_type = mime_type
+        self.ext = ext
+        self.size = size
+
+class FakeMessage:
+    """The attributes of a Telethon Message that scrape_channel reads.
+
+    Media is either a file on disk (`media_path`) or `media_size` bytes of
+    generated content.
+    """
+
+    def __init__(self, message_id, date, text, sender_id=None, media_kind=None, media_id=None, mime_type=None, media_path=None, media_size=0):
+        self.id = message_id
+        self.date = date
+        self.text = text
+        self.sender_id = sender_id
+        self.media_path = media_path
+        self.media_size = os.path.getsize(media_path) if media_path else media_size
+        self.photo = FakePhoto(media_id) if media_kind == 'photo' else None
+        self.document = FakeDocument(media_id, mime_type) if media_kind == 'document' else None
+        self.file = None
+        if media_kind:
+            ext = os.path.splitext(media_path)[1] if media_path else '.jpg'
+            self.file = FakeFile(mime_type or FAKE_MIME_TYPES.get(ext, 'application/octet-stream'), ext, self.media_size)
+
+def _media_id(data):
+    return int(hashlib.md5(data).hexdigest()[:15], 16)
+
+def load_corpus(messages_root=RAW_DATA_DIR, image_root=IMAGE_DATA_DIR):
+    """Replay the scraped corpus: {channel: [FakeMessage, ...]} sorted by id.
+
+    Photos keep pointing at their files under `image_root`. Their fake ids are
+    derived from the file content, so a reposted image gets the same photo id
+    the way a forwarded Telegram photo does.
+    """
+    corpus = {}
+    for msg_date, channel_name, path in iter_message_files(messages_root):
+        for msg in iter_messages(path):
+            media_path = None
+            if msg.get('local_media_path'):
+                rel_path = msg['local_media_path'].replace('\\', '/')
+                candidate = os.path.join(image_root, os.path.relpath(rel_path, IMAGE_DATA_DIR))
+                if os.path.exists(candidate):
+                    media_path = candidate
+            media_kind = media_id = None
+            if media_path:
+                with open(media_path, 'rb') as f:
+                    media_id = _media_id(f.read())
+                media_kind = 'photo' if msg.get('media_type') == 'photo' else 'document'
+            corpus.setdefault(channel_name, []).append(FakeMessage(
+                msg['id'],
+                datetime.fromisoformat(msg['date']),
+                msg.get('text'),
+                msg.get('sender_id'),
+                media_kind,
+                media_id,
+                media_path=media_path,
+            ))
+    for messages in corpus.values():
+        messages.sort(key=lambda m: m.id)
+    return corpus
+
+def synthetic_corpus(channels=3, messages_per_channel=1000, media_ratio=0.5, media_bytes=150_000, duplicate_ratio=0.1, seed=0, start_date=None):
+    """Generate a corpus with the shape of the real channels."""
+    rng = random.Random(seed)
+    start_date = start_date or datetime(2025, 1, 1, tzinfo=timezone.utc)
+    corpus = {}
+    media_ids = []
+    for c in range(channels):
+        messages = []
+        for i in range(1, messages_per_channel + 1):
+            media_kind = media_id = None
+            if rng.random() < media_ratio:
+                media_kind = 'photo'
+                if media_ids and rng.random() < duplicate_ratio:
+                    media_id = rng.choice(media_ids)
+                else:
+                    media_id = rng.getrandbits(60)
+                    media_ids.append(media_id)
+            text = ' '.join(rng.choice(['paracetamol', 'cream', 'pill', 'price', 'birr', 'ዋጋ', 'ሳሙና', 'delivery']) for _ in range(rng.randint(3, 40)))
+            messages.append(FakeMessage(
+                i,
+                start_date + timedelta(minutes=10 * i),
+                text,
+                media_kind=media_kind,
+                media_id=media_id,
+                media_size=media_bytes if media_kind else 0,
+            ))
+        corpus[f'synthetic_channel_{c}'] = messages
+    return corpus
+
+class FakeTelegramClient:
+    """Local stand-in for the subset of TelegramClient the scraper uses.
+
+    Serves `corpus` from memory with `latency` seconds per API call and an
+    optional `bandwidth` (bytes/second) for downloads. Every `flood_every`th
+    request raises FloodWaitError(`flood_seconds`).
+    """
+
+    def __init__(self, corpus, latency=0.0, bandwidth=None, flood_every=0, flood_seconds=1):
+        self.corpus = corpus
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.flood_every = flood_every
+        self.flood_seconds = flood_seconds
+        self.requests = 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def _request(self, extra_seconds=0.0):
+        self.requests += 1
+        if self.flood_every and self.requests % self.flood_every == 0:
+            raise FloodWaitError(None, capture=self.flood_seconds)
+        if self.latency or extra_seconds:
+            await asyncio.sleep(self.latency + extra_seconds)
+
+    def _channel_messages(self, entity):
+        return self.corpus.get(str(entity).split('/')[-1], [])
+
+    def _select(self, entity, reverse, min_id, offset_id, offset_date):
+        messages = [m for m in self._channel_messages(entity) if m.id > (min_id or 0)]
+        if reverse:
+            if offset_id:
+                messages = [m for m in messages if m.id > offset_id]
+            if offset_date:
+                messages = [m for m in messages if m.date >= offset_date]
+            return messages
+        messages = messages[::-1]
+        if offset_id:
+            messages = [m for m in messages if m.id < offset_id]
+        if offset_date:
+            messages = [m for m in messages if m.date < offset_date]
+        return messages
+
+    async def get_messages(self, entity, limit=100, reverse=False, min_id=0, offset_id=0, offset_date=None):
+        await self._request()
+        return self._select(entity, reverse, min_id, offset_id, offset_date)[:limit]
+
+    async def iter_messages(self, entity, limit=None, reverse=False, min_id=0, offset_id=0, offset_date=None):
+        messages = self._select(entity, reverse, min_id, offset_id, offset_date)
+        if limit is not None:
+            messages = messages[:limit]
+        for start in range(0, len(messages), 100):
+            await self._request()
+            for message in messages[start:start + 100]:
+                yield message
+
+    async def download_media(self, message, file):
+        transfer = message.media_size / self.bandwidth if self.bandwidth else 0.0
+        await self._request(transfer)
+        os.makedirs(os.path.dirname(file) or '.', exist_ok=True)
+        if message.media_path:
+            with open(message.media_path, 'rb') as src, open(file, 'wb') as dst:
+                dst.write(src.read())
+        else:
+            # Deterministic per media id, so content-hash dedupe behaves like real reposts
+            rng = random.Random(message.photo.id if message.photo else message.document.id)
+            with open(file, 'wb') as dst:
+                dst.write(rng.randbytes(message.media_size))
+        return file
@@ -0,0 +1,228 @@
+"""Counters, gauges and histograms in the Prometheus text format, with no dependencies.
+
+Batch jobs record into the module's registry and call `export(job)` when
+they finish, which writes `<METRICS_TEXTFILE_DIR>/<job>.prom` for
+node_exporter's textfile collector and/or pushes to a Pushgateway at
+METRICS_PUSHGATEWAY_URL. The API serves the same registry at /metrics.
+
+    from instrumentation import counter, histogram
+    ROWS = counter('loader_rows_total', 'Rows loaded', ['table'])
+    ROWS.labels('raw_telegram_messages').inc(500)
+    with histogram('loader_batch_seconds', 'COPY batch latency').time():
+        ...
+
+With METRICS_ENABLED=0 every metric is a shared no-op object, so recording
+costs one method call that does nothing and nothing is exported.
+"""
+import os
+import time
+import socket
+import threading
+import urllib.request
+from contextlib import contextmanager
+
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', '1') != '0'
+METRICS_TEXTFILE_DIR = os.getenv('METRICS_TEXTFILE_DIR')
+METRICS_PUSHGATEWAY_URL = os.getenv('METRICS_PUSHGATEWAY_URL')
+# Seconds; from sub-millisecond API queries up to a long COPY batch
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _label_text(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in list(zip(names, values)) + list(extra)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class _CounterChild:
+    def __init__(self, lock):
+        self.lock = lock
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+class _GaugeChild(_CounterChild):
+    def set(self, value):
+        self.value = value
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+class _HistogramChild:
+    def __init__(self, lock, buckets):
+        self.lock = lock
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value, count=1):
+        """Record `count` observations of `value` (e.g. a batch's per-image latency, once per image)."""
+        with self.lock:
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += count
+                    break
+            self.sum += value * count
+            self.count += count
+
+    @contextmanager
+    def time(self):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+class Metric:
+    """One metric family; `labels(*values)` returns the child for one label combination."""
+
+    def __init__(self, kind, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.kind = kind
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.children = {}
+        self.lock = threading.Lock()
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f'{self.name} takes labels {self.labelnames}, got {values}')
+            with self.lock:
+                child = self.children.get(values)
+                if child is None:
+                    if self.kind == 'histogram':
+                        child = _HistogramChild(self.lock, self.buckets)
+                    elif self.kind == 'gauge':
+                        child = _GaugeChild(self.lock)
+                    else:
+                        child = _CounterChild(self.lock)
+                    self.children[values] = child
+        return child
+
+    # Unlabelled metrics can be used directly
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def dec(self, amount=1):
+        self.labels().dec(amount)
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def observe(self, value, count=1):
+        self.labels().observe(value, count)
+
+    def time(self):
+        return self.labels().time()
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for values, child in sorted(self.children.items()):
+            if self.kind != 'histogram':
+                lines.append(f'{self.name}{_label_text(self.labelnames, values)} {_number(child.value)}')
+                continue
+            cumulative = 0
+            for bound, count in zip(child.buckets, child.counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{_label_text(self.labelnames, values, [("le", _number(float(bound)))])} {cumulative}')
+            lines.append(f'{self.name}_bucket{_label_text(self.labelnames, values, [("le", "+Inf")])} {child.count}')
+            lines.append(f'{self.name}_sum{_label_text(self.labelnames, values)} {_number(child.sum)}')
+            lines.append(f'{self.name}_count{_label_text(self.labelnames, values)} {child.count}')
+        return '\n'.join(lines)
+
+class _NoopMetric:
+    """Stands in for every metric when metrics are disabled."""
+
+    def labels(self, *values):
+        return self
+
+    def inc(self, amount=1):
+        pass
+
+    def dec(self, amount=1):
+        pass
+
+    def set(self, value):
+        pass
+
+    def observe(self, value, count=1):
+        pass
+
+    @contextmanager
+    def time(self):
+        yield
+
+NOOP = _NoopMetric()
+
+class Registry:
+    def __init__(self, enabled=METRICS_ENABLED):
+        self.enabled = enabled
+        self.metrics = {}
+
+    def _get(self, kind, name, documentation, labelnames, **kwargs):
+        if not self.enabled:
+            return NOOP
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = Metric(kind, name, documentation, labelnames, **kwargs)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._get('counter', name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._get('gauge', name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._get('histogram', name, documentation, labelnames, buckets=buckets)
+
+    def render(self):
+        return ''.join(metric.render() + '\n' for metric in self.metrics.values() if metric.children)
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+
+def write_textfile(path, registry=REGISTRY):
+    """Write the registry for node_exporter's textfile collector, atomically."""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(registry.render())
+    os.replace(tmp_path, path)
+
+def push(url, job, registry=REGISTRY, timeout=10):
+    """Replace this job's metrics on a Pushgateway (one group per job and host)."""
+    request = urllib.request.Request(
+        f"{url.rstrip('/')}/metrics/job/{job}/instance/{socket.gethostname()}",
+        data=registry.render().encode('utf-8'),
+        method='PUT',
+        headers={'Content-Type': 'text/plain; version=0.0.4'},
+    )
+    with urllib.request.urlopen(request, timeout=timeout):
+        pass
+
+def export(job, registry=REGISTRY):
+    """Export a finished batch job's metrics wherever METRICS_* points; never fails the job."""
+    if not registry.enabled:
+        return
+    gauge(f'{job}_last_run_timestamp_seconds', 'When the job last finished').set(time.time())
+    try:
+        if METRICS_TEXTFILE_DIR:
+            write_textfile(os.path.join(METRICS_TEXTFILE_DIR, f'{job}.prom'), registry)
+        if METRICS_PUSHGATEWAY_URL:
+            push(METRICS_PUSHGATEWAY_URL, job, registry)
+    except OSError as e:
+        print(f"Could not export metrics for {job}: {e}")
@@ -0,0 +1,118 @@
+import re
+import unicodedata
+from collections import deque
+
+# Zero-width characters that are often sprinkled into channel posts
+ZERO_WIDTH = dict.fromkeys(map(ord, '\u200b\u200c\u200d\u2060\ufeff'), None)
+
+def normalize_text(text):
+    """Normalize text for matching.
+
+    NFKC folds compatibility forms to plain letters, which covers the
+    mathematical-alphanumeric "fancy" letters (e.g. 𝗣𝗮𝗿𝗮𝗰𝗲𝘁𝗮𝗺𝗼𝗹) and fullwidth
+    forms used in these channels. casefold then lowercases Latin text; Ethiopic
+    has no case and passes through unchanged.
+    """
+    return unicodedata.normalize('NFKC', text).translate(ZERO_WIDTH).casefold()
+
+def is_word_char(char):
+    return char == '_' or unicodedata.category(char)[0] in 'LMN'
+
+def parse_term(term):
+    """Split a raw keyword into (kind, value).
+
+    `re:<pattern>` is a regex, `word:<term>` only matches whole words and
+    anything else is a plain substring.
+    """
+    for kind in ('re', 'word'):
+        if term.startswith(kind + ':'):
+            return kind, term[len(kind) + 1:]
+    return 'substring', term
+
+def load_keywords(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip() and not line.startswith('#')]
+
+class KeywordFilter:
+    """Keyword matcher compiled once from the configured terms.
+
+    Substring and whole-word terms share one Aho-Corasick automaton, so each
+    message is scanned once no matter how many terms there are. Regex terms
+    are run separately against the same normalized text.
+    """
+
+    def __init__(self, terms):
+        self.terms = list(terms)
+        self.literals = []
+        self.regexes = []
+        for term in self.terms:
+            kind, value = parse_term(term)
+            if kind == 're':
+                self.regexes.append((term, re.compile(value, re.IGNORECASE)))
+            elif normalize_text(value):
+                self.literals.append((term, normalize_text(value), kind == 'word'))
+        self._build()
+
+    @classmethod
+    def from_args(cls, keywords=None, keywords_file=None):
+        terms = list(keywords or [])
+        if keywords_file:
+            terms.extend(load_keywords(keywords_file))
+        return cls(terms)
+
+    def __bool__(self):
+        return bool(self.terms)
+
+    def _build(self):
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [[]]
+        for index, (_, pattern, _) in enumerate(self.literals):
+            state = 0
+            for char in pattern:
+                if char not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append([])
+                    self.goto[state][char] = len(self.goto) - 1
+                state = self.goto[state][char]
+            self.out[state].append(index)
+        # Breadth-first pass to fill failure links and merge outputs
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, child in self.goto[state].items():
+                queue.append(child)
+                if state == 0:
+                    continue  # depth-1 states fail back to the root
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(char, 0)
+                self.out[child] = self.out[child] + self.out[self.fail[child]]
+
+    def matches(self, text):
+        """Return the configured terms found in `text`, in first-match order."""
+        if not text:
+            return []
+        text = normalize_text(text)
+        found = {}
+        goto, fail, out = self.goto, self.fail, self.out
+        state = 0
+        for i, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for index in out[state]:
+                term, pattern, whole_word = self.literals[index]
+                if term in found:
+                    continue
+                if whole_word:
+                    start = i - len(pattern) + 1
+                    if (start > 0 and is_word_char(text[start - 1])) or (i + 1 < len(text) and is_word_char(text[i + 1])):
+                        continue
+                found[term] = None
+        for term, regex in self.regexes:
+            if term not in found and regex.search(text):
+                found[term] = None
+        return list(found)
@@ -0,0 +1,109 @@
+import os
+import hashlib
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+CREATE_MANIFEST_SQL = '''
+CREATE TABLE IF NOT EXISTS load_manifest (
+    target_table TEXT,
+    file_path TEXT,
+    file_size BIGINT,
+    file_mtime DOUBLE PRECISION,
+    content_hash TEXT,
+    rows_loaded BIGINT,
+    loaded_at TIMESTAMP DEFAULT now(),
+    PRIMARY KEY (target_table, file_path)
+);
+'''
+
+UPSERT_MANIFEST_SQL = '''
+INSERT INTO load_manifest (target_table, file_path, file_size, file_mtime, content_hash, rows_loaded, loaded_at)
+VALUES (%s, %s, %s, %s, %s, %s, now())
+ON CONFLICT (target_table, file_path) DO UPDATE SET
+    file_size = EXCLUDED.file_size,
+    file_mtime = EXCLUDED.file_mtime,
+    content_hash = EXCLUDED.content_hash,
+    rows_loaded = EXCLUDED.rows_loaded,
+    loaded_at = EXCLUDED.loaded_at;
+'''
+
+def file_hash(path, chunk_size=HASH_CHUNK_SIZE):
+    hasher = hashlib.md5()
+    with open(path, 'rb') as f:
+        update_hash(hasher, f, chunk_size=chunk_size)
+    return hasher.hexdigest()
+
+def update_hash(hasher, f, limit=None, chunk_size=HASH_CHUNK_SIZE):
+    """Feed `f` from its current position to `hasher`, up to `limit` bytes if given."""
+    remaining = limit
+    while remaining is None or remaining > 0:
+        chunk = f.read(chunk_size if remaining is None else min(chunk_size, remaining))
+        if not chunk:
+            break
+        hasher.update(chunk)
+        if remaining is not None:
+            remaining -= len(chunk)
+
+class LoadManifest:
+    """Tracks which files have been loaded into `target_table`.
+
+    A file whose size and mtime are unchanged is skipped without reading it.
+    If only the mtime changed, the content hash decides. NDJSON segments are
+    append-only: when one grew, only the already-loaded prefix is hashed and
+    checked against the stored hash, and the segment is loaded from the
+    previous size onward instead of from the start.
+
+    Entries are staged with `stage` once a file's rows have been handed to the
+    loader and written by `write_pending` in the same transaction as the last
+    of those rows, so the manifest never claims rows that were not committed.
+    """
+
+    def __init__(self, conn, target_table):
+        self.conn = conn
+        self.target_table = target_table
+        self.pending = []
+        with conn.cursor() as cur:
+            cur.execute(CREATE_MANIFEST_SQL)
+            cur.execute(
+                'SELECT file_path, file_size, file_mtime, content_hash, rows_loaded FROM load_manifest WHERE target_table = %s',
+                (target_table,)
+            )
+            self.entries = {row[0]: row[1:] for row in cur.fetchall()}
+        conn.commit()
+
+    def plan(self, path):
+        """Return (offset, entry) for a file, or (None, None) if it is up to date.
+
+        `offset` is where loading should start; `entry` is what to stage once
+        the rows from `offset` onward have been loaded.
+        """
+        stat = os.stat(path)
+        known = self.entries.get(path)
+        if known and known[0] == stat.st_size and known[1] == stat.st_mtime:
+            return None, None
+        if known and path.endswith('.ndjson') and stat.st_size > known[0]:
+            hasher = hashlib.md5()
+            with open(path, 'rb') as f:
+                update_hash(hasher, f, limit=known[0])
+                if hasher.hexdigest() == known[2]:
+                    # Grew by appends: the stored hash covers [0, known size),
+                    # so only the tail up to the size being loaded is hashed
+                    update_hash(hasher, f, limit=stat.st_size - known[0])
+                    return known[0], (path, stat.st_size, stat.st_mtime, hasher.hexdigest(), known[3])
+        content_hash = file_hash(path)
+        if known and known[2] == content_hash:
+            # Touched but identical: refresh the stat so we don't hash it again
+            self.stage((path, stat.st_size, stat.st_mtime, content_hash, known[3]), 0)
+            return None, None
+        return 0, (path, stat.st_size, stat.st_mtime, content_hash, 0)
+
+    def stage(self, entry, rows):
+        path, size, mtime, content_hash, rows_before = entry
+        self.pending.append((self.target_table, path, size, mtime, content_hash, rows_before + rows))
+
+    def write_pending(self, cur):
+        if self.pending:
+            cur.executemany(UPSERT_MANIFEST_SQL, self.pending)
+            for entry in self.pending:
+                self.entries[entry[1]] = entry[2:]
+            self.pending = []
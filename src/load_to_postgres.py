@@ -1,10 +1,17 @@
 import os
 import json
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import psycopg2
 from psycopg2.extras import execute_values
 from dotenv import load_dotenv
-
-RAW_DATA_DIR = 'data/raw/telegram_messages'
+from message_segments import RAW_DATA_DIR, iter_message_files, iter_messages
+from pg_copy import CopyBuffer, DEFAULT_BATCH_ROWS, create_staging_table, record_batch, ROWS_PER_SEC
+from load_manifest import LoadManifest
+from data_version import bump_data_version
+from instrumentation import export
+import parquet_lake
 
 # Load environment variables
 load_dotenv()
@@ -27,66 +34,279 @@ CREATE TABLE IF NOT EXISTS raw_telegram_messages (
     has_audio BOOLEAN,
     media_type TEXT,
     local_media_path TEXT,
-    raw_json JSONB
+    raw_json JSONB,
+    loaded_at TIMESTAMP DEFAULT now()
 );
 '''
 
+# When each row was last inserted or changed, for jobs that only process new
+# rows (see product_mentions.py). Tables created before it get the column here.
+ADD_LOADED_AT_SQL = '''
+ALTER TABLE raw_telegram_messages ADD COLUMN IF NOT EXISTS loaded_at TIMESTAMP DEFAULT now();
+'''
+
+# The incremental dbt marts pick up rows loaded since their last run, plus a
+# lookback on message_date (see dbt_project/macros/incremental.sql)
+CREATE_INDEXES_SQL = '''
+CREATE INDEX IF NOT EXISTS raw_telegram_messages_loaded_at_idx ON raw_telegram_messages (loaded_at);
+CREATE INDEX IF NOT EXISTS raw_telegram_messages_message_date_idx ON raw_telegram_messages (message_date);
+'''
+
+# Natural key: message ids are only unique within a channel. Older tables were
+# loaded without a key, so duplicates are dropped before the index is built.
+CREATE_KEY_SQL = '''
+DO $$
+BEGIN
+    IF to_regclass('raw_telegram_messages_channel_id_key') IS NULL THEN
+        DELETE FROM raw_telegram_messages a
+        USING raw_telegram_messages b
+        WHERE a.channel = b.channel AND a.id = b.id AND a.ctid < b.ctid;
+        CREATE UNIQUE INDEX raw_telegram_messages_channel_id_key ON raw_telegram_messages (channel, id);
+    END IF;
+END $$;
+'''
+
+UPSERT_SET_SQL = '''
+ON CONFLICT (channel, id) DO UPDATE SET
+    message_date = EXCLUDED.message_date,
+    sender_id = EXCLUDED.sender_id,
+    text = EXCLUDED.text,
+    has_image = EXCLUDED.has_image,
+    has_document = EXCLUDED.has_document,
+    has_video = EXCLUDED.has_video,
+    has_audio = EXCLUDED.has_audio,
+    media_type = EXCLUDED.media_type,
+    local_media_path = EXCLUDED.local_media_path,
+    raw_json = EXCLUDED.raw_json,
+    loaded_at = now()
+WHERE raw_telegram_messages.raw_json IS DISTINCT FROM EXCLUDED.raw_json
+'''
+
 INSERT_SQL = '''
 INSERT INTO raw_telegram_messages (
     id, channel, message_date, sender_id, text, has_image, has_document, has_video, has_audio, media_type, local_media_path, raw_json
 ) VALUES %s
-ON CONFLICT DO NOTHING;
-'''
+''' + UPSERT_SET_SQL + ';'
 
-def get_all_json_files():
-    for date_dir in os.listdir(RAW_DATA_DIR):
-        date_path = os.path.join(RAW_DATA_DIR, date_dir)
-        if not os.path.isdir(date_path):
-            continue
-        for file in os.listdir(date_path):
-            if file.endswith('.json'):
-                yield date_dir, file, os.path.join(date_path, file)
+STAGING_TABLE = 'raw_telegram_messages_stage'
 
-def main():
-    conn = psycopg2.connect(
+# Later rows in a batch win over earlier ones with the same key
+MERGE_SQL = f'''
+INSERT INTO raw_telegram_messages (
+    id, channel, message_date, sender_id, text, has_image, has_document, has_video, has_audio, media_type, local_media_path, raw_json
+)
+SELECT DISTINCT ON (channel, id)
+    id, channel, message_date, sender_id, text, has_image, has_document, has_video, has_audio, media_type, local_media_path, raw_json
+FROM {STAGING_TABLE}
+ORDER BY channel, id, ctid DESC
+''' + UPSERT_SET_SQL + ';'
+
+COLUMNS = [
+    'id', 'channel', 'message_date', 'sender_id', 'text', 'has_image', 'has_document',
+    'has_video', 'has_audio', 'media_type', 'local_media_path', 'raw_json'
+]
+
+def message_row(channel, msg):
+    return (
+        msg.get('id'),
+        channel,
+        msg.get('date'),
+        msg.get('sender_id'),
+        msg.get('text'),
+        msg.get('has_image'),
+        msg.get('has_document'),
+        msg.get('has_video'),
+        msg.get('has_audio'),
+        msg.get('media_type'),
+        msg.get('local_media_path'),
+        json.dumps(msg)
+    )
+
+def parquet_message_rows(path):
+    """COLUMNS rows from a Parquet lake file, with message_date as the same text the JSON files hold."""
+    for row in parquet_lake.iter_message_rows(path, COLUMNS):
+        yield row[:2] + (str(row[2]) if row[2] else None,) + row[3:]
+
+def iter_source_files(source):
+    """(date, channel, path) of every message file in the raw JSON tree or the Parquet lake."""
+    if source == 'parquet':
+        return parquet_lake.iter_lake_files('messages')
+    return iter_message_files(RAW_DATA_DIR)
+
+def connect():
+    return psycopg2.connect(
         host=DB_HOST,
         port=DB_PORT,
         dbname=DB_NAME,
         user=DB_USER,
         password=DB_PASS
     )
+
+def iter_files(manifest=None, source='json'):
+    """Yield (channel, path, offset, end, manifest entry) for files that need loading."""
+    for date_dir, channel, path in iter_source_files(source):
+        if manifest is None:
+            yield channel, path, 0, None, None
+            continue
+        offset, entry = manifest.plan(path)
+        if entry is not None:
+            yield channel, path, offset, entry[1], entry
+
+def iter_file_rows(manifest, channel, path, offset, end, entry):
+    """Rows of one file; its manifest entry is staged once they have all been read."""
+    rows = 0
+    if path.endswith('.parquet'):
+        for row in parquet_message_rows(path):
+            rows += 1
+            yield row
+    else:
+        for msg in iter_messages(path, offset, end):
+            rows += 1
+            yield message_row(channel, msg)
+    if manifest is not None:
+        manifest.stage(entry, rows)
+
+def iter_rows(manifest=None, source='json'):
+    for file in iter_files(manifest, source):
+        yield from iter_file_rows(manifest, *file)
+
+def report_batch(buffer, batch_rows, seconds):
+    record_batch('raw_telegram_messages', batch_rows, seconds, buffer.rows_per_sec)
+    print(f"Batch {buffer.batches}: {batch_rows} rows in {seconds:.2f}s | Total: {buffer.rows} rows ({buffer.rows_per_sec:.0f} rows/sec)")
+
+def load_copy(conn, batch_size, manifest=None, source='json'):
+    """Stream rows through a staging table with COPY and upsert them every batch.
+
+    The manifest is written in the same transaction as the batch that holds
+    the last rows of each file.
+    """
+    create_staging_table(conn, STAGING_TABLE, 'raw_telegram_messages')
+    buffer = CopyBuffer(
+        conn, STAGING_TABLE, COLUMNS, max_rows=batch_size, on_batch=report_batch,
+        merge_sql=MERGE_SQL, before_commit=manifest.write_pending if manifest else None
+    )
+    for row in iter_rows(manifest, source):
+        buffer.add(row)
+    buffer.flush()
+    return buffer.rows, buffer.rows_per_sec
+
+def load_insert(conn, manifest=None, source='json'):
+    cur = conn.cursor()
+    # execute_values can't upsert the same key twice in one statement
+    all_rows = list({(row[1], row[0]): row for row in iter_rows(manifest, source)}.values())
+    started = time.perf_counter()
+    if all_rows:
+        execute_values(cur, INSERT_SQL, all_rows)
+    if manifest is not None:
+        manifest.write_pending(cur)
+    conn.commit()
+    cur.close()
+    record_batch('raw_telegram_messages', len(all_rows), time.perf_counter() - started)
+    return len(all_rows), None
+
+def iter_work_units(source='json'):
+    """Group message files into (date, channel, [paths]) units for the worker pool."""
+    units = {}
+    for date_dir, channel, path in iter_source_files(source):
+        units.setdefault((date_dir, channel), []).append(path)
+    return [(date_dir, channel, paths) for (date_dir, channel), paths in units.items()]
+
+# Per-process state for parallel loads: each worker holds one connection
+_worker = {}
+
+def init_worker(batch_size, full):
+    conn = connect()
+    create_staging_table(conn, STAGING_TABLE, 'raw_telegram_messages')
+    manifest = LoadManifest(conn, 'raw_telegram_messages')
+    if full:
+        manifest.entries = {}
+    _worker.update(conn=conn, manifest=manifest, batch_size=batch_size)
+
+def load_unit(unit):
+    date_dir, channel, paths = unit
+    started = time.perf_counter()
+    manifest = _worker['manifest']
+    # Metrics live in the parent's registry, so batch timings travel back with the result
+    batches = []
+    buffer = CopyBuffer(
+        _worker['conn'], STAGING_TABLE, COLUMNS, max_rows=_worker['batch_size'],
+        merge_sql=MERGE_SQL, before_commit=manifest.write_pending,
+        on_batch=lambda buffer, batch_rows, seconds: batches.append((batch_rows, seconds))
+    )
+    for path in paths:
+        offset, entry = manifest.plan(path)
+        if entry is None:
+            continue
+        for row in iter_file_rows(manifest, channel, path, offset, entry[1], entry):
+            buffer.add(row)
+    buffer.flush()
+    elapsed = time.perf_counter() - started
+    if buffer.rows:
+        print(f"[worker {os.getpid()}] {date_dir}/{channel}: {buffer.rows} rows in {elapsed:.2f}s", flush=True)
+    return os.getpid(), buffer.rows, elapsed, batches
+
+def load_parallel(workers, batch_size, full, source='json'):
+    """Load date/channel units in a process pool, one DB connection per worker."""
+    units = iter_work_units(source)
+    started = time.perf_counter()
+    per_worker = {}
+    rows = 0
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(batch_size, full)) as pool:
+        futures = [pool.submit(load_unit, unit) for unit in units]
+        for future in as_completed(futures):
+            pid, unit_rows, seconds, batches = future.result()
+            for batch_rows, batch_seconds in batches:
+                record_batch('raw_telegram_messages', batch_rows, batch_seconds)
+            stats = per_worker.setdefault(pid, [0, 0, 0.0])
+            stats[0] += 1
+            stats[1] += unit_rows
+            stats[2] += seconds
+            rows += unit_rows
+    elapsed = time.perf_counter() - started
+    for pid, (unit_count, worker_rows, busy) in sorted(per_worker.items()):
+        print(f"Worker {pid}: {unit_count} units, {worker_rows} rows, busy {busy:.2f}s")
+    print(f"Loaded {len(units)} units with {workers} workers in {elapsed:.2f}s")
+    rows_per_sec = rows / max(elapsed, 1e-9)
+    ROWS_PER_SEC.labels('raw_telegram_messages').set(rows_per_sec)
+    return rows, rows_per_sec
+
+def main():
+    parser = argparse.ArgumentParser(description='Load raw Telegram messages into Postgres')
+    parser.add_argument('--mode', choices=['copy', 'insert'], default='copy', help='copy streams with COPY in batches; insert is the old single execute_values load')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_ROWS, help='Rows per COPY batch/commit')
+    parser.add_argument('--full', action='store_true', help='Ignore the load manifest and reload every file')
+    parser.add_argument('--workers', type=int, default=1, help='Parse and load date/channel partitions in this many processes (copy mode)')
+    parser.add_argument('--source', choices=['json', 'parquet'], default='json', help='Load from the raw JSON tree or the Parquet lake (see parquet_lake.py)')
+    args = parser.parse_args()
+
+    conn = connect()
     cur = conn.cursor()
     cur.execute(CREATE_TABLE_SQL)
+    cur.execute(ADD_LOADED_AT_SQL)
+    cur.execute(CREATE_KEY_SQL)
+    cur.execute(CREATE_INDEXES_SQL)
     conn.commit()
+    cur.close()
 
-    all_rows = []
-    for date_dir, file, path in get_all_json_files():
-        channel = file.replace('.json', '')
-        with open(path, 'r', encoding='utf-8') as f:
-            messages = json.load(f)
-            for msg in messages:
-                all_rows.append((
-                    msg.get('id'),
-                    channel,
-                    msg.get('date'),
-                    msg.get('sender_id'),
-                    msg.get('text'),
-                    msg.get('has_image'),
-                    msg.get('has_document'),
-                    msg.get('has_video'),
-                    msg.get('has_audio'),
-                    msg.get('media_type'),
-                    msg.get('local_media_path'),
-                    json.dumps(msg)
-                ))
-    if all_rows:
-        execute_values(cur, INSERT_SQL, all_rows)
+    manifest = LoadManifest(conn, 'raw_telegram_messages')
+    if args.full:
+        manifest.entries = {}
+    if args.mode == 'copy' and args.workers > 1:
+        rows, rows_per_sec = load_parallel(args.workers, args.batch_size, args.full, args.source)
+    elif args.mode == 'copy':
+        rows, rows_per_sec = load_copy(conn, args.batch_size, manifest, args.source)
+    else:
+        rows, rows_per_sec = load_insert(conn, manifest, args.source)
+    if rows:
+        with conn.cursor() as cur:
+            bump_data_version(cur, 'raw_telegram_messages')
         conn.commit()
-        print(f"Inserted {len(all_rows)} messages into raw_telegram_messages.")
+        rate = f" ({rows_per_sec:.0f} rows/sec)" if rows_per_sec else ''
+        print(f"Upserted {rows} messages into raw_telegram_messages{rate}.")
     else:
-        print("No messages found to insert.")
-    cur.close()
+        print("No new or changed message files to load.")
     conn.close()
+    export('load_to_postgres')
 
 if __name__ == '__main__':
     main() 
\ No newline at end of file
@@ -1,8 +1,13 @@
 import os
 import csv
+import argparse
 import psycopg2
-from psycopg2.extras import execute_values
 from dotenv import load_dotenv
+from pg_copy import CopyBuffer, create_staging_table, record_batch
+from load_manifest import LoadManifest
+from data_version import bump_data_version
+from instrumentation import export
+import parquet_lake
 
 CSV_FILE = 'yolo_detections.csv'
 
@@ -19,47 +24,154 @@ CREATE TABLE IF NOT EXISTS raw_image_detections (
     message_id BIGINT,
     image_path TEXT,
     detected_object_class TEXT,
-    confidence_score FLOAT
+    confidence_score FLOAT,
+    loaded_at TIMESTAMP DEFAULT now()
 );
 '''
 
-INSERT_SQL = '''
+# When each row was last inserted or changed; the incremental dbt marts only
+# rebuild detections loaded since their last run. Older tables get it here.
+ADD_LOADED_AT_SQL = '''
+ALTER TABLE raw_image_detections ADD COLUMN IF NOT EXISTS loaded_at TIMESTAMP DEFAULT now();
+CREATE INDEX IF NOT EXISTS raw_image_detections_loaded_at_idx ON raw_image_detections (loaded_at);
+'''
+
+# Natural key: one row per class per image, keeping the most confident box.
+# Older tables were loaded without a key, so they are collapsed first.
+CREATE_KEY_SQL = '''
+DO $$
+BEGIN
+    IF to_regclass('raw_image_detections_natural_key') IS NULL THEN
+        DELETE FROM raw_image_detections a
+        USING raw_image_detections b
+        WHERE a.message_id = b.message_id
+          AND a.image_path = b.image_path
+          AND a.detected_object_class = b.detected_object_class
+          AND (a.confidence_score, a.ctid) < (b.confidence_score, b.ctid);
+        CREATE UNIQUE INDEX raw_image_detections_natural_key
+            ON raw_image_detections (message_id, image_path, detected_object_class);
+    END IF;
+END $$;
+'''
+
+# Detections used to be written with Windows paths; fold them into their POSIX
+# spelling so the natural key doesn't see the same image twice.
+NORMALIZE_PATHS_SQL = '''
 INSERT INTO raw_image_detections (
     message_id, image_path, detected_object_class, confidence_score
-) VALUES %s
-ON CONFLICT DO NOTHING;
+)
+SELECT message_id, replace(image_path, chr(92), '/'), detected_object_class, max(confidence_score)
+FROM raw_image_detections
+WHERE strpos(image_path, chr(92)) > 0
+GROUP BY message_id, replace(image_path, chr(92), '/'), detected_object_class
+ON CONFLICT (message_id, image_path, detected_object_class) DO UPDATE SET
+    confidence_score = GREATEST(raw_image_detections.confidence_score, EXCLUDED.confidence_score),
+    loaded_at = now();
+DELETE FROM raw_image_detections WHERE strpos(image_path, chr(92)) > 0;
 '''
 
-def main():
-    conn = psycopg2.connect(
+COLUMNS = ['message_id', 'image_path', 'detected_object_class', 'confidence_score']
+
+STAGING_TABLE = 'raw_image_detections_stage'
+
+MERGE_SQL = f'''
+INSERT INTO raw_image_detections (
+    message_id, image_path, detected_object_class, confidence_score
+)
+SELECT message_id, image_path, detected_object_class, max(confidence_score)
+FROM {STAGING_TABLE}
+GROUP BY message_id, image_path, detected_object_class
+ON CONFLICT (message_id, image_path, detected_object_class) DO UPDATE SET
+    confidence_score = EXCLUDED.confidence_score,
+    loaded_at = now()
+WHERE raw_image_detections.confidence_score IS DISTINCT FROM EXCLUDED.confidence_score;
+'''
+
+def posix_path(path):
+    return path.replace('\\', '/')
+
+def connect():
+    return psycopg2.connect(
         host=DB_HOST,
         port=DB_PORT,
         dbname=DB_NAME,
         user=DB_USER,
         password=DB_PASS
     )
-    cur = conn.cursor()
-    cur.execute(CREATE_TABLE_SQL)
+
+def prepare_table(conn):
+    with conn.cursor() as cur:
+        cur.execute(CREATE_TABLE_SQL)
+        cur.execute(ADD_LOADED_AT_SQL)
+        cur.execute(CREATE_KEY_SQL)
+        cur.execute(NORMALIZE_PATHS_SQL)
     conn.commit()
 
-    rows = []
-    with open(CSV_FILE, 'r', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            rows.append((
+def report_batch(buffer, batch_rows, seconds):
+    record_batch('raw_image_detections', batch_rows, seconds, buffer.rows_per_sec)
+
+def open_buffer(conn, **kwargs):
+    """CopyBuffer that upserts batches of COLUMNS rows into raw_image_detections."""
+    create_staging_table(conn, STAGING_TABLE, 'raw_image_detections')
+    kwargs.setdefault('on_batch', report_batch)
+    return CopyBuffer(conn, STAGING_TABLE, COLUMNS, merge_sql=MERGE_SQL, **kwargs)
+
+def iter_csv_rows(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            yield (
                 int(row['message_id']),
-                row['image_path'],
+                posix_path(row['image_path']),
                 row['detected_object_class'],
                 float(row['confidence_score'])
-            ))
+            )
+
+def iter_source_files(source):
+    if source == 'parquet':
+        return [path for _, _, path in parquet_lake.iter_lake_files('detections')]
+    return [CSV_FILE]
+
+def main():
+    parser = argparse.ArgumentParser(description='Load YOLO detections into Postgres')
+    parser.add_argument('--source', choices=['csv', 'parquet'], default='csv', help=f'Load from {CSV_FILE} or the Parquet lake written by yolo_enrichment.py --sink parquet')
+    args = parser.parse_args()
+
+    conn = connect()
+    prepare_table(conn)
+
+    manifest = LoadManifest(conn, 'raw_image_detections')
+    buffer = open_buffer(conn, before_commit=manifest.write_pending)
+    files = rows = 0
+    for path in iter_source_files(args.source):
+        if not os.path.exists(path):
+            continue
+        offset, entry = manifest.plan(path)
+        if entry is None:
+            continue
+        file_rows = 0
+        if args.source == 'parquet':
+            file_rows_iter = parquet_lake.iter_detection_rows(path, COLUMNS)
+        else:
+            file_rows_iter = iter_csv_rows(path)
+        for row in file_rows_iter:
+            buffer.add(row)
+            file_rows += 1
+        manifest.stage(entry, file_rows)
+        files += 1
+        rows += file_rows
+    buffer.flush()
     if rows:
-        execute_values(cur, INSERT_SQL, rows)
+        with conn.cursor() as cur:
+            bump_data_version(cur, 'raw_image_detections')
         conn.commit()
-        print(f"Inserted {len(rows)} detections into raw_image_detections.")
+    if not files:
+        print(f"No new or changed detection files ({args.source}) since the last load.")
+    elif rows:
+        print(f"Upserted {rows} detections from {files} file(s) into raw_image_detections.")
     else:
         print("No detections found to insert.")
-    cur.close()
     conn.close()
+    export('load_yolo_detections')
 
 if __name__ == '__main__':
-    main() 
\ No newline at end of file
+    main()
@@ -0,0 +1,103 @@
+import os
+import sqlite3
+from datetime import datetime, timezone
+
+MEDIA_INDEX_PATH = 'data/raw/media_index.sqlite'
+
+CREATE_TABLE_SQL = '''
+CREATE TABLE IF NOT EXISTS media (
+    key TEXT PRIMARY KEY,
+    path TEXT,
+    channel TEXT,
+    message_id INTEGER,
+    added_at TEXT
+) WITHOUT ROWID;
+'''
+
+def media_key(message, media_type):
+    """Stable Telegram identifier for a message's media, known before downloading."""
+    if media_type == 'photo' and getattr(message, 'photo', None) is not None:
+        return f"photo:{message.photo.id}"
+    if media_type == 'document' and getattr(message, 'document', None) is not None:
+        return f"document:{message.document.id}"
+    return None
+
+def content_key(file_hash):
+    return f"md5:{file_hash}"
+
+class MediaIndex:
+    """Persistent dedupe index shared by every channel and every run.
+
+    Entries live in a SQLite primary-key table, so each lookup is a single
+    indexed probe and nothing is loaded into memory at startup. Keys that are
+    being downloaded right now are tracked in memory so two concurrent
+    downloads of the same media don't both go through.
+
+    Downloaded keys are only staged by `add`. `commit(channel)` writes them
+    once the channel's messages that point at the files are durable, so a
+    crash in between never leaves a key whose message was lost.
+    """
+
+    def __init__(self, path=MEDIA_INDEX_PATH):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute(CREATE_TABLE_SQL)
+        self.conn.commit()
+        self.in_flight = set()
+        # channel -> rows added since its last commit, and their keys
+        self.pending = {}
+        self.staged = set()
+
+    def __contains__(self, key):
+        if key is None:
+            return False
+        if key in self.in_flight:
+            return True
+        return self.conn.execute('SELECT 1 FROM media WHERE key = ?', (key,)).fetchone() is not None
+
+    def reserve(self, key):
+        """Claim `key` for download. Returns False if it is already known."""
+        if key is None:
+            return True
+        if key in self:
+            return False
+        self.in_flight.add(key)
+        return True
+
+    def release(self, key):
+        """Give up a reservation whose download was not added."""
+        if key not in self.staged:
+            self.in_flight.discard(key)
+
+    def add(self, keys, path, channel=None, message_id=None):
+        """Stage `keys` for the file at `path`; they stay reserved until `commit(channel)`."""
+        added_at = datetime.now(timezone.utc).isoformat()
+        rows = [(key, path, channel, message_id, added_at) for key in keys if key]
+        self.pending.setdefault(channel, []).extend(rows)
+        self.staged.update(row[0] for row in rows)
+        self.in_flight.update(row[0] for row in rows)
+
+    def commit(self, channel=None):
+        """Persist `channel`'s staged keys; call once its messages are flushed."""
+        rows = self.pending.pop(channel, [])
+        if rows:
+            self.conn.executemany('INSERT OR IGNORE INTO media VALUES (?, ?, ?, ?, ?)', rows)
+            self.conn.commit()
+        for row in rows:
+            self.staged.discard(row[0])
+            self.in_flight.discard(row[0])
+
+    def discard(self, channel=None):
+        """Drop `channel`'s staged keys, e.g. when its unflushed messages are lost."""
+        for row in self.pending.pop(channel, []):
+            self.staged.discard(row[0])
+            self.in_flight.discard(row[0])
+
+    def __len__(self):
+        return self.conn.execute('SELECT count(*) FROM media').fetchone()[0]
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,163 @@
+import os
+import json
+from checkpoints import fsync_dir
+
+RAW_DATA_DIR = 'data/raw/telegram_messages'
+DEFAULT_SEGMENT_BYTES = 64 * 1024 * 1024
+DEFAULT_BUFFER_MESSAGES = 1000
+READ_CHUNK_SIZE = 1024 * 1024
+
+def segment_path(root, msg_date, channel_name, index):
+    return os.path.join(root, msg_date, f'{channel_name}.{index:05d}.ndjson')
+
+def parse_message_file_name(file):
+    """Return the channel name for a message file, or None if it isn't one.
+
+    Handles both the legacy `<channel>.json` arrays and the
+    `<channel>.<segment>.ndjson` segments written by SegmentWriter.
+    """
+    if file.endswith('.ndjson'):
+        channel_name, _, index = file[:-len('.ndjson')].rpartition('.')
+        return channel_name if channel_name and index.isdigit() else None
+    if file.endswith('.json'):
+        return file[:-len('.json')]
+    return None
+
+class SegmentWriter:
+    """Append-only NDJSON writer with rolling, size-bounded segments.
+
+    Messages are buffered in memory (at most `max_buffered` in total) and
+    appended to `<root>/<date>/<channel>.<n>.ndjson`. A new segment is started
+    once the current one reaches `max_segment_bytes`. `flush` fsyncs what it
+    wrote, so once it returns the messages are durable.
+    """
+
+    def __init__(self, root=RAW_DATA_DIR, max_segment_bytes=DEFAULT_SEGMENT_BYTES, max_buffered=DEFAULT_BUFFER_MESSAGES, clean=False):
+        self.root = root
+        self.max_segment_bytes = max_segment_bytes
+        self.max_buffered = max_buffered
+        self.clean = clean
+        self.buffers = {}
+        self.buffered = 0
+        self.segments = {}
+        self.messages_written = 0
+        self.bytes_written = 0
+
+    def write(self, msg_date, channel_name, msg):
+        key = (msg_date, channel_name)
+        self.buffers.setdefault(key, []).append(json.dumps(msg, ensure_ascii=False, separators=(',', ':')))
+        self.buffered += 1
+        if self.buffered >= self.max_buffered:
+            self.flush()
+
+    def _open_segment(self, msg_date, channel_name):
+        """Find the segment to append to for a date/channel the first time it is touched."""
+        out_dir = os.path.join(self.root, msg_date)
+        os.makedirs(out_dir, exist_ok=True)
+        existing = []
+        for file in os.listdir(out_dir):
+            if parse_message_file_name(file) != channel_name:
+                continue
+            if self.clean:
+                os.remove(os.path.join(out_dir, file))
+            elif file.endswith('.ndjson'):
+                existing.append(int(file.rsplit('.', 2)[1]))
+        index = max(existing, default=0)
+        path = segment_path(self.root, msg_date, channel_name, index)
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        return [index, size]
+
+    def flush(self):
+        for (msg_date, channel_name), lines in self.buffers.items():
+            key = (msg_date, channel_name)
+            if key not in self.segments:
+                self.segments[key] = self._open_segment(msg_date, channel_name)
+            segment = self.segments[key]
+            i = 0
+            while i < len(lines):
+                if segment[1] >= self.max_segment_bytes:
+                    segment[0] += 1
+                    segment[1] = 0
+                path = segment_path(self.root, msg_date, channel_name, segment[0])
+                created = not os.path.exists(path)
+                with open(path, 'a', encoding='utf-8') as f:
+                    while i < len(lines) and segment[1] < self.max_segment_bytes:
+                        data = lines[i] + '\n'
+                        f.write(data)
+                        nbytes = len(data.encode('utf-8'))
+                        segment[1] += nbytes
+                        self.bytes_written += nbytes
+                        self.messages_written += 1
+                        i += 1
+                    f.flush()
+                    os.fsync(f.fileno())
+                # A new segment's directory entry must be durable too, or the checkpoint can outlive it
+                if created:
+                    fsync_dir(os.path.dirname(path))
+        self.buffers.clear()
+        self.buffered = 0
+
+    def close(self):
+        self.flush()
+
+def _iter_json_array(f, chunk_size=READ_CHUNK_SIZE):
+    """Yield the elements of a top-level JSON array without loading the whole file."""
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    started = False
+    eof = False
+    while True:
+        # Skip separators between elements
+        while pos < len(buf) and (buf[pos].isspace() or buf[pos] == ',' or (not started and buf[pos] == '[')):
+            started = started or buf[pos] == '['
+            pos += 1
+        if pos < len(buf) and buf[pos] == ']':
+            return
+        if pos < len(buf):
+            try:
+                obj, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            else:
+                yield obj
+                pos = end
+                continue
+        if eof:
+            return
+        chunk = f.read(chunk_size)
+        eof = not chunk
+        buf = buf[pos:] + chunk
+        pos = 0
+
+def iter_messages(path, offset=0, end=None):
+    """Yield message dicts from a legacy JSON array file or an NDJSON segment.
+
+    For segments, reading starts at byte `offset` (the size of the segment
+    when it was last read) and stops at byte `end`, so lines appended while
+    we read are left for next time.
+    """
+    if path.endswith('.ndjson'):
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            while end is None or f.tell() < end:
+                line = f.readline()
+                if not line:
+                    break
+                if line.strip():
+                    yield json.loads(line)
+    else:
+        with open(path, 'r', encoding='utf-8') as f:
+            yield from _iter_json_array(f)
+
+def iter_message_files(root=RAW_DATA_DIR):
+    """Yield (date, channel, path) for every message file under `root`."""
+    for date_dir in sorted(os.listdir(root)):
+        date_path = os.path.join(root, date_dir)
+        if not os.path.isdir(date_path):
+            continue
+        for file in sorted(os.listdir(date_path)):
+            channel_name = parse_message_file_name(file)
+            if channel_name:
+                yield date_dir, channel_name, os.path.join(date_path, file)
@@ -0,0 +1,305 @@
+"""Columnar copy of data/raw: Parquet partitioned by date/channel.
+
+    data/lake/messages/date=2025-06-18/channel=lobelia4cosmetics/part-0.parquet
+    data/lake/detections/date=2025-06-18/channel=lobelia4cosmetics/part-0.parquet
+
+Columns are typed like raw_telegram_messages and raw_image_detections, with
+`date` and `channel` coming from the directory names (hive partitioning), so
+readers can project only the columns they need and skip whole partitions.
+
+    python parquet_lake.py                  # convert new/changed message files and the detections CSV
+    python parquet_lake.py --full           # rewrite every partition
+
+Detections are enrichment output: `yolo_enrichment.py --sink parquet` writes
+them here directly (DetectionLakeWriter), and this script converts the CSV
+export only when it is newer than the lake's detections.
+"""
+import os
+import csv
+import json
+import shutil
+import argparse
+from datetime import datetime
+from message_segments import RAW_DATA_DIR, iter_message_files, iter_messages
+
+LAKE_ROOT = 'data/lake'
+DETECTIONS_CSV = 'yolo_detections.csv'
+ROW_GROUP_ROWS = 50000
+UNKNOWN_PARTITION = 'unknown'
+# Written when a detections snapshot is complete; its mtime dates the snapshot
+SNAPSHOT_MARKER = '_snapshot'
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+        import pyarrow.dataset
+    except ImportError:
+        raise ImportError("The Parquet lake needs pyarrow: pip install pyarrow") from None
+    return pyarrow
+
+def message_schema():
+    pa = _pyarrow()
+    return pa.schema([
+        ('id', pa.int64()),
+        ('message_date', pa.timestamp('us', tz='UTC')),
+        ('sender_id', pa.int64()),
+        ('text', pa.string()),
+        ('has_image', pa.bool_()),
+        ('has_document', pa.bool_()),
+        ('has_video', pa.bool_()),
+        ('has_audio', pa.bool_()),
+        ('media_type', pa.string()),
+        ('local_media_path', pa.string()),
+        ('extra_json', pa.string()),
+    ])
+
+def detection_schema():
+    pa = _pyarrow()
+    return pa.schema([
+        ('message_id', pa.int64()),
+        ('image_path', pa.string()),
+        ('detected_object_class', pa.string()),
+        ('confidence_score', pa.float64()),
+    ])
+
+def partition_dir(kind, msg_date, channel, root=LAKE_ROOT):
+    return os.path.join(root, kind, f'date={msg_date}', f'channel={channel}')
+
+def iter_lake_files(kind, root=LAKE_ROOT):
+    """Yield (date, channel, path) for every Parquet file of `kind` ('messages' or 'detections')."""
+    base = os.path.join(root, kind)
+    if not os.path.isdir(base):
+        return
+    for date_dir in sorted(os.listdir(base)):
+        if not date_dir.startswith('date='):
+            continue
+        for channel_dir in sorted(os.listdir(os.path.join(base, date_dir))):
+            if not channel_dir.startswith('channel='):
+                continue
+            part_dir = os.path.join(base, date_dir, channel_dir)
+            for file in sorted(os.listdir(part_dir)):
+                if file.endswith('.parquet'):
+                    yield date_dir[len('date='):], channel_dir[len('channel='):], os.path.join(part_dir, file)
+
+def dataset(kind, root=LAKE_ROOT):
+    """A pyarrow dataset over one table of the lake, with `date` and `channel` as partition columns."""
+    pa = _pyarrow()
+    partition_schema = pa.schema([('date', pa.string()), ('channel', pa.string())])
+    file_schema = message_schema() if kind == 'messages' else detection_schema()
+    schema = pa.schema(list(file_schema) + list(partition_schema))
+    partitioning = pa.dataset.partitioning(partition_schema, flavor='hive')
+    return pa.dataset.dataset(os.path.join(root, kind), schema=schema, format='parquet', partitioning=partitioning)
+
+def read_table(kind, columns=None, dates=None, channels=None, root=LAKE_ROOT):
+    """Read only `columns` of the partitions matching `dates`/`channels` into a pyarrow Table.
+
+    For example `read_table('messages', ['channel', 'message_date'], dates=['2025-06-18'])`.
+    """
+    pa = _pyarrow()
+    ds = dataset(kind, root)
+    condition = None
+    for field, values in (('date', dates), ('channel', channels)):
+        if values:
+            clause = pa.dataset.field(field).isin(list(values))
+            condition = clause if condition is None else condition & clause
+    return ds.to_table(columns=columns, filter=condition)
+
+def _write(path, schema, batches):
+    """Write record batches to `path` via a temp file so readers never see a half-written file."""
+    pa = _pyarrow()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+    rows = 0
+    with pa.parquet.ParquetWriter(tmp_path, schema, compression='zstd') as writer:
+        for batch in batches:
+            writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+            rows += len(batch)
+    os.replace(tmp_path, path)
+    return rows
+
+def _chunks(rows, size=ROW_GROUP_ROWS):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+# Message keys the scraper writes, in its order; each has a typed column ('date' is message_date)
+MESSAGE_KEYS = [
+    'id', 'date', 'sender_id', 'text', 'has_image', 'has_document',
+    'has_video', 'has_audio', 'media_type', 'local_media_path'
+]
+
+def message_record(msg):
+    """Typed columns for one message; keys without a column (e.g. keyword_matches) go to extra_json."""
+    msg_date = msg.get('date')
+    record = {key: msg.get(key) for key in MESSAGE_KEYS if key != 'date'}
+    record['message_date'] = datetime.fromisoformat(msg_date) if msg_date else None
+    extra = {key: value for key, value in msg.items() if key not in MESSAGE_KEYS}
+    if msg_date and str(record['message_date']) != msg_date:
+        extra['date'] = msg_date  # keep a date string that doesn't round-trip as written
+    record['extra_json'] = json.dumps(extra) if extra else None
+    return record
+
+def message_json(record):
+    """The message as the scraper wrote it, for raw_json; the inverse of message_record."""
+    msg = {key: record[key] for key in MESSAGE_KEYS if key != 'date'}
+    msg_date = record['message_date']
+    msg = dict(id=msg.pop('id'), date=str(msg_date) if msg_date else None, **msg)
+    if record.get('extra_json'):
+        msg.update(json.loads(record['extra_json']))
+    return json.dumps(msg)
+
+def convert_messages(source_root=RAW_DATA_DIR, root=LAKE_ROOT, full=False):
+    """Write one Parquet file per date/channel; partitions newer than all their sources are skipped."""
+    units = {}
+    for msg_date, channel, path in iter_message_files(source_root):
+        units.setdefault((msg_date, channel), []).append(path)
+    written = rows = 0
+    for (msg_date, channel), paths in units.items():
+        target = os.path.join(partition_dir('messages', msg_date, channel, root), 'part-0.parquet')
+        if not full and os.path.exists(target) and os.path.getmtime(target) >= max(os.path.getmtime(p) for p in paths):
+            continue
+        records = (message_record(msg) for path in paths for msg in iter_messages(path))
+        rows += _write(target, message_schema(), _chunks(records))
+        written += 1
+    return written, rows
+
+def detection_partition(image_path):
+    """(date, channel) from data/raw/telegram_images/<date>/<channel>/<file>."""
+    parts = image_path.replace('\\', '/').split('/')
+    if len(parts) >= 3:
+        return parts[-3], parts[-2]
+    return UNKNOWN_PARTITION, UNKNOWN_PARTITION
+
+class DetectionLakeWriter:
+    """Writes detection rows into date/channel partitions as they are produced.
+
+    Rows are buffered for one partition at a time and written out as a new
+    part file when the next row belongs to another partition, so memory stays
+    at one row group however many detections there are. Rows arrive grouped
+    by image directory; a partition that comes round again just gets another
+    part file. Every run is a full snapshot written under `<root>/.detections-staging`
+    and swapped in on close, so readers never see a half-written one.
+    """
+
+    def __init__(self, root=LAKE_ROOT, append=False):
+        _pyarrow()
+        self.root = root
+        self.staging = os.path.join(root, '.detections-staging')
+        # A resumed run carries on with the interrupted run's partial snapshot
+        if not append and os.path.isdir(self.staging):
+            shutil.rmtree(self.staging)
+        self.parts = sum(1 for _ in iter_lake_files('detections', self.staging))
+        self.partition = None
+        self.pending = []
+        self.partitions = set()
+        self.rows = 0
+
+    def write(self, rows):
+        for row in rows:
+            image_path = row['image_path'].replace('\\', '/')
+            partition = detection_partition(image_path)
+            if partition != self.partition or len(self.pending) >= ROW_GROUP_ROWS:
+                self.flush()
+                self.partition = partition
+            self.pending.append({
+                'message_id': int(row['message_id']),
+                'image_path': image_path,
+                'detected_object_class': row['detected_object_class'],
+                'confidence_score': float(row['confidence_score']),
+            })
+
+    def flush(self):
+        if not self.pending:
+            return
+        target = os.path.join(partition_dir('detections', *self.partition, self.staging), f'part-{self.parts}.parquet')
+        self.rows += _write(target, detection_schema(), [self.pending])
+        self.parts += 1
+        self.partitions.add(self.partition)
+        self.pending = []
+
+    def close(self):
+        """Replace the lake's detections with this snapshot."""
+        self.flush()
+        snapshot = os.path.join(self.staging, 'detections')
+        os.makedirs(snapshot, exist_ok=True)
+        with open(os.path.join(snapshot, SNAPSHOT_MARKER), 'w'):
+            pass
+        base = os.path.join(self.root, 'detections')
+        previous = base + '.old'
+        if os.path.isdir(previous):
+            shutil.rmtree(previous)
+        if os.path.isdir(base):
+            os.replace(base, previous)
+        os.replace(snapshot, base)
+        shutil.rmtree(self.staging)
+        if os.path.isdir(previous):
+            shutil.rmtree(previous)
+
+def snapshot_mtime(root=LAKE_ROOT):
+    """When the lake's detections were last written, or None if they never were."""
+    marker = os.path.join(root, 'detections', SNAPSHOT_MARKER)
+    return os.path.getmtime(marker) if os.path.exists(marker) else None
+
+def convert_detections(csv_path=DETECTIONS_CSV, root=LAKE_ROOT, full=False):
+    """Rewrite the detections from the CSV export unless the lake already has a newer snapshot."""
+    if not os.path.exists(csv_path):
+        return 0, 0
+    written_at = snapshot_mtime(root)
+    if not full and written_at is not None and written_at >= os.path.getmtime(csv_path):
+        return 0, 0
+    writer = DetectionLakeWriter(root)
+    with open(csv_path, 'r', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            writer.write([row])
+    writer.close()
+    return len(writer.partitions), writer.rows
+
+def iter_message_rows(path, columns):
+    """Rows of one messages file as tuples in `columns` order.
+
+    `channel` comes from the partition and `raw_json` is rebuilt from the
+    typed columns, so only the columns asked for are read unless raw_json is.
+    """
+    pa = _pyarrow()
+    channel = os.path.basename(os.path.dirname(path))[len('channel='):]
+    if 'raw_json' in columns:
+        file_columns = None
+    else:
+        file_columns = [c for c in columns if c != 'channel']
+    for batch in pa.parquet.ParquetFile(path).iter_batches(columns=file_columns):
+        for record in batch.to_pylist():
+            record['channel'] = channel
+            if 'raw_json' in columns:
+                record['raw_json'] = message_json(record)
+            yield tuple(record[c] for c in columns)
+
+def iter_detection_rows(path, columns):
+    pa = _pyarrow()
+    for batch in pa.parquet.ParquetFile(path).iter_batches(columns=columns):
+        for record in batch.to_pylist():
+            yield tuple(record[c] for c in columns)
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert data/raw into the Parquet lake')
+    parser.add_argument('--messages', type=str, default=RAW_DATA_DIR, help='Raw message tree to convert')
+    parser.add_argument('--detections', type=str, default=DETECTIONS_CSV, help='Detections CSV to convert')
+    parser.add_argument('--lake', type=str, default=LAKE_ROOT, help='Lake root')
+    parser.add_argument('--full', action='store_true', help='Rewrite every partition')
+    args = parser.parse_args()
+
+    partitions, rows = convert_messages(args.messages, args.lake, args.full)
+    print(f"Messages: wrote {partitions} partitions ({rows} rows)")
+    if not os.path.exists(args.detections):
+        print(f"Detections: no {args.detections}; yolo_enrichment.py --sink parquet writes them to the lake directly")
+        return
+    partitions, rows = convert_detections(args.detections, args.lake, args.full)
+    print(f"Detections: wrote {partitions} partitions ({rows} rows)")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+import cv2
+import numpy as np
+
+HASH_ALGORITHMS = ('phash', 'dhash')
+DEFAULT_HASH_ALGORITHM = 'phash'
+DEFAULT_MAX_DISTANCE = 4    # differing bits out of 64
+
+def _bits_to_int(bits):
+    value = 0
+    for bit in bits.flatten():
+        value = (value << 1) | int(bit)
+    return value
+
+def dhash(img, size=8):
+    """Difference hash: is each pixel brighter than its right neighbour, on a (size+1) x size thumbnail."""
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if img.ndim == 3 else img
+    small = cv2.resize(gray, (size + 1, size), interpolation=cv2.INTER_AREA)
+    return _bits_to_int(small[:, 1:] > small[:, :-1])
+
+def phash(img, size=8, highfreq_factor=4):
+    """DCT hash: low-frequency DCT coefficients of a 32x32 thumbnail against their median.
+
+    Survives re-compression, resizing and small colour changes, which is
+    what reposted product shots go through.
+    """
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if img.ndim == 3 else img
+    side = size * highfreq_factor
+    small = cv2.resize(gray, (side, side), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low = cv2.dct(small)[:size, :size]
+    return _bits_to_int(low > np.median(low))
+
+def image_hash(img, algorithm=DEFAULT_HASH_ALGORITHM):
+    return phash(img) if algorithm == 'phash' else dhash(img)
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+class BKTree:
+    """Burkhard-Keller tree over 64-bit hashes for Hamming-radius lookups.
+
+    Each node keeps its children by distance to it, so a search within
+    radius r only descends into children whose edge is within r of the
+    query's distance to the node (triangle inequality) instead of scanning
+    every hash.
+    """
+
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def add(self, hash_value, item):
+        self.size += 1
+        node = (hash_value, item, {})
+        if self.root is None:
+            self.root = node
+            return
+        current = self.root
+        while True:
+            distance = hamming(hash_value, current[0])
+            child = current[2].get(distance)
+            if child is None:
+                current[2][distance] = node
+                return
+            current = child
+
+    def nearest(self, hash_value, max_distance):
+        """(distance, item) of the closest hash within `max_distance`, or None."""
+        best = None
+        stack = [self.root] if self.root else []
+        while stack:
+            node_hash, item, children = stack.pop()
+            distance = hamming(hash_value, node_hash)
+            if distance <= max_distance and (best is None or distance < best[0]):
+                best = (distance, item)
+                if distance == 0:
+                    break
+            radius = best[0] if best else max_distance
+            for edge, child in children.items():
+                if distance - radius <= edge <= distance + radius:
+                    stack.append(child)
+        return best
+
+    def __len__(self):
+        return self.size
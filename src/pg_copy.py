@@ -0,0 +1,93 @@
+import io
+import time
+from instrumentation import counter, gauge, histogram
+
+DEFAULT_BATCH_ROWS = 10000
+DEFAULT_BATCH_BYTES = 8 * 1024 * 1024
+
+BATCH_SECONDS = histogram('loader_batch_seconds', 'COPY, merge and commit time per batch', ['table'])
+ROWS_LOADED = counter('loader_rows_total', 'Rows copied and committed', ['table'])
+ROWS_PER_SEC = gauge('loader_rows_per_second', 'Load throughput since the load started', ['table'])
+
+_COPY_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+def copy_text(value):
+    """Encode one value for PostgreSQL's COPY text format."""
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    return str(value).replace('\x00', '').translate(_COPY_ESCAPES)
+
+def create_staging_table(conn, staging_table, target_table):
+    """Session-local copy of `target_table`'s columns, emptied on every commit."""
+    with conn.cursor() as cur:
+        cur.execute(f'CREATE TEMP TABLE IF NOT EXISTS {staging_table} (LIKE {target_table}) ON COMMIT DELETE ROWS')
+    conn.commit()
+
+def record_batch(table, batch_rows, seconds, rows_per_sec=None):
+    """Record one committed batch of a load into `table` (see instrumentation.py)."""
+    BATCH_SECONDS.labels(table).observe(seconds)
+    ROWS_LOADED.labels(table).inc(batch_rows)
+    if rows_per_sec is not None:
+        ROWS_PER_SEC.labels(table).set(rows_per_sec)
+
+class CopyBuffer:
+    """Bounded buffer of rows that are sent with `COPY ... FROM STDIN`.
+
+    Rows are encoded as they are added. Once `max_rows` rows or `max_bytes`
+    characters are buffered the batch is copied and committed, so memory stays
+    flat however many rows go through.
+
+    For upserts, `table` is a staging table (see create_staging_table) and
+    `merge_sql` moves each batch into the real table. `before_commit(cur)`
+    runs last, inside the batch's transaction.
+    """
+
+    def __init__(self, conn, table, columns, max_rows=DEFAULT_BATCH_ROWS, max_bytes=DEFAULT_BATCH_BYTES, on_batch=None, merge_sql=None, before_commit=None):
+        self.conn = conn
+        self.copy_sql = f"COPY {table} ({', '.join(columns)}) FROM STDIN"
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.on_batch = on_batch
+        self.merge_sql = merge_sql
+        self.before_commit = before_commit
+        self.lines = []
+        self.buffered_bytes = 0
+        self.rows = 0
+        self.batches = 0
+        self.started = time.perf_counter()
+
+    def add(self, row):
+        line = '\t'.join(copy_text(value) for value in row) + '\n'
+        self.lines.append(line)
+        self.buffered_bytes += len(line)
+        if len(self.lines) >= self.max_rows or self.buffered_bytes >= self.max_bytes:
+            self.flush()
+
+    def flush(self):
+        if not self.lines:
+            if self.before_commit:
+                with self.conn.cursor() as cur:
+                    self.before_commit(cur)
+                self.conn.commit()
+            return
+        batch_started = time.perf_counter()
+        with self.conn.cursor() as cur:
+            cur.copy_expert(self.copy_sql, io.StringIO(''.join(self.lines)))
+            if self.merge_sql:
+                cur.execute(self.merge_sql)
+            if self.before_commit:
+                self.before_commit(cur)
+        self.conn.commit()
+        self.rows += len(self.lines)
+        self.batches += 1
+        batch_rows = len(self.lines)
+        self.lines = []
+        self.buffered_bytes = 0
+        if self.on_batch:
+            self.on_batch(self, batch_rows, time.perf_counter() - batch_started)
+
+    @property
+    def rows_per_sec(self):
+        return self.rows / max(time.perf_counter() - self.started, 1e-9)
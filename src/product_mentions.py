@@ -0,0 +1,219 @@
+"""Daily product-mention counts per channel, kept up to date incrementally.
+
+`product_mentions_daily` holds, for every (day, channel, product), how many
+messages mention the product. Each run only re-counts the (channel, day)
+partitions that got new or changed messages since that channel's watermark
+(its newest `raw_telegram_messages.loaded_at` already counted), so the cost
+follows the newly loaded rows rather than the whole history.
+
+    python product_mentions.py                                  # after load_to_postgres.py
+    python product_mentions.py --dictionary product_dictionary.txt
+    python product_mentions.py --full                           # recount everything
+
+Products are the entries of the dictionary file when there is one, one per
+line as `Canonical name: alias, other alias` (aliases match whole words after
+the same normalization as the scraper's keyword filter). Without a dictionary
+every word of at least --min-length letters that isn't a stopword counts.
+Changing the dictionary, stopwords or minimum length rebuilds the table.
+"""
+import os
+import re
+import json
+import hashlib
+import argparse
+from collections import Counter
+from datetime import timedelta
+from psycopg2.extras import execute_values
+from keyword_filter import KeywordFilter, load_keywords, normalize_text
+from data_version import bump_data_version
+
+PRODUCT_DICTIONARY_PATH = 'product_dictionary.txt'
+MIN_TOKEN_LENGTH = 3
+# Re-check this much before each watermark: rows committed late by a
+# concurrent load can carry a loaded_at older than rows already counted
+WATERMARK_OVERLAP = timedelta(hours=1)
+TOKENIZER_VERSION = 1
+
+# Words that the channels use everywhere and never name a product
+DEFAULT_STOPWORDS = frozenset('''
+a an and are as at be but by for from has have in is it its of on or our the this that to we with you your
+all any can get new now only per not more most very just also will each other than into out up
+price prices birr etb call contact phone tel address location delivery available order orders
+shop store pharmacy pharmaceuticals cosmetics product products quality original stock free
+tablet tablets tab tabs capsule capsules cap caps syrup suspension cream gel ointment drops
+mg ml gm kg pcs pack box bottle strip dose
+'''.split())
+
+# A word starts with a letter, so prices, dosages and phone numbers are skipped
+TOKEN_RE = re.compile(r"[^\W\d_][^\W_]*(?:[-'][^\W_]+)*")
+
+CREATE_TABLES_SQL = '''
+CREATE TABLE IF NOT EXISTS product_mentions_daily (
+    mention_date DATE,
+    channel_name TEXT,
+    product TEXT,
+    mentions INTEGER,
+    PRIMARY KEY (mention_date, channel_name, product)
+);
+CREATE INDEX IF NOT EXISTS product_mentions_daily_channel_idx ON product_mentions_daily (channel_name, mention_date);
+CREATE TABLE IF NOT EXISTS product_mentions_watermarks (
+    channel_name TEXT PRIMARY KEY,
+    last_loaded_at TIMESTAMP,
+    tokenizer_version TEXT,
+    updated_at TIMESTAMP DEFAULT now()
+);
+CREATE INDEX IF NOT EXISTS raw_telegram_messages_loaded_at_idx ON raw_telegram_messages (loaded_at);
+CREATE INDEX IF NOT EXISTS raw_telegram_messages_channel_date_idx ON raw_telegram_messages (channel, message_date);
+'''
+
+# (channel, day) partitions with rows loaded after their channel's watermark
+TOUCHED_SQL = '''
+CREATE TEMP TABLE product_mentions_touched ON COMMIT DROP AS
+SELECT m.channel AS channel_name, m.message_date::date AS mention_date, max(m.loaded_at) AS loaded_at
+FROM raw_telegram_messages m
+LEFT JOIN product_mentions_watermarks w ON w.channel_name = m.channel
+WHERE m.loaded_at > %(since)s
+  AND (w.last_loaded_at IS NULL OR m.loaded_at > w.last_loaded_at - %(overlap)s)
+  AND m.message_date IS NOT NULL
+GROUP BY 1, 2;
+'''
+
+TOUCHED_TEXTS_SQL = '''
+SELECT t.channel_name, t.mention_date, m.text
+FROM product_mentions_touched t
+JOIN raw_telegram_messages m
+  ON m.channel = t.channel_name
+ AND m.message_date >= t.mention_date
+ AND m.message_date < t.mention_date + 1
+WHERE m.text IS NOT NULL
+'''
+
+REPLACE_SQL = '''
+DELETE FROM product_mentions_daily d
+USING product_mentions_touched t
+WHERE d.channel_name = t.channel_name AND d.mention_date = t.mention_date;
+'''
+
+INSERT_SQL = 'INSERT INTO product_mentions_daily (mention_date, channel_name, product, mentions) VALUES %s'
+
+ADVANCE_WATERMARKS_SQL = '''
+INSERT INTO product_mentions_watermarks (channel_name, last_loaded_at, tokenizer_version, updated_at)
+SELECT channel_name, max(loaded_at), %s, now()
+FROM product_mentions_touched
+GROUP BY channel_name
+ON CONFLICT (channel_name) DO UPDATE SET
+    last_loaded_at = GREATEST(product_mentions_watermarks.last_loaded_at, EXCLUDED.last_loaded_at),
+    tokenizer_version = EXCLUDED.tokenizer_version,
+    updated_at = EXCLUDED.updated_at;
+-- Every row loaded up to this run's newest loaded_at has now been seen, so
+-- channels without new rows move up too; otherwise one idle channel would
+-- hold `since` back and each run would rescan everything loaded after it
+UPDATE product_mentions_watermarks w SET
+    last_loaded_at = t.high_water,
+    updated_at = now()
+FROM (SELECT max(loaded_at) AS high_water FROM product_mentions_touched) t
+WHERE t.high_water > w.last_loaded_at;
+'''
+
+def load_dictionary(path):
+    """{normalized alias: canonical name} from `Canonical: alias, alias` lines."""
+    products = {}
+    for line in load_keywords(path):
+        name, _, aliases = line.partition(':')
+        name = name.strip()
+        for alias in [name] + aliases.split(','):
+            if normalize_text(alias.strip()):
+                products[normalize_text(alias.strip())] = name
+    return products
+
+class ProductTokenizer:
+    """Turns a message into the distinct products it mentions.
+
+    With a dictionary, aliases are matched as whole words in one pass with
+    KeywordFilter and reported under their canonical name. Without one, the
+    normalized words that aren't stopwords are the products.
+    """
+
+    def __init__(self, products=None, stopwords=DEFAULT_STOPWORDS, min_length=MIN_TOKEN_LENGTH):
+        self.products = dict(products or {})
+        self.stopwords = frozenset(normalize_text(word) for word in stopwords)
+        self.min_length = min_length
+        self.matcher = KeywordFilter('word:' + alias for alias in self.products)
+
+    @classmethod
+    def from_files(cls, dictionary_path=PRODUCT_DICTIONARY_PATH, stopwords_path=None, min_length=MIN_TOKEN_LENGTH):
+        products = load_dictionary(dictionary_path) if dictionary_path and os.path.exists(dictionary_path) else None
+        stopwords = DEFAULT_STOPWORDS | frozenset(load_keywords(stopwords_path)) if stopwords_path else DEFAULT_STOPWORDS
+        return cls(products, stopwords, min_length)
+
+    def version(self):
+        """Changes whenever the same text could tokenize differently."""
+        state = [TOKENIZER_VERSION, sorted(self.products.items()), sorted(self.stopwords), self.min_length]
+        return hashlib.md5(json.dumps(state, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+    def products_in(self, text):
+        if not text:
+            return []
+        if self.products:
+            return list(dict.fromkeys(self.products[term[len('word:'):]] for term in self.matcher.matches(text)))
+        words = TOKEN_RE.findall(normalize_text(text))
+        return list(dict.fromkeys(w for w in words if len(w) >= self.min_length and w not in self.stopwords))
+
+def update_mentions(conn, tokenizer, full=False, overlap=WATERMARK_OVERLAP):
+    """Re-count the partitions touched since the watermarks; returns (partitions, messages, rows)."""
+    version = tokenizer.version()
+    with conn.cursor() as cur:
+        cur.execute(CREATE_TABLES_SQL)
+        cur.execute('SELECT last_loaded_at, tokenizer_version FROM product_mentions_watermarks')
+        marks = cur.fetchall()
+        if full or any(mark_version != version for _, mark_version in marks):
+            cur.execute('TRUNCATE product_mentions_daily, product_mentions_watermarks')
+            marks = []
+        # Channels without a watermark have never been counted, so start from the beginning
+        since = min(last for last, _ in marks) - overlap if marks else '-infinity'
+        cur.execute(TOUCHED_SQL, {'since': since, 'overlap': overlap})
+        cur.execute('SELECT count(*) FROM product_mentions_touched')
+        partitions = cur.fetchone()[0]
+
+    counts = Counter()
+    messages = 0
+    with conn.cursor(name='product_mentions_texts') as texts:
+        texts.itersize = 5000
+        texts.execute(TOUCHED_TEXTS_SQL)
+        for channel_name, mention_date, text in texts:
+            messages += 1
+            for product in tokenizer.products_in(text):
+                counts[(mention_date, channel_name, product)] += 1
+
+    with conn.cursor() as cur:
+        cur.execute(REPLACE_SQL)
+        if counts:
+            execute_values(cur, INSERT_SQL, [key + (mentions,) for key, mentions in counts.items()], page_size=5000)
+        cur.execute(ADVANCE_WATERMARKS_SQL, (version,))
+        if partitions:
+            bump_data_version(cur, 'product_mentions')
+    conn.commit()
+    return partitions, messages, len(counts)
+
+def main():
+    from load_to_postgres import connect
+
+    parser = argparse.ArgumentParser(description='Update product_mentions_daily from newly loaded messages')
+    parser.add_argument('--dictionary', type=str, default=PRODUCT_DICTIONARY_PATH, help='Product dictionary (used if the file exists)')
+    parser.add_argument('--stopwords', type=str, default=None, help='Extra stopwords, one per line')
+    parser.add_argument('--min-length', type=int, default=MIN_TOKEN_LENGTH, help='Shortest word counted when there is no dictionary')
+    parser.add_argument('--overlap-minutes', type=float, default=WATERMARK_OVERLAP.total_seconds() / 60, help='Re-check this long before each watermark')
+    parser.add_argument('--full', action='store_true', help='Drop all counts and recount every message')
+    args = parser.parse_args()
+
+    tokenizer = ProductTokenizer.from_files(args.dictionary, args.stopwords, args.min_length)
+    conn = connect()
+    partitions, messages, rows = update_mentions(conn, tokenizer, args.full, timedelta(minutes=args.overlap_minutes))
+    conn.close()
+    if partitions:
+        print(f"Re-counted {partitions} channel/day partitions ({messages} messages): {rows} product_mentions_daily rows.")
+    else:
+        print("No new messages since the last update.")
+
+if __name__ == '__main__':
+    main()
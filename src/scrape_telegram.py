@@ -11,8 +11,17 @@ import asyncio
 from concurrent.futures import ThreadPoolExecutor
 import hashlib
 import time
-from collections import defaultdict
 import shutil
+from contextlib import AsyncExitStack
+from media_index import MediaIndex, MEDIA_INDEX_PATH, media_key, content_key
+from checkpoints import CheckpointJournal, CHECKPOINT_DIR, DEFAULT_FLUSH_EVERY, DEFAULT_FLUSH_INTERVAL, load_checkpoint, resume_stats
+from message_segments import SegmentWriter, RAW_DATA_DIR, DEFAULT_SEGMENT_BYTES, DEFAULT_BUFFER_MESSAGES
+from keyword_filter import KeywordFilter
+from instrumentation import counter, histogram, export
+from telegram_scheduler import (
+    RequestScheduler, DEFAULT_REQUESTS_PER_SECOND, DEFAULT_BURST, DEFAULT_MAX_CONCURRENT_REQUESTS,
+    DEFAULT_MAX_FLOOD_RETRIES, shard_channels, assign_sessions
+)
 
 # Load environment variables
 load_dotenv()
@@ -25,44 +34,109 @@ logging.basicConfig(
     format='%(asctime)s %(levelname)s:%(message)s'
 )
 
-RAW_DATA_DIR = 'data/raw/telegram_messages'
 IMAGE_DATA_DIR = 'data/raw/telegram_images'
-CHECKPOINT_DIR = 'data/raw/checkpoints'
 
 # Default config
 DEFAULT_IMAGE_TYPES = ['image/jpeg', 'image/png']
 DEFAULT_KEYWORDS = []  # e.g., ['paracetamol', 'cream', 'pill']
+DEFAULT_DOWNLOAD_WORKERS = 4
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Hashing runs off the event loop so downloads and iter_messages keep flowing
+hash_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='hash')
 
-# Helper to hash image content for deduplication
-image_hashes = set()
+# Recorded once per channel from its StageStats, so the per-message loop pays nothing extra
+STAGE_ITEMS = counter('scraper_stage_items_total', 'Items through each scrape stage', ['channel', 'stage'])
+STAGE_BYTES = counter('scraper_stage_bytes_total', 'Bytes through each scrape stage', ['channel', 'stage'])
+STAGE_SECONDS = counter('scraper_stage_busy_seconds_total', 'Busy time of each scrape stage', ['channel', 'stage'])
+FLOOD_WAIT_SECONDS = counter('scraper_flood_wait_seconds_total', 'Seconds Telegram asked us to wait', ['channel'])
+CHANNEL_SECONDS = histogram('scraper_channel_seconds', 'Wall time per channel scrape', ['channel', 'outcome'])
 
-def hash_file(file_path):
+def hash_file(file_path, chunk_size=HASH_CHUNK_SIZE):
     hasher = hashlib.md5()
     with open(file_path, 'rb') as f:
-        buf = f.read()
-        hasher.update(buf)
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            hasher.update(chunk)
     return hasher.hexdigest()
 
+async def hash_file_async(file_path):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(hash_executor, hash_file, file_path)
+
+class StageStats:
+    """Item/byte counters and busy time for one stage of the scrape loop."""
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.bytes = 0
+        self.busy_seconds = 0.0
+
+    def record(self, elapsed, nbytes=0):
+        self.count += 1
+        self.bytes += nbytes
+        self.busy_seconds += elapsed
+
+    def summary(self, wall_seconds):
+        wall_seconds = max(wall_seconds, 1e-9)
+        text = f"{self.name}: {self.count} ({self.count / wall_seconds:.1f}/s"
+        if self.bytes:
+            text += f", {self.bytes / 1e6 / wall_seconds:.2f} MB/s"
+        return text + ")"
+
+def record_channel_metrics(channel_name, stats, client, outcome, elapsed):
+    for key, stage in stats.items():
+        STAGE_ITEMS.labels(channel_name, key).inc(stage.count)
+        STAGE_BYTES.labels(channel_name, key).inc(stage.bytes)
+        STAGE_SECONDS.labels(channel_name, key).inc(stage.busy_seconds)
+    FLOOD_WAIT_SECONDS.labels(channel_name).inc(getattr(client, 'flood_wait_seconds', 0))
+    CHANNEL_SECONDS.labels(channel_name, outcome).observe(elapsed)
+
+class DownloadStage:
+    """Runs media downloads as tasks with at most `max_in_flight` running.
+
+    `submit` blocks while the stage is full, which gives back-pressure to the
+    `iter_messages` loop instead of queueing an unbounded number of tasks.
+    """
+
+    def __init__(self, max_in_flight):
+        self.semaphore = asyncio.Semaphore(max(1, max_in_flight))
+        self.pending = set()
+
+    async def submit(self, coro):
+        await self.semaphore.acquire()
+        task = asyncio.create_task(coro)
+        self.pending.add(task)
+        # A callback rather than a `finally` in the task, so a task cancelled before it starts still frees its slot
+        task.add_done_callback(self._done)
+
+    def _done(self, task):
+        self.pending.discard(task)
+        self.semaphore.release()
+
+    async def drain(self):
+        while self.pending:
+            await asyncio.gather(*list(self.pending))
+
+    async def cancel(self):
+        """Cancel whatever is still running and wait for it, so no task outlives the scrape."""
+        tasks = list(self.pending)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
 def load_channels(channel_file):
     with open(channel_file, 'r') as f:
         return [line.strip() for line in f if line.strip() and not line.startswith('#')]
 
-def load_checkpoint(channel_name):
-    os.makedirs(CHECKPOINT_DIR, exist_ok=True)
-    checkpoint_file = os.path.join(CHECKPOINT_DIR, f'{channel_name}.json')
-    if os.path.exists(checkpoint_file):
-        with open(checkpoint_file, 'r') as f:
-            return json.load(f).get('last_message_id')
-    return None
-
-def save_checkpoint(channel_name, last_message_id):
-    os.makedirs(CHECKPOINT_DIR, exist_ok=True)
-    checkpoint_file = os.path.join(CHECKPOINT_DIR, f'{channel_name}.json')
-    with open(checkpoint_file, 'w') as f:
-        json.dump({'last_message_id': last_message_id}, f)
-
-async def download_media(message, channel_name, today, client, media_type, image_types):
+async def download_media(message, channel_name, today, client, media_type, image_types, stats=None, media_index=None):
     media_path = None
+    key = media_key(message, media_type)
+    # Skip media we have already stored before fetching any bytes
+    if media_index is not None and not media_index.reserve(key):
+        if stats:
+            stats['dedupe'].record(0)
+        return None
     try:
         out_dir = os.path.join(IMAGE_DATA_DIR, today, channel_name)
         os.makedirs(out_dir, exist_ok=True)
@@ -75,45 +149,115 @@ async def download_media(message, channel_name, today, client, media_type, image
                 ext = message.file.ext
             file_name += ext
         file_path = os.path.join(out_dir, file_name)
+        started = time.perf_counter()
         await client.download_media(message, file_path)
-        # Deduplication by hash
-        file_hash = hash_file(file_path)
-        if file_hash in image_hashes:
+        if stats:
+            stats['download'].record(time.perf_counter() - started, os.path.getsize(file_path))
+        # Deduplication by content hash, for re-uploads that got a new Telegram id
+        started = time.perf_counter()
+        file_hash = await hash_file_async(file_path)
+        if stats:
+            stats['hash'].record(time.perf_counter() - started, os.path.getsize(file_path))
+        if media_index is not None and content_key(file_hash) in media_index:
             os.remove(file_path)
+            if stats:
+                stats['dedupe'].record(0)
             return None
-        image_hashes.add(file_hash)
         # Image type filtering
         if media_type == 'photo' or (media_type == 'document' and message.file and message.file.mime_type in image_types):
+            if media_index is not None:
+                media_index.add([key, content_key(file_hash)], file_path, channel_name, message.id)
             return file_path
         else:
             os.remove(file_path)
             return None
     except Exception as e:
         logging.error(f"Failed to download {media_type} for message {message.id} in {channel_name}: {e}")
+    finally:
+        if media_index is not None:
+            media_index.release(key)
     return None
 
-async def scrape_channel(client, channel_url, args, image_types, keywords):
+async def scrape_channel(client, channel_url, args, image_types, keywords, media_index=None):
     channel_name = channel_url.split('/')[-1]
-    messages_by_date = defaultdict(list)
+    if keywords and not isinstance(keywords, KeywordFilter):
+        keywords = KeywordFilter(keywords)
     images_downloaded = 0
     skipped_messages = 0
     errors = 0
-    last_message_id = load_checkpoint(channel_name)
+    journal = CheckpointJournal(
+        channel_name,
+        getattr(args, 'flush_every', DEFAULT_FLUSH_EVERY),
+        getattr(args, 'flush_interval', DEFAULT_FLUSH_INTERVAL)
+    )
+    last_message_id = journal.last_message_id
+    writer = SegmentWriter(
+        RAW_DATA_DIR,
+        getattr(args, 'segment_bytes', DEFAULT_SEGMENT_BYTES),
+        getattr(args, 'buffer_messages', DEFAULT_BUFFER_MESSAGES),
+        clean=getattr(args, 'clean', False)
+    )
+    stats = {name: StageStats(name.capitalize()) for name in ('messages', 'download', 'hash', 'dedupe')}
+    downloads = DownloadStage(getattr(args, 'download_workers', DEFAULT_DOWNLOAD_WORKERS))
+    started = time.perf_counter()
+
+    async def fetch_media(message, msg_dict, media_type, mime_type):
+        nonlocal images_downloaded
+        msg_date = message.date.strftime('%Y-%m-%d')
+        path = await download_media(message, channel_name, msg_date, client, media_type, image_types, stats, media_index)
+        if not path:
+            writer.write(msg_date, channel_name, msg_dict)
+            return
+        if media_type == 'photo':
+            msg_dict['has_image'] = True
+            msg_dict['media_type'] = 'photo'
+        elif mime_type.startswith('image/'):
+            msg_dict['has_image'] = True
+            msg_dict['media_type'] = 'image_document'
+        elif mime_type.startswith('video/'):
+            msg_dict['has_video'] = True
+            msg_dict['media_type'] = 'video_document'
+        elif mime_type.startswith('audio/'):
+            msg_dict['has_audio'] = True
+            msg_dict['media_type'] = 'audio_document'
+        msg_dict['local_media_path'] = path
+        images_downloaded += 1
+        writer.write(msg_date, channel_name, msg_dict)
+
+    def write_durably():
+        writer.flush()
+        journal.commit()
+
+    async def flush():
+        # Output must be durable before the checkpoint moves past it
+        await downloads.drain()
+        # fsyncs; run off the event loop so other channels keep scraping
+        await asyncio.get_running_loop().run_in_executor(None, write_durably)
+        # Only now are the messages pointing at the new files durable
+        if media_index is not None:
+            media_index.commit(channel_name)
+
     try:
         iter_kwargs = {
             'entity': channel_url,
             'reverse': True
         }
         if last_message_id is not None:
-            iter_kwargs['min_id'] = last_message_id + 1
+            iter_kwargs['min_id'] = last_message_id
         if args.start_date:
             iter_kwargs['offset_date'] = args.start_date
 
         async for message in client.iter_messages(**iter_kwargs):
+            stats['messages'].record(0)
+            # Every message recorded so far is fully handled, so it is safe to flush here
+            if journal.due():
+                await flush()
+            journal.record(message.id, message.date)
             # Message filtering by keywords
+            keyword_matches = None
             if keywords:
-                text = (message.text or '').lower()
-                if not any(kw.lower() in text for kw in keywords):
+                keyword_matches = keywords.matches(message.text)
+                if not keyword_matches:
                     skipped_messages += 1
                     continue
             msg_dict = {
@@ -128,103 +272,155 @@ async def scrape_channel(client, channel_url, args, image_types, keywords):
                 'media_type': None,
                 'local_media_path': None
             }
-            # Download images/photos
+            if keyword_matches is not None:
+                msg_dict['keyword_matches'] = keyword_matches
+            msg_date_obj = message.date
+            if args.start_date and msg_date_obj < args.start_date:
+                continue
+            if args.end_date and msg_date_obj > args.end_date:
+                continue
+            msg_date = message.date.strftime('%Y-%m-%d')
+            # Media messages are written once their download finishes, the rest straight away
             if message.photo:
-                # Use message date for image folder as well
-                msg_date = message.date.strftime('%Y-%m-%d')
-                path = await download_media(message, channel_name, msg_date, client, 'photo', image_types)
-                if path:
-                    msg_dict['has_image'] = True
-                    msg_dict['media_type'] = 'photo'
-                    msg_dict['local_media_path'] = path
-                    images_downloaded += 1
+                await downloads.submit(fetch_media(message, msg_dict, 'photo', ''))
             # Download documents (images, videos, audio)
             elif message.document:
                 mime_type = message.file.mime_type if message.file else ''
                 if mime_type.startswith('image/') or mime_type.startswith('video/') or mime_type.startswith('audio/'):
-                    msg_date = message.date.strftime('%Y-%m-%d')
-                    path = await download_media(message, channel_name, msg_date, client, 'document', image_types)
-                    if path:
-                        if mime_type.startswith('image/'):
-                            msg_dict['has_image'] = True
-                            msg_dict['media_type'] = 'image_document'
-                        elif mime_type.startswith('video/'):
-                            msg_dict['has_video'] = True
-                            msg_dict['media_type'] = 'video_document'
-                        elif mime_type.startswith('audio/'):
-                            msg_dict['has_audio'] = True
-                            msg_dict['media_type'] = 'audio_document'
-                        msg_dict['local_media_path'] = path
-                        images_downloaded += 1
+                    await downloads.submit(fetch_media(message, msg_dict, 'document', mime_type))
+                else:
+                    writer.write(msg_date, channel_name, msg_dict)
             else:
                 skipped_messages += 1
-            # Group messages by their actual date
-            msg_date_obj = message.date
-            if args.start_date and msg_date_obj < args.start_date:
-                continue
-            if args.end_date and msg_date_obj > args.end_date:
-                continue
-            msg_date = message.date.strftime('%Y-%m-%d')
-            messages_by_date[msg_date].append(msg_dict)
-            save_checkpoint(channel_name, message.id)
-        # Clean old data if --clean is set
-        if getattr(args, 'clean', False):
-            for msg_date in messages_by_date.keys():
-                out_dir = os.path.join(RAW_DATA_DIR, msg_date)
-                out_file = os.path.join(out_dir, f'{channel_name}.json')
-                if os.path.exists(out_file):
-                    os.remove(out_file)
-        # Write messages grouped by date
-        for msg_date, msgs in messages_by_date.items():
-            out_dir = os.path.join(RAW_DATA_DIR, msg_date)
-            os.makedirs(out_dir, exist_ok=True)
-            out_file = os.path.join(out_dir, f'{channel_name}.json')
-            with open(out_file, 'w', encoding='utf-8') as f:
-                json.dump(msgs, f, ensure_ascii=False, indent=2)
-        logging.info(f'Successfully scraped messages for {channel_name}. Images downloaded: {images_downloaded}, Skipped: {skipped_messages}, Errors: {errors}')
-        print(f"Channel: {channel_name} | Images: {images_downloaded} | Skipped: {skipped_messages} | Errors: {errors}")
+                writer.write(msg_date, channel_name, msg_dict)
+        await flush()
+        elapsed = time.perf_counter() - started
+        throughput = ' | '.join(stage.summary(elapsed) for stage in stats.values())
+        throughput += f" | FloodWait: {getattr(client, 'flood_wait_seconds', 0)}s"
+        logging.info(f'Successfully scraped messages for {channel_name}. Images downloaded: {images_downloaded}, Skipped: {skipped_messages}, Errors: {errors}. {throughput}')
+        print(f"Channel: {channel_name} | Images: {images_downloaded} | Skipped: {skipped_messages} | Errors: {errors} | Checkpoint: {journal.last_message_id} | {throughput}")
+        record_channel_metrics(channel_name, stats, client, 'ok', elapsed)
+        return {
+            'channel': channel_name,
+            'messages': stats['messages'].count,
+            'images': images_downloaded,
+            'media_bytes': stats['download'].bytes,
+            'skipped': skipped_messages,
+            'errors': errors,
+            'seconds': elapsed,
+        }
     except FloodWaitError as e:
-        logging.error(f'FloodWaitError scraping {channel_name}: Must wait {e.seconds} seconds')
-        print(f'FloodWaitError: Waiting {e.seconds} seconds for {channel_name}')
-        time.sleep(e.seconds)
-        return await scrape_channel(client, channel_url, args, image_types, keywords)
+        # The scheduler already backed off and retried; keep what we have and resume next run
+        await flush()
+        logging.error(f'FloodWaitError scraping {channel_name}: giving up after retries (last wait {e.seconds} seconds), resuming from message {journal.last_message_id} next run')
+        print(f'FloodWaitError: Stopped {channel_name} at message {journal.last_message_id}, resume on next run')
+        record_channel_metrics(channel_name, stats, client, 'flood_wait', time.perf_counter() - started)
     except Exception as e:
         errors += 1
+        # Stop the downloads first so none stages media keys after the discard
+        await downloads.cancel()
+        if media_index is not None:
+            media_index.discard(channel_name)
         logging.error(f'Error scraping {channel_name}: {e}')
         print(f'Error scraping {channel_name}: {e}')
+        record_channel_metrics(channel_name, stats, client, 'error', time.perf_counter() - started)
+    finally:
+        # Downloads still running here belong to a failed or cancelled scrape
+        await downloads.cancel()
 
-async def main():
+def build_parser():
     parser = argparse.ArgumentParser(description='Telegram Scraper')
     parser.add_argument('--channels', type=str, default='channels.txt', help='Path to channels.txt')
     parser.add_argument('--start-date', type=str, default=None, help='Start date (YYYY-MM-DD)')
     parser.add_argument('--end-date', type=str, default=None, help='End date (YYYY-MM-DD)')
-    parser.add_argument('--keywords', type=str, nargs='*', default=DEFAULT_KEYWORDS, help='Keywords to filter messages')
+    parser.add_argument('--keywords', type=str, nargs='*', default=DEFAULT_KEYWORDS, help='Keywords to filter messages (prefix word: for whole words, re: for regexes)')
+    parser.add_argument('--keywords-file', type=str, default=None, help='File with one keyword per line, same syntax as --keywords')
     parser.add_argument('--image-types', type=str, nargs='*', default=DEFAULT_IMAGE_TYPES, help='Allowed image MIME types')
     parser.add_argument('--parallel', action='store_true', help='Enable parallel scraping')
     parser.add_argument('--clean', action='store_true', help='Delete old data for selected date/channel before rescanning')
-    args = parser.parse_args()
+    parser.add_argument('--media-index', type=str, default=MEDIA_INDEX_PATH, help='Path to the persistent media dedupe index')
+    parser.add_argument('--download-workers', type=int, default=DEFAULT_DOWNLOAD_WORKERS, help='Maximum concurrent media downloads per channel')
+    parser.add_argument('--flush-every', type=int, default=DEFAULT_FLUSH_EVERY, help='Flush output and checkpoint every N messages')
+    parser.add_argument('--flush-interval', type=float, default=DEFAULT_FLUSH_INTERVAL, help='Flush output and checkpoint at least every N seconds')
+    parser.add_argument('--segment-bytes', type=int, default=DEFAULT_SEGMENT_BYTES, help='Roll over to a new NDJSON segment after this many bytes')
+    parser.add_argument('--buffer-messages', type=int, default=DEFAULT_BUFFER_MESSAGES, help='Maximum messages buffered in memory before writing')
+    parser.add_argument('--requests-per-second', type=float, default=DEFAULT_REQUESTS_PER_SECOND, help='Telegram requests per second per session')
+    parser.add_argument('--burst', type=int, default=DEFAULT_BURST, help='Request burst size per session')
+    parser.add_argument('--max-concurrent-requests', type=int, default=DEFAULT_MAX_CONCURRENT_REQUESTS, help='Maximum in-flight Telegram requests per session')
+    parser.add_argument('--max-flood-retries', type=int, default=DEFAULT_MAX_FLOOD_RETRIES, help='Retries after FloodWait before a channel gives up for this run')
+    parser.add_argument('--sessions', type=str, nargs='*', default=None, help='Session files to spread channels over (default: $TELEGRAM_SESSION)')
+    parser.add_argument('--shard-index', type=int, default=0, help='Index of this scraper process when sharding channels')
+    parser.add_argument('--shard-count', type=int, default=1, help='Number of scraper processes sharing the channel list')
+    parser.add_argument('--resume-stats', action='store_true', help='Print per-channel checkpoint stats and exit')
+    return parser
 
+def parse_args(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.shard_count < 1:
+        parser.error('--shard-count must be at least 1')
+    if not 0 <= args.shard_index < args.shard_count:
+        parser.error(f'--shard-index must be between 0 and {args.shard_count - 1} for --shard-count {args.shard_count}')
     # Parse dates
     if args.start_date:
         args.start_date = datetime.strptime(args.start_date, '%Y-%m-%d').replace(tzinfo=timezone.utc)
     if args.end_date:
         args.end_date = datetime.strptime(args.end_date, '%Y-%m-%d').replace(tzinfo=timezone.utc)
+    return args
+
+async def run_scraper(args, client_factory=None):
+    """Scrape every configured channel; returns the per-channel summaries.
 
+    `client_factory(session)` must return an async context manager yielding a
+    TelegramClient-like object. It defaults to a real TelegramClient; the
+    benchmark passes a fake one.
+    """
     # Load channels
-    channels = load_channels(args.channels)
-    API_ID = os.getenv('TELEGRAM_API_ID')
-    API_HASH = os.getenv('TELEGRAM_API_HASH')
+    channels = shard_channels(load_channels(args.channels), args.shard_index, args.shard_count)
+    if client_factory is None:
+        API_ID = os.getenv('TELEGRAM_API_ID')
+        API_HASH = os.getenv('TELEGRAM_API_HASH')
+        client_factory = lambda session: TelegramClient(session, API_ID, API_HASH)
     SESSION_NAME = os.getenv('TELEGRAM_SESSION', 'anon')
+    sessions = args.sessions or [SESSION_NAME]
+    results = []
+
+    media_index = MediaIndex(args.media_index)
+    keyword_filter = KeywordFilter.from_args(args.keywords, args.keywords_file)
 
-    async with TelegramClient(SESSION_NAME, API_ID, API_HASH) as client:
-        tasks = []
-        for channel in channels:
+    async def scrape_session(client, session_channels):
+        # One scheduler per session: rate limits apply per Telegram account
+        async with RequestScheduler(args.requests_per_second, args.burst, args.max_concurrent_requests, args.max_flood_retries) as scheduler:
+            tasks = []
+            for channel in session_channels:
+                channel_client = scheduler.for_channel(client, channel)
+                if args.parallel:
+                    tasks.append(scrape_channel(channel_client, channel, args, args.image_types, keyword_filter, media_index))
+                else:
+                    results.append(await scrape_channel(channel_client, channel, args, args.image_types, keyword_filter, media_index))
             if args.parallel:
-                tasks.append(scrape_channel(client, channel, args, args.image_types, args.keywords))
-            else:
-                await scrape_channel(client, channel, args, args.image_types, args.keywords)
-        if args.parallel:
-            await asyncio.gather(*tasks)
+                results.extend(await asyncio.gather(*tasks))
+
+    async with AsyncExitStack() as stack:
+        session_tasks = []
+        for session, session_channels in assign_sessions(channels, sessions).items():
+            if not session_channels:
+                continue
+            client = await stack.enter_async_context(client_factory(session))
+            session_tasks.append(scrape_session(client, session_channels))
+        await asyncio.gather(*session_tasks)
+    media_index.close()
+    return [result for result in results if result]
+
+async def main():
+    args = parse_args()
+    if args.resume_stats:
+        for state in resume_stats(CHECKPOINT_DIR):
+            print(f"Channel: {state['channel']} | Last message: {state.get('last_message_id')} ({state.get('last_message_date')}) | "
+                  f"Committed: {state.get('messages_committed', 0)} | Updated: {state.get('updated_at')}")
+        return
+    await run_scraper(args)
+    export('scrape_telegram')
     print('Scraping complete.')
 
 if __name__ == '__main__':
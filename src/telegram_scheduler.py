@@ -0,0 +1,185 @@
+import asyncio
+import logging
+import time
+import zlib
+from collections import deque
+from telethon.errors import FloodWaitError
+
+DEFAULT_REQUESTS_PER_SECOND = 10.0
+DEFAULT_BURST = 20
+DEFAULT_MAX_CONCURRENT_REQUESTS = 8
+DEFAULT_MAX_FLOOD_RETRIES = 5
+PAGE_SIZE = 100
+
+class TokenBucket:
+    """Classic token bucket: `rate` tokens per second, holding at most `burst`."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class RequestScheduler:
+    """Owns every Telegram request made through one client.
+
+    Requests are queued per channel and dispatched round-robin, so a channel
+    with a deep backlog can't starve the others. Each dispatch takes a token
+    from the shared bucket and one of `max_concurrent` slots. A FloodWaitError
+    only blocks the channel that hit it: its queue is paused for the requested
+    time (without blocking the event loop) and the request is retried, up to
+    `max_flood_retries` times.
+    """
+
+    def __init__(self, rate=DEFAULT_REQUESTS_PER_SECOND, burst=DEFAULT_BURST, max_concurrent=DEFAULT_MAX_CONCURRENT_REQUESTS, max_flood_retries=DEFAULT_MAX_FLOOD_RETRIES):
+        self.bucket = TokenBucket(rate, burst)
+        self.slots = asyncio.Semaphore(max(1, max_concurrent))
+        self.max_flood_retries = max_flood_retries
+        self.queues = {}
+        self.order = deque()
+        self.blocked_until = {}
+        self.flood_wait_seconds = {}
+        self.requests = 0
+        self.wakeup = asyncio.Event()
+        self.dispatcher = None
+        self.running = set()
+
+    async def __aenter__(self):
+        self.dispatcher = asyncio.create_task(self._dispatch())
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.dispatcher.cancel()
+        try:
+            await self.dispatcher
+        except asyncio.CancelledError:
+            pass
+        if self.running:
+            await asyncio.gather(*self.running, return_exceptions=True)
+
+    async def call(self, channel, func, *args, **kwargs):
+        """Queue `func(*args, **kwargs)` under `channel` and wait for its result."""
+        future = asyncio.get_running_loop().create_future()
+        if channel not in self.queues:
+            self.queues[channel] = deque()
+            self.order.append(channel)
+        self.queues[channel].append((func, args, kwargs, future, 0))
+        self.wakeup.set()
+        return await future
+
+    def for_channel(self, client, channel):
+        return ScheduledClient(self, client, channel)
+
+    def _next_job(self):
+        now = time.monotonic()
+        for _ in range(len(self.order)):
+            channel = self.order[0]
+            self.order.rotate(-1)
+            queue = self.queues[channel]
+            while queue and queue[0][3].done():
+                queue.popleft()  # caller went away
+            if queue and self.blocked_until.get(channel, 0) <= now:
+                return channel, queue.popleft()
+        return None
+
+    def _next_unblock_in(self):
+        now = time.monotonic()
+        waits = [until - now for channel, until in self.blocked_until.items() if self.queues.get(channel)]
+        return max(0.0, min(waits)) if waits else None
+
+    async def _dispatch(self):
+        while True:
+            picked = self._next_job()
+            if picked is None:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), self._next_unblock_in())
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self.slots.acquire()
+            await self.bucket.acquire()
+            task = asyncio.create_task(self._run(*picked))
+            self.running.add(task)
+            task.add_done_callback(self.running.discard)
+
+    async def _run(self, channel, job):
+        func, args, kwargs, future, attempts = job
+        self.requests += 1
+        try:
+            result = await func(*args, **kwargs)
+        except FloodWaitError as e:
+            self.flood_wait_seconds[channel] = self.flood_wait_seconds.get(channel, 0) + e.seconds
+            if attempts >= self.max_flood_retries:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                logging.warning(f'FloodWaitError for {channel}: pausing its requests for {e.seconds} seconds')
+                self.blocked_until[channel] = time.monotonic() + e.seconds
+                self.queues[channel].appendleft((func, args, kwargs, future, attempts + 1))
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+        else:
+            if not future.done():
+                future.set_result(result)
+        finally:
+            self.slots.release()
+            self.wakeup.set()
+
+class ScheduledClient:
+    """The part of TelegramClient used by scrape_channel, routed through a RequestScheduler."""
+
+    def __init__(self, scheduler, client, channel, page_size=PAGE_SIZE):
+        self.scheduler = scheduler
+        self.client = client
+        self.channel = channel
+        self.page_size = page_size
+
+    @property
+    def flood_wait_seconds(self):
+        return self.scheduler.flood_wait_seconds.get(self.channel, 0)
+
+    async def iter_messages(self, entity, reverse=True, min_id=0, offset_date=None):
+        """Oldest-first iteration over messages newer than `min_id`.
+
+        Fetches one page per scheduled request and continues from the last id
+        seen, so a retried page never re-yields or skips messages.
+        """
+        if not reverse:
+            raise ValueError('ScheduledClient only supports reverse (oldest-first) iteration')
+        last_id = min_id or 0
+        while True:
+            kwargs = {'limit': self.page_size, 'reverse': True, 'offset_id': last_id}
+            if not last_id and offset_date:
+                kwargs['offset_date'] = offset_date
+            page = await self.scheduler.call(self.channel, self.client.get_messages, entity, **kwargs)
+            if not page:
+                return
+            for message in page:
+                last_id = max(last_id, message.id)
+                yield message
+
+    async def download_media(self, message, file_path):
+        return await self.scheduler.call(self.channel, self.client.download_media, message, file_path)
+
+def shard_channels(channels, shard_index, shard_count):
+    """Stable subset of `channels` for one of `shard_count` scraper processes."""
+    return [channel for channel in channels if zlib.crc32(channel.encode('utf-8')) % shard_count == shard_index]
+
+def assign_sessions(channels, sessions):
+    """Spread channels over session files round-robin; returns {session: [channels]}."""
+    assignment = {session: [] for session in sessions}
+    for i, channel in enumerate(channels):
+        assignment[sessions[i % len(sessions)]].append(channel)
+    return assignment
@@ -0,0 +1,174 @@
+import os
+import ast
+import math
+import time
+import cv2
+import numpy as np
+
+DEFAULT_IOU = 0.7        # ultralytics' predict default
+MAX_DET = 300
+MAX_NMS = 30000
+MAX_WH = 7680            # class offset so NMS never merges boxes of different classes
+PAD_VALUE = 114
+
+# YOLO models loaded so far in this process, by weights name
+_models = {}
+
+def get_model(name):
+    """Load `name` with ultralytics the first time it is asked for in this process and reuse it after."""
+    if name not in _models:
+        from ultralytics import YOLO
+        _models[name] = YOLO(name)
+    return _models[name]
+
+def weights_path(name):
+    """Local path of the weights `name`, downloading ultralytics' released weights if needed.
+
+    Only fetches the file; no model is built, so a parent process can hash
+    the weights without paying for a model its workers load themselves.
+    """
+    if os.path.isfile(name):
+        return name
+    from ultralytics.utils.downloads import attempt_download_asset
+    return str(attempt_download_asset(name))
+
+def letterbox(img, imgsz):
+    """Resize keeping the aspect ratio and pad to a square, as ultralytics does for fixed-size models."""
+    h, w = img.shape[:2]
+    r = min(imgsz / h, imgsz / w)
+    new_w, new_h = int(round(w * r)), int(round(h * r))
+    dw, dh = (imgsz - new_w) / 2, (imgsz - new_h) / 2
+    if (w, h) != (new_w, new_h):
+        img = cv2.resize(img, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
+    top, bottom = int(round(dh - 0.1)), int(round(dh + 0.1))
+    left, right = int(round(dw - 0.1)), int(round(dw + 0.1))
+    return cv2.copyMakeBorder(img, top, bottom, left, right, cv2.BORDER_CONSTANT, value=(PAD_VALUE,) * 3)
+
+def preprocess(images, imgsz):
+    """BGR HWC uint8 images -> RGB NCHW float32 batch in [0, 1]."""
+    batch = np.stack([letterbox(img, imgsz) for img in images])
+    batch = np.ascontiguousarray(batch[..., ::-1].transpose(0, 3, 1, 2))
+    return batch.astype(np.float32) / 255.0
+
+def non_max_suppression(pred, conf, iou=DEFAULT_IOU, max_det=MAX_DET):
+    """One image's raw (4 + classes, anchors) output -> [(class_id, score), ...], best first.
+
+    Mirrors ultralytics' single-label, class-aware NMS so every backend
+    reports the same detections for the same network output.
+    """
+    pred = pred.T
+    class_ids = pred[:, 4:].argmax(1)
+    scores = pred[np.arange(len(pred)), 4 + class_ids]
+    keep = scores > conf
+    xywh, scores, class_ids = pred[keep, :4], scores[keep], class_ids[keep]
+    order = np.argsort(-scores, kind='stable')[:MAX_NMS]
+    boxes = np.concatenate([xywh[:, :2] - xywh[:, 2:] / 2, xywh[:, :2] + xywh[:, 2:] / 2], axis=1)
+    boxes = boxes + class_ids[:, None] * MAX_WH
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    kept = []
+    while order.size and len(kept) < max_det:
+        i, rest = order[0], order[1:]
+        kept.append(i)
+        tl = np.maximum(boxes[i, :2], boxes[rest, :2])
+        br = np.minimum(boxes[i, 2:], boxes[rest, 2:])
+        inter = np.prod(np.clip(br - tl, 0, None), axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            overlap = inter / (areas[i] + areas[rest] - inter)
+        # Like torchvision, only suppress on IoU > iou (degenerate 0/0 boxes survive)
+        order = rest[~(overlap > iou)]
+    return [(int(class_ids[i]), float(scores[i])) for i in kept]
+
+class Backend:
+    """Runs the network; preprocessing and NMS are shared so backends only differ in the forward pass.
+
+    Every image is letterboxed to the same `imgsz` square, so an image's
+    detections don't depend on which other images share its batch.
+    Subclasses set `names`, `imgsz` and `forward(batch) -> (N, 4 + classes, anchors)`.
+    """
+    name = None
+
+    def __init__(self, conf, iou=DEFAULT_IOU):
+        self.conf = conf
+        self.iou = iou
+
+    def predict(self, images, stage_seconds=None):
+        """Detections for each BGR image as [[class name, confidence], ...]."""
+        started = time.perf_counter()
+        batch = preprocess(images, self.imgsz)
+        preprocessed = time.perf_counter()
+        pred = self.forward(batch)
+        inferred = time.perf_counter()
+        boxes = [
+            [[self.names.get(c, str(c)), score] for c, score in non_max_suppression(p, self.conf, self.iou)]
+            for p in pred
+        ]
+        if stage_seconds is not None:
+            stage_seconds['preprocess'] += preprocessed - started
+            stage_seconds['inference'] += inferred - preprocessed
+            stage_seconds['postprocess'] += time.perf_counter() - inferred
+        return boxes
+
+class TorchBackend(Backend):
+    name = 'torch'
+
+    def __init__(self, weights, imgsz, conf, iou=DEFAULT_IOU, threads=None):
+        super().__init__(conf, iou)
+        import torch
+        self.torch = torch
+        if threads:
+            torch.set_num_threads(threads)
+        yolo = get_model(weights)
+        self.model = yolo.model.fuse(verbose=False).eval()
+        self.names = yolo.names
+        stride = int(max(self.model.stride))
+        self.imgsz = math.ceil(imgsz / stride) * stride
+
+    def forward(self, batch):
+        with self.torch.inference_mode():
+            out = self.model(self.torch.from_numpy(batch))
+        return (out[0] if isinstance(out, (list, tuple)) else out).numpy()
+
+class OnnxBackend(Backend):
+    """ONNX Runtime on CPU for models from export_yolo.py (fp32 or int8).
+
+    Class names and the input size come from the metadata ultralytics writes
+    into the exported model.
+    """
+    name = 'onnx'
+
+    def __init__(self, weights, imgsz, conf, iou=DEFAULT_IOU, threads=None):
+        super().__init__(conf, iou)
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(weights, options, providers=['CPUExecutionProvider'])
+        meta = self.session.get_modelmeta().custom_metadata_map
+        self.names = ast.literal_eval(meta['names']) if 'names' in meta else {}
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        batch_dim, _, height, _ = model_input.shape
+        self.imgsz = height if isinstance(height, int) else imgsz
+        self.fixed_batch = batch_dim if isinstance(batch_dim, int) else None
+
+    def forward(self, batch):
+        if not self.fixed_batch or len(batch) == self.fixed_batch:
+            return self.session.run(None, {self.input_name: batch})[0]
+        # Static-batch export: run in chunks of its batch size, zero-padding the last one
+        outputs = []
+        for start in range(0, len(batch), self.fixed_batch):
+            chunk = batch[start:start + self.fixed_batch]
+            padded = np.zeros((self.fixed_batch,) + chunk.shape[1:], dtype=chunk.dtype)
+            padded[:len(chunk)] = chunk
+            outputs.append(self.session.run(None, {self.input_name: padded})[0][:len(chunk)])
+        return np.concatenate(outputs)
+
+BACKENDS = {'torch': TorchBackend, 'onnx': OnnxBackend}
+
+def backend_for(weights, backend='auto'):
+    if backend == 'auto':
+        return 'onnx' if str(weights).endswith('.onnx') else 'torch'
+    return backend
+
+def load_backend(weights, backend='auto', imgsz=640, conf=0.25, iou=DEFAULT_IOU, threads=None):
+    return BACKENDS[backend_for(weights, backend)](weights, imgsz, conf, iou, threads)
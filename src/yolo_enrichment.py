@@ -1,52 +1,478 @@
 import os
 import csv
-from ultralytics import YOLO
+import json
+import time
+import argparse
+from datetime import datetime, timezone
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+import cv2
 from glob import glob
+from pg_copy import DEFAULT_BATCH_ROWS
+from checkpoints import write_json_atomic
+from detection_cache import DETECTION_CACHE_PATH, DetectionCache, model_key, run_stats
+from yolo_backends import BACKENDS, load_backend, weights_path
+from perceptual_hash import BKTree, DEFAULT_HASH_ALGORITHM, DEFAULT_MAX_DISTANCE, HASH_ALGORITHMS, image_hash
+from instrumentation import counter, histogram, export
+from parquet_lake import LAKE_ROOT, DetectionLakeWriter
 
 IMAGE_ROOT = 'data/raw/telegram_images'
 OUTPUT_CSV = 'yolo_detections.csv'
 MODEL_NAME = 'yolov8n.pt'  # You can use yolov8n.pt (nano), yolov8s.pt (small), etc.
+DEFAULT_BATCH_SIZE = 8
+DEFAULT_IMGSZ = 640
+DEFAULT_CONF = 0.25
+DEFAULT_DECODE_WORKERS = 4
+DEFAULT_PREFETCH_BATCHES = 2
+PROGRESS_PATH = 'data/raw/yolo_progress.json'
+STAGES = ('decode', 'preprocess', 'inference', 'postprocess')
 
-# Load YOLOv8 model
-model = YOLO(MODEL_NAME)
+IMAGE_STAGE_SECONDS = histogram('enrichment_image_stage_seconds', 'Per-image time in each enrichment stage', ['stage'])
+IMAGES = counter('enrichment_images_total', 'Images seen by the enrichment run', ['outcome'])
 
-def get_all_images():
-    # Recursively find all images in the directory
+def observe_stages(after, before, images):
+    """Spread each stage's time since `before` evenly over the batch's images."""
+    if images:
+        for stage, seconds in after.items():
+            if seconds > before.get(stage, 0.0):
+                IMAGE_STAGE_SECONDS.labels(stage).observe((seconds - before.get(stage, 0.0)) / images, count=images)
+
+# Inference backends created so far in this process
+_backends = {}
+
+def get_backend(args):
+    """The backend for `args`, loaded the first time it is asked for in this process and reused after."""
+    key = (args.backend, args.model, args.imgsz, args.conf)
+    if key not in _backends:
+        _backends[key] = load_backend(args.model, args.backend, args.imgsz, args.conf, threads=args.threads)
+    return _backends[key]
+
+def resolve_model_key(name, imgsz):
+    # ultralytics downloads named weights into the working directory, so hash
+    # that file; the model itself is only built in the processes that infer
+    return f"{model_key(weights_path(name))}@{imgsz}"
+
+def get_all_images(image_root=IMAGE_ROOT):
+    # Recursively find all images in the directory; only files named after a
+    # message can be linked to one, so anything else is skipped here
     exts = ('*.jpg', '*.jpeg', '*.png')
-    for root, dirs, files in os.walk(IMAGE_ROOT):
+    for root, dirs, files in os.walk(image_root):
         for ext in exts:
             for img_path in glob(os.path.join(root, ext)):
+                if extract_message_id(img_path) is None:
+                    print(f"Skipping {img_path}: file name is not a message id")
+                    continue
                 yield img_path
 
 def extract_message_id(image_path):
-    # Assumes filename is message_id.jpg or message_id.png
+    # Assumes filename is message_id.jpg or message_id.png; None for any other name
     fname = os.path.basename(image_path)
     msg_id = fname.split('.')[0]
-    return msg_id
+    return int(msg_id) if msg_id.isdigit() else None
 
-def main():
-    results = []
-    for img_path in get_all_images():
-        msg_id = extract_message_id(img_path)
+def iter_image_units(image_root=IMAGE_ROOT):
+    """Group images by their date/channel directory into (unit, [paths]) for the worker pool."""
+    units = {}
+    for img_path in get_all_images(image_root):
+        unit = os.path.relpath(os.path.dirname(img_path), image_root).replace('\\', '/')
+        units.setdefault(unit, []).append(img_path)
+    return sorted(units.items())
+
+def detection_rows(boxes, msg_id, img_path):
+    return [{
+        'message_id': msg_id,
+        'image_path': img_path.replace('\\', '/'),
+        'detected_object_class': cls,
+        'confidence_score': conf
+    } for cls, conf in boxes]
+
+def iter_uncached(img_paths, cache, sink, content_hashes):
+    """Yield images the cache has no result for; cached detections go straight to `sink`."""
+    for img_path in img_paths:
         try:
-            yolo_results = model(img_path)
-            for det in yolo_results[0].boxes:
-                cls = yolo_results[0].names[int(det.cls)]
-                conf = float(det.conf)
-                results.append({
-                    'message_id': msg_id,
-                    'image_path': img_path,
-                    'detected_object_class': cls,
-                    'confidence_score': conf
-                })
-        except Exception as e:
+            content_hash = cache.content_hash(img_path)
+        except OSError as e:
             print(f"Error processing {img_path}: {e}")
-    # Write results to CSV
-    with open(OUTPUT_CSV, 'w', newline='', encoding='utf-8') as f:
-        writer = csv.DictWriter(f, fieldnames=['message_id', 'image_path', 'detected_object_class', 'confidence_score'])
-        writer.writeheader()
-        writer.writerows(results)
-    print(f"Detection results saved to {OUTPUT_CSV} ({len(results)} detections)")
+            cache.errors += 1
+            continue
+        boxes = cache.get(content_hash)
+        if boxes is None:
+            content_hashes[img_path] = content_hash
+            yield img_path
+        else:
+            sink.write(detection_rows(boxes, extract_message_id(img_path), img_path))
+
+def store_result(boxes, img_path, cache, content_hashes, sink, representative=None):
+    cache.put(content_hashes.pop(img_path), boxes, representative)
+    sink.write(detection_rows(boxes, extract_message_id(img_path), img_path))
+
+class NearDuplicateIndex:
+    """Perceptual hashes of the images the model actually ran on, for reusing their detections.
+
+    Only representatives are indexed, never images that borrowed detections,
+    so a chain of slightly different reposts can't drift away from the image
+    that was really inferred.
+    """
+
+    def __init__(self, cache, algorithm=DEFAULT_HASH_ALGORITHM, max_distance=DEFAULT_MAX_DISTANCE):
+        self.algorithm = algorithm
+        self.max_distance = max_distance
+        self.tree = BKTree()
+        self.known = set()
+        self.loaded_at = ''
+        self.refresh(cache)
+
+    def refresh(self, cache):
+        """Pick up representatives other processes have committed since the last load."""
+        loaded_at = datetime.now(timezone.utc).isoformat()
+        for hash_value, content_hash in cache.iter_representatives(self.algorithm, self.loaded_at):
+            self.add(hash_value, content_hash)
+        self.loaded_at = loaded_at
+
+    def match(self, hash_value):
+        found = self.tree.nearest(hash_value, self.max_distance)
+        return found[1] if found else None
+
+    def add(self, hash_value, content_hash):
+        if content_hash not in self.known:
+            self.known.add(content_hash)
+            self.tree.add(hash_value, content_hash)
+
+def decode_image(img_path, hash_algorithm=None):
+    """Read an image as a BGR array; returns (path, image, seconds, perceptual hash or None)."""
+    started = time.perf_counter()
+    img = cv2.imread(img_path)
+    hash_value = image_hash(img, hash_algorithm) if hash_algorithm and img is not None else None
+    return img_path, img, time.perf_counter() - started, hash_value
+
+def iter_decoded_batches(img_paths, batch_size, pool, prefetch_batches, hash_algorithm=None):
+    """Yield lists of decoded images, keeping up to `prefetch_batches` batches decoding ahead."""
+    window = deque()
+    batch = []
+    paths = iter(img_paths)
+    for img_path in paths:
+        window.append(pool.submit(decode_image, img_path, hash_algorithm))
+        if len(window) >= batch_size * prefetch_batches:
+            break
+    while window:
+        batch.append(window.popleft().result())
+        next_path = next(paths, None)
+        if next_path is not None:
+            window.append(pool.submit(decode_image, next_path, hash_algorithm))
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def infer_batch(backend, decoded, cache, index, content_hashes, sink, stage_seconds):
+    """Run the model on a batch of decoded images; returns how many it actually ran on.
+
+    With an `index`, images that look like an already inferred image (or an
+    earlier one in this batch) reuse its detections instead.
+    """
+    to_infer = []
+    followers = []
+    batch_reps = set()
+    for img_path, img, seconds, hash_value in decoded:
+        stage_seconds['decode'] += seconds
+        IMAGE_STAGE_SECONDS.labels('decode').observe(seconds)
+        if img is None:
+            print(f"Error processing {img_path}: could not decode image")
+            content_hashes.pop(img_path, None)
+            cache.errors += 1
+            continue
+        if index is not None:
+            content_hash = content_hashes[img_path]
+            cache.put_image_hash(content_hash, index.algorithm, hash_value)
+            rep = index.match(hash_value)
+            if rep in batch_reps:
+                followers.append((img_path, rep))
+                continue
+            boxes = cache.peek(rep) if rep else None
+            if boxes is not None:
+                store_result(boxes, img_path, cache, content_hashes, sink, representative=rep)
+                cache.near_duplicates += 1
+                continue
+            index.add(hash_value, content_hash)
+            batch_reps.add(content_hash)
+        to_infer.append((img_path, img))
+    if not to_infer:
+        return 0
+    before = {stage: stage_seconds[stage] for stage in STAGES[1:]}
+    try:
+        batch_boxes = backend.predict([img for _, img in to_infer], stage_seconds)
+        observe_stages({stage: stage_seconds[stage] for stage in STAGES[1:]}, before, len(to_infer))
+    except Exception as e:
+        print(f"Error processing batch starting at {to_infer[0][0]}: {e}")
+        for img_path, _ in to_infer + followers:
+            content_hashes.pop(img_path, None)
+        cache.errors += len(to_infer) + len(followers)
+        return 0
+    inferred = {}
+    for (img_path, _), boxes in zip(to_infer, batch_boxes):
+        inferred[content_hashes[img_path]] = boxes
+        store_result(boxes, img_path, cache, content_hashes, sink)
+    for img_path, rep in followers:
+        store_result(inferred[rep], img_path, cache, content_hashes, sink, representative=rep)
+        cache.near_duplicates += 1
+    return len(to_infer)
+
+# Near-duplicate indexes built so far in this process; worker-mode units share one
+_indexes = {}
+
+def near_duplicate_index(args, cache):
+    if args.near_dup_distance < 0:
+        return None
+    key = (cache.model_key, cache.conf, args.hash_algorithm, args.near_dup_distance)
+    if key in _indexes:
+        _indexes[key].refresh(cache)
+    else:
+        _indexes[key] = NearDuplicateIndex(cache, args.hash_algorithm, args.near_dup_distance)
+    return _indexes[key]
+
+def run_sequential(args, cache, sink, stage_seconds, img_paths=None):
+    backend = get_backend(args)
+    index = near_duplicate_index(args, cache)
+    hash_algorithm = index.algorithm if index else None
+    content_hashes = {}
+    images = 0
+    for img_path in iter_uncached(img_paths or get_all_images(), cache, sink, content_hashes):
+        images += infer_batch(backend, [decode_image(img_path, hash_algorithm)], cache, index, content_hashes, sink, stage_seconds)
+    cache.commit()
+    return images
+
+def run_batched(args, cache, sink, stage_seconds, img_paths=None):
+    """Decode images in a thread pool while the model runs fixed-size batches."""
+    backend = get_backend(args)
+    index = near_duplicate_index(args, cache)
+    hash_algorithm = index.algorithm if index else None
+    content_hashes = {}
+    images = 0
+    img_paths = iter_uncached(img_paths or get_all_images(), cache, sink, content_hashes)
+    with ThreadPoolExecutor(max_workers=args.decode_workers, thread_name_prefix='decode') as pool:
+        for batch in iter_decoded_batches(img_paths, args.batch_size, pool, args.prefetch_batches, hash_algorithm):
+            images += infer_batch(backend, batch, cache, index, content_hashes, sink, stage_seconds)
+            cache.commit()
+    return images
+
+class DetectionSink:
+    """Streams detections to the CSV export, raw_image_detections and/or the Parquet lake as they are produced.
+
+    Postgres rows go through a bounded COPY buffer and are upserted on the
+    table's natural key, so cached detections re-sent on a later run are
+    no-ops. The CSV is written next to its final name and moved into place on
+    close, so a crashed run never leaves a truncated export behind; the lake
+    snapshot is swapped in the same way (see parquet_lake.DetectionLakeWriter).
+    """
+
+    def __init__(self, csv_path=None, postgres=False, batch_rows=DEFAULT_BATCH_ROWS, append=False, lake_root=None):
+        self.rows = 0
+        self.csv_path = csv_path
+        self.csv_file = self.writer = None
+        self.conn = self.buffer = None
+        self.lake = None
+        if csv_path:
+            # A resumed run carries on with the interrupted run's partial export
+            resume_csv = append and os.path.exists(csv_path + '.tmp')
+            self.csv_file = open(csv_path + '.tmp', 'a' if resume_csv else 'w', newline='', encoding='utf-8')
+            self.writer = csv.DictWriter(self.csv_file, fieldnames=['message_id', 'image_path', 'detected_object_class', 'confidence_score'])
+            if not resume_csv:
+                self.writer.writeheader()
+        if postgres:
+            # Imported here so CSV-only runs don't need psycopg2 or a database
+            from load_yolo_detections import connect, prepare_table, open_buffer
+            self.conn = connect()
+            prepare_table(self.conn)
+            self.buffer = open_buffer(self.conn, max_rows=batch_rows)
+        if lake_root:
+            self.lake = DetectionLakeWriter(lake_root, append=append)
+
+    def write(self, rows):
+        for row in rows:
+            if self.writer:
+                self.writer.writerow(row)
+            if self.buffer:
+                self.buffer.add((int(row['message_id']), row['image_path'], row['detected_object_class'], row['confidence_score']))
+        if self.lake:
+            self.lake.write(rows)
+        self.rows += len(rows)
+
+    def flush(self):
+        if self.buffer:
+            self.buffer.flush()
+        if self.lake:
+            self.lake.flush()
+        if self.csv_file:
+            self.csv_file.flush()
+
+    def close(self):
+        if self.buffer:
+            self.buffer.flush()
+            if self.buffer.rows:
+                from data_version import bump_data_version
+                with self.conn.cursor() as cur:
+                    bump_data_version(cur, 'raw_image_detections')
+                self.conn.commit()
+            self.conn.close()
+            print(f"Upserted {self.buffer.rows} detections into raw_image_detections in {self.buffer.batches} batches")
+        if self.csv_file:
+            self.csv_file.close()
+            os.replace(self.csv_path + '.tmp', self.csv_path)
+            print(f"Detection results saved to {self.csv_path} ({self.rows} detections)")
+        if self.lake:
+            self.lake.close()
+            print(f"Wrote {self.lake.rows} detections to {self.lake.root}/detections ({self.lake.parts} part files)")
+
+class CollectedRows(list):
+    """Sink that keeps a worker's detections to hand back to the parent process."""
+
+    def write(self, rows):
+        self.extend(rows)
+
+# Per-process state for worker mode: each worker holds its own cache connection
+_worker = {}
+
+def init_worker(args, key):
+    args.threads = args.threads or max(1, (os.cpu_count() or 1) // args.workers)
+    _worker.update(args=args, cache=DetectionCache(key, args.conf, args.cache))
+
+def process_unit(unit):
+    name, img_paths = unit
+    args, cache = _worker['args'], _worker['cache']
+    before = (cache.hits, cache.misses, cache.errors, cache.near_duplicates)
+    rows = CollectedRows()
+    stage_seconds = dict.fromkeys(STAGES, 0.0)
+    started = time.perf_counter()
+    run = run_batched if args.mode == 'batched' else run_sequential
+    images = run(args, cache, rows, stage_seconds, img_paths)
+    counts = (cache.hits - before[0], cache.misses - before[1], cache.errors - before[2], cache.near_duplicates - before[3])
+    return name, os.getpid(), rows, images, counts, stage_seconds, time.perf_counter() - started
+
+def load_progress(path, key, conf):
+    """Units finished by an interrupted run with the same model and conf."""
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            progress = json.load(f)
+        if progress.get('model_key') == key and progress.get('conf') == conf:
+            return progress
+    return {'model_key': key, 'conf': conf, 'done': {}}
+
+def run_parallel(args, key, cache, sink, stage_seconds):
+    """Run date/channel units in a process pool and merge their detections into `sink`.
+
+    Each worker loads the model once and pulls units as it frees up. A unit
+    is marked done in the progress file only after its rows are flushed, so
+    `--resume` picks up where an interrupted run stopped.
+    """
+    progress = {'model_key': key, 'conf': args.conf, 'done': {}}
+    if args.resume:
+        progress = load_progress(args.progress, key, args.conf)
+    units = iter_image_units()
+    todo = [unit for unit in units if progress['done'].get(unit[0]) != len(unit[1])]
+    if len(todo) < len(units):
+        print(f"Resuming: {len(units) - len(todo)} of {len(units)} units already done")
+    images = 0
+    per_worker = {}
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker, initargs=(args, key)) as pool:
+        futures = {pool.submit(process_unit, unit): unit for unit in todo}
+        for future in as_completed(futures):
+            name, pid, rows, unit_images, counts, unit_stages, seconds = future.result()
+            sink.write(rows)
+            sink.flush()
+            progress['done'][name] = len(futures[future][1])
+            write_json_atomic(args.progress, progress)
+            cache.hits += counts[0]
+            cache.misses += counts[1]
+            cache.errors += counts[2]
+            cache.near_duplicates += counts[3]
+            for stage, unit_seconds in unit_stages.items():
+                stage_seconds[stage] += unit_seconds
+            # Workers' own metrics stay in their processes; per-unit averages are what reaches this one
+            observe_stages(unit_stages, {}, unit_images)
+            images += unit_images
+            stats = per_worker.setdefault(pid, [0, 0, 0.0])
+            stats[0] += 1
+            stats[1] += unit_images
+            stats[2] += seconds
+            print(f"[worker {pid}] {name}: {unit_images} inferred, {len(rows)} detections in {seconds:.2f}s", flush=True)
+    for pid, (unit_count, worker_images, busy) in sorted(per_worker.items()):
+        print(f"Worker {pid}: {unit_count} units, {worker_images} images inferred, busy {busy:.2f}s")
+    # The run finished, so the next one starts from scratch (the cache keeps it cheap)
+    if os.path.exists(args.progress):
+        os.remove(args.progress)
+    return images
+
+def print_cache_stats(path):
+    runs = run_stats(path)
+    if not runs:
+        print(f"No runs recorded in {path}")
+        return
+    print(f"{'run':>5}  {'finished':<21}{'model':<28}{'conf':>6}{'images':>8}{'hits':>8}{'misses':>8}{'errors':>8}{'near-dup':>10}")
+    for r in runs:
+        print(f"{r['run_id']:>5}  {r['finished_at'][:19]:<21}{r['model_key'][:27]:<28}{r['conf']:>6.2f}{r['images']:>8}{r['hits']:>8}{r['misses']:>8}{r['errors']:>8}{r['near_duplicates'] or 0:>10}")
+
+def main():
+    parser = argparse.ArgumentParser(description='YOLOv8 enrichment of scraped images')
+    parser.add_argument('--mode', choices=['sequential', 'batched'], default='batched', help='batched prefetches and decodes images in a thread pool and runs fixed-size batches')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE, help='Images per forward pass (batched mode)')
+    parser.add_argument('--imgsz', type=int, default=DEFAULT_IMGSZ, help='Inference image size')
+    parser.add_argument('--threads', '--torch-threads', type=int, default=None, help='Intra-op threads per process for torch/ONNX Runtime (default: the runtime decides, or cores / --workers in worker mode)')
+    parser.add_argument('--decode-workers', type=int, default=DEFAULT_DECODE_WORKERS, help='Threads decoding images ahead of the model')
+    parser.add_argument('--prefetch-batches', type=int, default=DEFAULT_PREFETCH_BATCHES, help='Batches decoded ahead of the model')
+    parser.add_argument('--model', type=str, default=MODEL_NAME, help='YOLO weights to run (.pt, or .onnx from export_yolo.py)')
+    parser.add_argument('--backend', choices=['auto'] + list(BACKENDS), default='auto', help='Inference backend (auto: onnx for .onnx weights, torch otherwise)')
+    parser.add_argument('--conf', type=float, default=DEFAULT_CONF, help='Confidence threshold')
+    parser.add_argument('--cache', type=str, default=DETECTION_CACHE_PATH, help='Detection cache database')
+    parser.add_argument('--cache-stats', action='store_true', help='List cache hits/misses of recent runs and exit')
+    parser.add_argument('--near-dup-distance', type=int, default=DEFAULT_MAX_DISTANCE, help='Reuse the detections of an inferred image whose perceptual hash is within this many bits (-1 disables)')
+    parser.add_argument('--hash-algorithm', choices=HASH_ALGORITHMS, default=DEFAULT_HASH_ALGORITHM, help='Perceptual hash for near-duplicate matching')
+    parser.add_argument('--sink', nargs='+', choices=['csv', 'postgres', 'parquet', 'both'], default=['csv'], help='Where detections go: the CSV export, raw_image_detections and/or the Parquet lake (both: csv and postgres)')
+    parser.add_argument('--lake', type=str, default=LAKE_ROOT, help='Parquet lake root for --sink parquet')
+    parser.add_argument('--output', type=str, default=OUTPUT_CSV, help='CSV export path')
+    parser.add_argument('--db-batch-rows', type=int, default=DEFAULT_BATCH_ROWS, help='Detections per COPY batch')
+    parser.add_argument('--workers', type=int, default=1, help='Run date/channel directories in this many processes, each with its own model')
+    parser.add_argument('--progress', type=str, default=PROGRESS_PATH, help='Units finished so far in worker mode')
+    parser.add_argument('--resume', action='store_true', help='Skip units an interrupted worker-mode run already finished')
+    args = parser.parse_args()
+
+    if args.cache_stats:
+        print_cache_stats(args.cache)
+        return
+
+    key = resolve_model_key(args.model, args.imgsz)
+    cache = DetectionCache(key, args.conf, args.cache)
+    sinks = set(args.sink)
+    if 'both' in sinks:
+        sinks |= {'csv', 'postgres'}
+    sink = DetectionSink(
+        csv_path=args.output if 'csv' in sinks else None,
+        postgres='postgres' in sinks,
+        batch_rows=args.db_batch_rows,
+        append=args.resume and args.workers > 1,
+        lake_root=args.lake if 'parquet' in sinks else None,
+    )
+    stage_seconds = dict.fromkeys(STAGES, 0.0)
+    started = time.perf_counter()
+    if args.workers > 1:
+        images = run_parallel(args, key, cache, sink, stage_seconds)
+    else:
+        run = run_batched if args.mode == 'batched' else run_sequential
+        images = run(args, cache, sink, stage_seconds)
+    sink.close()
+    elapsed = time.perf_counter() - started
+    cache.record_run()
+    cache.close()
+
+    for outcome, count in (('inferred', images), ('cache_hit', cache.hits), ('error', cache.errors), ('near_duplicate', cache.near_duplicates)):
+        IMAGES.labels(outcome).inc(count)
+    export('yolo_enrichment')
+
+    stages = ', '.join(f"{stage} {seconds:.2f}s" for stage, seconds in stage_seconds.items())
+    print(f"Cache: {cache.hits} hits, {cache.misses} misses, {cache.errors} errors")
+    if args.near_dup_distance >= 0:
+        print(f"Near-duplicates: {cache.near_duplicates} images reused the detections of a similar image ({cache.near_duplicates} inferences saved)")
+    print(f"Inferred {images} images in {elapsed:.2f}s ({images / max(elapsed, 1e-9):.1f} images/sec) | {stages}")
 
 if __name__ == '__main__':
-    main() 
\ No newline at end of file
+    main()